@@ -30,6 +30,7 @@ from dreem.util.cli import *
 
 @optgroup.group('Miscellaneous')
 @poisson
+@co_mutations
 @verbose
 
 
@@ -4,6 +4,7 @@ import click
 import pandas as pd
 import dreem.util as util
 import numpy as np
+import pyarrow.orc as po
 import string
 import json
 import jsbeautifier
@@ -11,16 +12,16 @@ import jsbeautifier
 from dreem.aggregate.library_samples import get_samples_info, get_library_info
 from dreem.aggregate.rnastructure import add_rnastructure_predictions
 from dreem.aggregate.poisson import compute_conf_interval
-from dreem.util.cli import INPUT_DIR, LIBRARY, SAMPLES, SAMPLE, CLUSTERING_FILE, TOP_DIR, FASTA, RNASTRUCTURE_PATH, RNASTRUCTURE_TEMPERATURE, RNASTRUCTURE_FOLD_ARGS, RNASTRUCTURE_DMS, RNASTRUCTURE_DMS_MIN_UNPAIRED_VALUE, RNASTRUCTURE_DMS_MAX_PAIRED_VALUE, POISSON, VERBOSE, COORDS, PRIMERS, FILL, RNASTRUCTURE_PARTITION, RNASTRUCTURE_PROBABILITY
+from dreem.util.cli import INPUT_DIR, LIBRARY, SAMPLES, SAMPLE, CLUSTERING_FILE, TOP_DIR, FASTA, RNASTRUCTURE_PATH, RNASTRUCTURE_TEMPERATURE, RNASTRUCTURE_FOLD_ARGS, RNASTRUCTURE_DMS, RNASTRUCTURE_DMS_MIN_UNPAIRED_VALUE, RNASTRUCTURE_DMS_MAX_PAIRED_VALUE, POISSON, VERBOSE, COORDS, PRIMERS, FILL, RNASTRUCTURE_PARTITION, RNASTRUCTURE_PROBABILITY, CO_MUTATIONS
 sys.path.append(os.path.dirname(__file__))
-from mutation_count import generate_mut_profile_from_bit_vector
+from mutation_count import generate_mut_profile_from_bit_vector, count_co_mutations
 from dreem.util.files_sanity import check_library, check_samples
 from dreem.aggregate.rnastructure import RNAstructure
 from dreem.util.seq import parse_fasta
 from dreem.util.dump import *
 import logging
 
-def run(bv_files:list, library:str=LIBRARY, samples:str=SAMPLES, sample:str=SAMPLE, clustering_file:str=CLUSTERING_FILE, out_dir:str=TOP_DIR, fasta:str = FASTA, rnastructure_path:str=RNASTRUCTURE_PATH, rnastructure_temperature:bool=RNASTRUCTURE_TEMPERATURE, rnastructure_fold_args:str=RNASTRUCTURE_FOLD_ARGS, rnastructure_dms:bool=RNASTRUCTURE_DMS, rnastructure_dms_min_unpaired_value:int=RNASTRUCTURE_DMS_MIN_UNPAIRED_VALUE, rnastructure_dms_max_paired_value:int=RNASTRUCTURE_DMS_MAX_PAIRED_VALUE, rnastructure_partition:bool=RNASTRUCTURE_PARTITION, rnastructure_probability:bool=RNASTRUCTURE_PROBABILITY, poisson:bool=POISSON, verbose:bool=VERBOSE, coords:str=COORDS, primers:str=PRIMERS, fill:bool=FILL):
+def run(bv_files:list, library:str=LIBRARY, samples:str=SAMPLES, sample:str=SAMPLE, clustering_file:str=CLUSTERING_FILE, out_dir:str=TOP_DIR, fasta:str = FASTA, rnastructure_path:str=RNASTRUCTURE_PATH, rnastructure_temperature:bool=RNASTRUCTURE_TEMPERATURE, rnastructure_fold_args:str=RNASTRUCTURE_FOLD_ARGS, rnastructure_dms:bool=RNASTRUCTURE_DMS, rnastructure_dms_min_unpaired_value:int=RNASTRUCTURE_DMS_MIN_UNPAIRED_VALUE, rnastructure_dms_max_paired_value:int=RNASTRUCTURE_DMS_MAX_PAIRED_VALUE, rnastructure_partition:bool=RNASTRUCTURE_PARTITION, rnastructure_probability:bool=RNASTRUCTURE_PROBABILITY, poisson:bool=POISSON, verbose:bool=VERBOSE, coords:str=COORDS, primers:str=PRIMERS, fill:bool=FILL, co_mutations:bool=CO_MUTATIONS):
     """Run the aggregate module.
 
     Reads in the bit vector files and aggregates them into a single file named [output]/output/aggregate/[name].csv.
@@ -69,6 +70,9 @@ def run(bv_files:list, library:str=LIBRARY, samples:str=SAMPLES, sample:str=SAMP
         primers for reference: '-p ref-name fwd rev'
     fill: bool
         Fill in coordinates of reference sequences for which neither coordinates nor primers were given (default: no).
+    co_mutations: bool
+        Count the reads mutated at and covering every pair of positions of each section, written to
+        [out_dir]/co_mutations/[sample]/[construct]/[section]_co_mut.csv and [section]_co_cov.csv.
         
     Returns:
     --------
@@ -111,12 +115,21 @@ def run(bv_files:list, library:str=LIBRARY, samples:str=SAMPLES, sample:str=SAMP
     
     mut_profiles = {}
     print('Reading in bit vectors from {}...'.format(bv_files))
+    bv_dirs = set(map(os.path.normpath, bv_files))
     for bv in bv_files:
-        construct, section = bv.split('/')[-2], bv.split('/')[-1].split('.')[0]
+        construct, boundaries = bv.split('/')[-2], bv.split('/')[-1].split('.')[0]
         
-        assert len(library[(library['construct'] == construct)&(library['section_boundaries'] == section)]) < 2, 'Library information not unique for construct {} section {}'.format(construct, section)
-        assert len(library[(library['construct'] == construct)&(library['section_boundaries'] == section)]) > 0, 'Library information not existing for construct {} section {}'.format(construct, section)
-        section = library[(library['construct'] == construct)&(library['section_boundaries'] == section)]['section'].values[0]
+        ref_seqs = fasta[fasta['construct'] == construct]['sequence'].values
+        # Bit vectors of a whole reference (vectorized with --whole-refs) are sliced into every section of the construct
+        # that was not vectorized on its own
+        sliced = len(ref_seqs) > 0 and boundaries == '1-{}'.format(len(ref_seqs[0]))
+        if sliced:
+            own_bv = library['section_boundaries'].apply(lambda b: os.path.normpath(os.path.join(os.path.dirname(bv), b)) in bv_dirs)
+            rows = library[(library['construct'] == construct)&((library['section_boundaries'] == boundaries)|~own_bv)]
+        else:
+            rows = library[(library['construct'] == construct)&(library['section_boundaries'] == boundaries)]
+            assert len(rows) < 2, 'Library information not unique for construct {} section {}'.format(construct, boundaries)
+        assert len(rows) > 0, 'Library information not existing for construct {} section {}'.format(construct, boundaries)
         
         if not len(os.listdir(bv)) > 0:
             logging.warning('No bit vectors found for construct {}'.format(construct))
@@ -127,15 +140,30 @@ def run(bv_files:list, library:str=LIBRARY, samples:str=SAMPLES, sample:str=SAMP
         # Add the library information
         mut_profiles[construct] = {**get_library_info(library, construct, verbose=verbose), **mut_profiles[construct]}
 
-        assert library[(library['construct'] == construct)&(library['section'] == section)].shape[0] == 1, 'Library information not found for construct {} section {}'.format(construct, section)
-        mut_profiles[construct][section] = {}
-        mut_profiles[construct][section]['section_start'] = library[(library['construct'] == construct)&(library['section'] == section)]['section_start'].values[0]
-        mut_profiles[construct][section]['section_end'] = library[(library['construct'] == construct)&(library['section'] == section)]['section_end'].values[0]
-        mut_profiles[construct][section]['pop_avg'] = generate_mut_profile_from_bit_vector(bv, clustering_file=clustering_file, verbose=verbose)
-        mut_profiles[construct][section]['sequence'] = mut_profiles[construct][section]['pop_avg'].pop('sequence')
-        assert mut_profiles[construct]['sequence'][mut_profiles[construct][section]['section_start']-1:mut_profiles[construct][section]['section_end']] == mut_profiles[construct][section]['sequence'], 'Sequence mismatch for construct {} section {}: {} vs {}'.format(construct, section, mut_profiles[construct]['sequence'][mut_profiles[construct][section]['section_start']-1:mut_profiles[construct][section]['section_end']], mut_profiles[construct][section]['sequence'])
-        for col in ['num_aligned']:
-            mut_profiles[construct][col] = mut_profiles[construct][section]['pop_avg'].pop(col)
+        for section in rows['section'].values:
+            assert library[(library['construct'] == construct)&(library['section'] == section)].shape[0] == 1, 'Library information not found for construct {} section {}'.format(construct, section)
+            mut_profiles[construct][section] = {}
+            mut_profiles[construct][section]['section_start'] = library[(library['construct'] == construct)&(library['section'] == section)]['section_start'].values[0]
+            mut_profiles[construct][section]['section_end'] = library[(library['construct'] == construct)&(library['section'] == section)]['section_end'].values[0]
+            first, last = int(mut_profiles[construct][section]['section_start']), int(mut_profiles[construct][section]['section_end'])
+            if not sliced or '{}-{}'.format(first, last) == boundaries:
+                first = last = None
+            mut_profiles[construct][section]['pop_avg'] = generate_mut_profile_from_bit_vector(bv, clustering_file=clustering_file, verbose=verbose, first=first, last=last)
+            mut_profiles[construct][section]['sequence'] = mut_profiles[construct][section]['pop_avg'].pop('sequence')
+            if co_mutations:
+                co_dir = os.path.join(out_dir, 'co_mutations', sample, construct)
+                os.makedirs(co_dir, exist_ok=True)
+                co_mut, co_cov = count_co_mutations(bv, first=first, last=last)
+                co_mut.to_csv(os.path.join(co_dir, section + '_co_mut.csv'))
+                co_cov.to_csv(os.path.join(co_dir, section + '_co_cov.csv'))
+            assert mut_profiles[construct]['sequence'][mut_profiles[construct][section]['section_start']-1:mut_profiles[construct][section]['section_end']] == mut_profiles[construct][section]['sequence'], 'Sequence mismatch for construct {} section {}: {} vs {}'.format(construct, section, mut_profiles[construct]['sequence'][mut_profiles[construct][section]['section_start']-1:mut_profiles[construct][section]['section_end']], mut_profiles[construct][section]['sequence'])
+            if first is None:
+                for col in ['num_aligned']:
+                    mut_profiles[construct][col] = mut_profiles[construct][section]['pop_avg'].pop(col)
+        if sliced:
+            # Each sliced section keeps the number of reads that cover it; the construct gets the number of reads
+            # aligned to the whole reference
+            mut_profiles[construct]['num_aligned'] = sum(po.ORCFile(os.path.join(bv, b)).nrows for b in os.listdir(bv) if b.endswith('.orc'))
 
     print('Done.')
     if df_samples is not None:
@@ -3,7 +3,7 @@ from dreem.util.util import *
 import pyarrow.orc as po
 import pyarrow as pa
 
-def generate_mut_profile_from_bit_vector(bit_vector, clustering_file, verbose=False):
+def generate_mut_profile_from_bit_vector(bit_vector, clustering_file, verbose=False, first=None, last=None):
     """
     Generate a mutation profile from a bit vector.
 
@@ -13,6 +13,9 @@ def generate_mut_profile_from_bit_vector(bit_vector, clustering_file, verbose=Fa
         Path to the bit vector.
     verbose : bool
         If True, print progress.
+    first, last : int
+        If given, profile only this section (1-indexed, inclusive) of the
+        bit vectors, e.g. of those of a whole reference; see read_section.
 
     Returns
     -------
@@ -52,37 +55,177 @@ def generate_mut_profile_from_bit_vector(bit_vector, clustering_file, verbose=Fa
 
     """
     # Read in the bit vector
-    bv = pa.concat_tables([po.read_table(os.path.join(bit_vector,b)) for b in os.listdir(bit_vector) if b.endswith(".orc")])
+    orc_files = [os.path.join(bit_vector,b) for b in os.listdir(bit_vector) if b.endswith(".orc")]
+    bv = pa.concat_tables([read_section(orc_file, first, last)[0] for orc_file in orc_files])
     muts = np.array(bv, dtype=np.uint8).T
+    # Index the bits of the vectors once, rather than scanning the whole
+    # array again for every query.
+    index = MutsBitmap(muts)
     # Convert to a mutation profile
     out = dict()
     out['sequence'] = ''.join([c[0] for c in bv.column_names])
     out['num_aligned'] = muts.shape[0]
-    out["match_bases"] = query_muts(muts, MATCH[0] | INS_5[0], set_type='subset')
-    out["mod_bases_A"] = query_muts(muts, SUB_A[0], set_type='subset')
-    out["mod_bases_C"] = query_muts(muts, SUB_C[0], set_type='subset')
-    out["mod_bases_G"] = query_muts(muts, SUB_G[0], set_type='subset')
-    out["mod_bases_T"] = query_muts(muts, SUB_T[0], set_type='subset')
-    out["mod_bases_N"] = query_muts(muts, SUB_N[0], set_type='subset')
-    out["del_bases"]   = query_muts(muts, DELET[0], set_type='subset')
-    out["ins_bases"]   = query_muts(muts, INS_3[0], set_type='superset')
-    # Can have any mutation, but not a match
-    out["mut_bases"] = out["mod_bases_N"] #query_muts(muts, SUB_N[0] | DELET[0] | INS_3[0], set_type='superset')
-    out["cov_bases"] = muts.astype(bool).sum(axis=0)  # i.e. not BLANK
-    # Unambiguously matching or mutated (informative)
-    out["info_bases"] = out["match_bases"] + out["mut_bases"]
-    # Mutation rate (fraction mutated among all unambiguously matching/mutated)
-    try:
-        out["mut_rates"] = out["mut_bases"] / out["info_bases"]
-    except ZeroDivisionError:
-        out["mut_rates"] = [m/i if i != 0 else None for m, i in zip(out["mut_bases"], out["info_bases"])]
+    if all(os.path.isfile(orc_file[:-len('.orc')] + '.counts.npz') for orc_file in orc_files):
+        # The per-position fields follow from the byte counts that vectoring wrote next to every batch.
+        out.update(generate_mut_profile_from_counts(bit_vector, first=first, last=last))
+    else:
+        out["match_bases"] = index.query(MATCH[0] | INS_5[0], set_type='subset')
+        out["mod_bases_A"] = index.query(SUB_A[0], set_type='subset')
+        out["mod_bases_C"] = index.query(SUB_C[0], set_type='subset')
+        out["mod_bases_G"] = index.query(SUB_G[0], set_type='subset')
+        out["mod_bases_T"] = index.query(SUB_T[0], set_type='subset')
+        out["mod_bases_N"] = index.query(SUB_N[0], set_type='subset')
+        out["del_bases"]   = index.query(DELET[0], set_type='subset')
+        out["ins_bases"]   = index.query(INS_3[0], set_type='superset')
+        # Can have any mutation, but not a match
+        out["mut_bases"] = out["mod_bases_N"] #query_muts(muts, SUB_N[0] | DELET[0] | INS_3[0], set_type='superset')
+        out["cov_bases"] = index.coverage()  # i.e. not BLANK
+        # Unambiguously matching or mutated (informative)
+        out["info_bases"] = out["match_bases"] + out["mut_bases"]
+        # Mutation rate (fraction mutated among all unambiguously matching/mutated)
+        try:
+            out["mut_rates"] = out["mut_bases"] / out["info_bases"]
+        except ZeroDivisionError:
+            out["mut_rates"] = [m/i if i != 0 else None for m, i in zip(out["mut_bases"], out["info_bases"])]
+        out['worst_cov_bases'] = min(out['cov_bases'])
+        out.pop("match_bases")
     
-    out['num_of_mutations'] = np.histogram(query_muts(muts, SUB_N[0], axis=1), bins=range(0, muts.shape[1]))[0] # query_muts(muts, SUB_N[0] | DELET[0] | INS_3[0], axis=1)
+    out['num_of_mutations'] = np.histogram(index.query(SUB_N[0], axis=1), bins=range(0, muts.shape[1]))[0] # query_muts(muts, SUB_N[0] | DELET[0] | INS_3[0], axis=1)
     
+    for k in out:
+        if isinstance(out[k], np.ndarray):
+            out[k] = list(out[k])
+    return out
+
+
+def generate_mut_profile_from_counts(bit_vector, first=None, last=None):
+    """
+    Generate the per-position fields of a mutation profile from the sidecar
+    files of byte counts that are written next to every batch of bit vectors,
+    without reading the bit vectors themselves.
+
+    Parameters
+    ----------
+    bit_vector : str
+        Path to the bit vector directory.
+    first, last : int
+        If given, profile only this section (1-indexed, inclusive) of the
+        bit vectors, e.g. of those of a whole reference; see
+        read_section_counts.
+
+    Returns
+    -------
+    df_row: dict
+        The same per-position fields as generate_mut_profile_from_bit_vector
+        (mod_bases_*, del_bases, ins_bases, mut_bases, cov_bases, info_bases,
+        mut_rates, worst_cov_bases), but not the per-read field
+        num_of_mutations, nor the sequence; and num_aligned, unless the
+        bit vectors are sliced (the number of reads that cover a section
+        does not follow from the counts of its positions).
+    """
+    counts_files = [os.path.join(bit_vector, b) for b in os.listdir(bit_vector) if b.endswith(".counts.npz")]
+    if not counts_files:
+        raise FileNotFoundError('No byte counts found in {}'.format(bit_vector))
+    counts = sum(read_section_counts(f, f[:-len('.counts.npz')] + '.orc', first, last)[0] for f in counts_files)
+    out = dict()
+    if first is None and last is None:
+        out['num_aligned'] = int(counts[0].sum())
+    out["match_bases"] = query_counts(counts, MATCH[0] | INS_5[0], set_type='subset')
+    out["mod_bases_A"] = query_counts(counts, SUB_A[0], set_type='subset')
+    out["mod_bases_C"] = query_counts(counts, SUB_C[0], set_type='subset')
+    out["mod_bases_G"] = query_counts(counts, SUB_G[0], set_type='subset')
+    out["mod_bases_T"] = query_counts(counts, SUB_T[0], set_type='subset')
+    out["mod_bases_N"] = query_counts(counts, SUB_N[0], set_type='subset')
+    out["del_bases"]   = query_counts(counts, DELET[0], set_type='subset')
+    out["ins_bases"]   = query_counts(counts, INS_3[0], set_type='superset')
+    out["mut_bases"] = out["mod_bases_N"]
+    out["cov_bases"] = counts[:, 1:].sum(axis=1)  # i.e. not BLANK
+    out["info_bases"] = out["match_bases"] + out["mut_bases"]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out["mut_rates"] = out["mut_bases"] / out["info_bases"]
     out['worst_cov_bases'] = min(out['cov_bases'])
-    
+
     out.pop("match_bases")
     for k in out:
         if isinstance(out[k], np.ndarray):
             out[k] = list(out[k])
     return out
+
+
+# Reads per matrix product in count_co_mutations: small enough that each
+# block of unpacked bits stays small, and far below 2^24, so that float32
+# products (which use BLAS) count exactly.
+# Bytes of one block of unpacked bits (positions x reads, as float32)
+CO_MUT_BLOCK_BYTES = 1 << 27
+# Most reads in one block: float32 counts integers exactly up to 2 ** 24
+CO_MUT_MAX_CHUNK = 1 << 20
+
+
+def _chunk_reads(n_positions):
+    """
+    Number of reads (a multiple of 8, the bits per packed byte) in each block
+    of _count_pairs, so that one block of n_positions x reads float32 fits in
+    CO_MUT_BLOCK_BYTES however many positions there are.
+    """
+    n_reads = min(CO_MUT_BLOCK_BYTES // (4 * max(n_positions, 1)), CO_MUT_MAX_CHUNK)
+    return max(n_reads // 8 * 8, 8)
+
+
+def _count_pairs(mask):
+    """
+    Count, for every pair of positions, the reads whose bits are 1 at both
+    positions in a packed mask (positions x reads/8; see MutsBitmap.match),
+    as the product of the unpacked mask with its transpose.
+    """
+    counts = np.zeros((mask.shape[0], mask.shape[0]), dtype=np.int64)
+    step = _chunk_reads(mask.shape[0]) // 8
+    for start in range(0, mask.shape[1], step):
+        # Padding bits at the end of the mask are 0, so they count nothing.
+        block = np.unpackbits(mask[:, start: start + step], axis=1).astype(np.float32)
+        counts += (block @ block.T).astype(np.int64)
+    return counts
+
+
+def count_co_mutations(bit_vector, bits=SUB_N[0], set_type='subset', first=None, last=None):
+    """
+    Count how many reads are mutated at both positions (co-mutation) and
+    cover both positions (co-coverage) for every pair of positions, reading
+    one batch of bit vectors at a time so that memory does not grow with the
+    number of reads.
+
+    Parameters
+    ----------
+    bit_vector : str
+        Path to the bit vector directory.
+    bits : int
+        Mutation to count, as for query_muts (default: any substitution).
+    set_type : str
+        'subset' or 'superset', as for query_muts.
+    first, last : int
+        If given, count only this section (1-indexed, inclusive) of the bit
+        vectors, e.g. of those of a whole reference; see read_section.
+
+    Returns
+    -------
+    co_mut: pd.DataFrame
+        Number of reads matching the query at both positions (positions x
+        positions); the diagonal is the number mutated at each position.
+    co_cov: pd.DataFrame
+        Number of reads covering (i.e. not BLANK at) both positions.
+    """
+    orc_files = sorted(os.path.join(bit_vector, b) for b in os.listdir(bit_vector) if b.endswith(".orc"))
+    if not orc_files:
+        raise FileNotFoundError('No bit vectors found in {}'.format(bit_vector))
+    columns = None
+    co_mut = co_cov = 0
+    for orc_file in orc_files:
+        bv, _ = read_section(orc_file, first, last)
+        if columns is None:
+            columns = bv.column_names
+        elif bv.column_names != columns:
+            raise ValueError('Positions of {} differ from those of {}'.format(orc_file, orc_files[0]))
+        index = MutsBitmap(np.array(bv, dtype=np.uint8).T)
+        co_mut = co_mut + _count_pairs(index.match(bits, set_type))
+        co_cov = co_cov + _count_pairs(index.match(AMBIG_INT))
+    return (pd.DataFrame(co_mut, index=columns, columns=columns),
+            pd.DataFrame(co_cov, index=columns, columns=columns))
@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+import numpy as np
+import pandas as pd
+
+from dreem.aggregate.main import run
+from dreem.aggregate.mutation_count import (count_co_mutations,
+                                            generate_mut_profile_from_bit_vector)
+from dreem.aggregate.test_mutation_count import (make_partial_batches,
+                                                 write_batches, write_section)
+from dreem.util.seq import parse_fasta
+
+
+class TestAggregateSections(TestCase):
+    """ Test which sections aggregation profiles from each directory of bit
+    vectors. """
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.sequence = "ACGTACGTACGTACGTACGTACGTA"
+        self.fasta = os.path.join(self.top, "refs.fasta")
+        with open(self.fasta, "w") as f:
+            f.write(f">ref\n{self.sequence}\n")
+        # A full-length section and two shorter sections.
+        self.library = os.path.join(self.top, "library.csv")
+        pd.DataFrame({"construct": ["ref", "ref", "ref"],
+                      "section": ["full", "a", "b"],
+                      "section_start": [1, 6, 3],
+                      "section_end": [25, 18, 21]}).to_csv(self.library,
+                                                           index=False)
+        self.batches = make_partial_batches(len(self.sequence))
+        self.out_dir = os.path.join(self.top, "out")
+        os.makedirs(self.out_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def bit_vector(self, first: int, last: int):
+        """ Write the bit vectors of one region and return its directory. """
+        bv = os.path.join(self.top, "vectors", "ref", f"{first}-{last}")
+        os.makedirs(bv)
+        if (first, last) == (1, len(self.sequence)):
+            write_batches(bv, self.batches, self.sequence)
+        else:
+            write_section(bv, self.batches, self.sequence, first, last)
+        return bv
+
+    def aggregate(self, bv_files: list, **kwargs):
+        # The library checks expect the names from parse_fasta as bytes.
+        with (np.errstate(divide='ignore', invalid='ignore'),
+              mock.patch("dreem.aggregate.main.check_library",
+                         lambda library, fasta, out_dir: library),
+              mock.patch("dreem.aggregate.main.parse_fasta",
+                         lambda fasta: ((name.encode(), seq) for name, seq
+                                        in parse_fasta(fasta)))):
+            run(bv_files, library=self.library, fasta=self.fasta,
+                out_dir=self.out_dir, sample="sample", **kwargs)
+        with open(os.path.join(self.out_dir, "sample.json")) as f:
+            return json.load(f)["ref"]
+
+    def expect(self, first: int, last: int):
+        """ Profile the section as if it had been vectorized on its own. """
+        section = os.path.join(self.top, "expect")
+        os.makedirs(section)
+        write_section(section, self.batches, self.sequence, first, last)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            profile = generate_mut_profile_from_bit_vector(section, None)
+        shutil.rmtree(section)
+        return profile
+
+    def test_whole_ref(self):
+        # Every section is profiled from the vectors of the whole reference,
+        # including when the library has a full-length section.
+        out = self.aggregate([self.bit_vector(1, 25)])
+        self.assertEqual(out["num_aligned"], sum(map(len, self.batches)))
+        for section, first, last in [("a", 6, 18), ("b", 3, 21)]:
+            with self.subTest(section=section):
+                expect = self.expect(first, last)
+                pop_avg = out[section]["pop_avg"]
+                self.assertEqual(out[section]["sequence"], expect["sequence"])
+                self.assertEqual(pop_avg["num_aligned"],
+                                 expect["num_aligned"])
+                self.assertLessEqual(pop_avg["num_aligned"],
+                                     out["num_aligned"])
+                for key in ["cov_bases", "info_bases", "mut_bases"]:
+                    self.assertEqual(pop_avg[key], list(expect[key]))
+        self.assertEqual(out["full"]["sequence"], self.sequence)
+
+    def test_own_sections(self):
+        # A section that was vectorized on its own is profiled from its own
+        # vectors, not sliced from those of the whole reference.
+        own = self.bit_vector(3, 21)
+        out = self.aggregate([self.bit_vector(1, 25), own])
+        self.assertEqual(set(out) & {"full", "a", "b"}, {"full", "a", "b"})
+        self.assertEqual(out["b"]["pop_avg"]["cov_bases"],
+                         list(self.expect(3, 21)["cov_bases"]))
+        self.assertNotIn("num_aligned", out["b"]["pop_avg"])
+        # Vectors of a section are never sliced into the other sections.
+        shutil.rmtree(self.out_dir)
+        os.makedirs(self.out_dir)
+        out = self.aggregate([own])
+        self.assertEqual(set(out) & {"full", "a", "b"}, {"b"})
+
+    def test_co_mutations(self):
+        # Each section gets the co-mutations of its slice of the vectors.
+        self.aggregate([self.bit_vector(1, 25)], co_mutations=True)
+        expect = os.path.join(self.top, "expect")
+        os.makedirs(expect)
+        write_section(expect, self.batches, self.sequence, 6, 18)
+        for name, table in zip(["co_mut", "co_cov"], count_co_mutations(expect)):
+            with self.subTest(name=name):
+                out = pd.read_csv(os.path.join(self.out_dir, "co_mutations",
+                                               "sample", "ref", f"a_{name}.csv"),
+                                  index_col=0)
+                pd.testing.assert_frame_equal(out, table)
+
+
+if __name__ == "__main__":
+    unittest.main()
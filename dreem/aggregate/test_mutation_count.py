@@ -0,0 +1,210 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+import numpy as np
+import pandas as pd
+
+from dreem.aggregate.mutation_count import (CO_MUT_MAX_CHUNK, _chunk_reads,
+                                            count_co_mutations,
+                                            generate_mut_profile_from_bit_vector,
+                                            generate_mut_profile_from_counts)
+from dreem.util.util import DELET_INT, SUB_N, count_mut_bytes, query_muts
+from dreem.util.test_util import make_muts
+
+
+def write_batches(bit_vector: str, batches: list, sequence: str, first: int = 1):
+    """ Write each batch of mutation vectors and its byte counts as the
+    vectoring step does, numbering the positions from first. """
+    columns = [f"{base}{pos}" for pos, base in enumerate(sequence, start=first)]
+    for batch_num, muts in enumerate(batches):
+        pd.DataFrame(muts.view(np.byte), columns=columns).to_orc(
+            os.path.join(bit_vector, f"vectors_{batch_num}.orc"), engine="pyarrow")
+        np.savez_compressed(os.path.join(bit_vector, f"vectors_{batch_num}.counts.npz"),
+                            counts=count_mut_bytes(muts))
+
+
+def make_partial_batches(n_positions: int):
+    """ Return batches of random mutation vectors of reads that cover only
+    part of a reference, as in amplicons. """
+    batches = list()
+    for seed in range(3):
+        muts = make_muts(300, n_positions, seed)
+        for i, row in enumerate(muts):
+            row[: i % 20] = 0
+        batches.append(muts)
+    return batches
+
+
+def write_section(bit_vector: str, batches: list, sequence: str, first: int,
+                  last: int):
+    """ Write the batches of one section as if it had been vectorized on its
+    own: only its positions, and only the reads covering it. """
+    sections = [muts[:, first - 1: last] for muts in batches]
+    write_batches(bit_vector, [muts[np.count_nonzero(muts, axis=1) > 0]
+                               for muts in sections],
+                  sequence[first - 1: last], first)
+
+
+class TestSliceSections(TestCase):
+    """ Test profiling sections sliced from the bit vectors of a whole
+    reference as the bit vectors are read. """
+
+    def setUp(self):
+        self.whole = tempfile.mkdtemp()
+        self.section = tempfile.mkdtemp()
+        self.sequence = "ACGTACGTACGTACGTACGTACGTA"
+        self.batches = make_partial_batches(len(self.sequence))
+        write_batches(self.whole, self.batches, self.sequence)
+
+    def tearDown(self):
+        shutil.rmtree(self.whole)
+        shutil.rmtree(self.section)
+
+    def test_profile(self):
+        first, last = 6, 18
+        write_section(self.section, self.batches, self.sequence, first, last)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sliced = generate_mut_profile_from_bit_vector(self.whole, None,
+                                                          first=first,
+                                                          last=last)
+            expect = generate_mut_profile_from_bit_vector(self.section, None)
+        self.assertEqual(sliced["sequence"], self.sequence[first - 1: last])
+        self.assertLess(sliced["num_aligned"],
+                        sum(map(len, self.batches)))
+        self.assertEqual(set(sliced), set(expect))
+        for key, value in expect.items():
+            with self.subTest(key=key):
+                np.testing.assert_array_equal(sliced[key], value)
+
+    def test_co_mutations(self):
+        first, last = 3, 21
+        write_section(self.section, self.batches, self.sequence, first, last)
+        for sliced, expect in zip(count_co_mutations(self.whole, first=first,
+                                                     last=last),
+                                  count_co_mutations(self.section)):
+            pd.testing.assert_frame_equal(sliced, expect)
+
+
+class TestProfileFromCounts(TestCase):
+    """ Test building a mutation profile from the byte counts of batches. """
+
+    def setUp(self):
+        self.bit_vector = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.bit_vector)
+
+    def remove_counts(self):
+        for file in os.listdir(self.bit_vector):
+            if file.endswith(".counts.npz"):
+                os.remove(os.path.join(self.bit_vector, file))
+
+    def test_same_as_bit_vector(self):
+        write_batches(self.bit_vector, [make_muts(300, 25, seed)
+                                        for seed in range(3)],
+                      "ACGTACGTACGTACGTACGTACGTA")
+        from_counts = generate_mut_profile_from_counts(self.bit_vector)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            with_counts = generate_mut_profile_from_bit_vector(self.bit_vector, None)
+            # Without the counts, every field comes from the vectors.
+            self.remove_counts()
+            from_bv = generate_mut_profile_from_bit_vector(self.bit_vector, None)
+        # Every field except those that need the vectors themselves.
+        self.assertEqual(set(from_counts),
+                         set(from_bv) - {"sequence", "num_of_mutations"})
+        for key, value in from_counts.items():
+            with self.subTest(key=key):
+                np.testing.assert_array_equal(value, from_bv[key])
+        self.assertEqual(set(with_counts), set(from_bv))
+        for key, value in from_bv.items():
+            with self.subTest(key=key):
+                np.testing.assert_array_equal(with_counts[key], value)
+
+    def test_section(self):
+        sequence = "ACGTACGTACGTACGTACGTACGTA"
+        write_batches(self.bit_vector, make_partial_batches(len(sequence)),
+                      sequence)
+        first, last = 4, 15
+        from_counts = generate_mut_profile_from_counts(self.bit_vector,
+                                                       first, last)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.remove_counts()
+            from_bv = generate_mut_profile_from_bit_vector(self.bit_vector,
+                                                           None, first=first,
+                                                           last=last)
+        # The number of reads covering a section is not in its counts.
+        self.assertEqual(set(from_counts),
+                         set(from_bv) - {"sequence", "num_of_mutations",
+                                         "num_aligned"})
+        for key, value in from_counts.items():
+            with self.subTest(key=key):
+                np.testing.assert_array_equal(value, from_bv[key])
+        self.assertEqual(len(from_counts["cov_bases"]), last - first + 1)
+
+    def test_counts_mismatch(self):
+        write_batches(self.bit_vector, [make_muts(10, 5)], "ACGTA")
+        np.savez_compressed(os.path.join(self.bit_vector, "vectors_0.counts.npz"),
+                            counts=count_mut_bytes(make_muts(10, 4)))
+        with self.assertRaises(ValueError):
+            generate_mut_profile_from_counts(self.bit_vector)
+
+    def test_no_counts(self):
+        with self.assertRaises(FileNotFoundError):
+            generate_mut_profile_from_counts(self.bit_vector)
+
+
+class TestCountCoMutations(TestCase):
+    """ Test counting co-mutations and co-coverage over batches. """
+
+    def setUp(self):
+        self.bit_vector = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.bit_vector)
+
+    @mock.patch("dreem.aggregate.mutation_count.CO_MUT_BLOCK_BYTES", 4 * 10 * 512)
+    def test_same_as_product(self):
+        sequence = "ACGTACGTAC"
+        chunk = _chunk_reads(len(sequence))
+        self.assertEqual(chunk, 512)
+        # Batches smaller than, just larger than, and several times the size
+        # of one chunk, none of which fills its last packed byte.
+        batches = [make_muts(n_vectors, len(sequence), seed)
+                   for seed, n_vectors in enumerate([5, chunk + 3,
+                                                     2 * chunk + 101])]
+        write_batches(self.bit_vector, batches, sequence)
+        muts = np.vstack(batches)
+        cov = (muts != 0).astype(np.int64)
+        for bits, set_type in [(SUB_N[0], "subset"), (SUB_N[0], "superset"),
+                               (DELET_INT, "subset")]:
+            with self.subTest(bits=bits, set_type=set_type):
+                co_mut, co_cov = count_co_mutations(self.bit_vector, bits,
+                                                    set_type)
+                q = query_muts(muts, bits, sum_up=False,
+                               set_type=set_type).astype(np.int64)
+                np.testing.assert_array_equal(co_mut.values, q.T @ q)
+                np.testing.assert_array_equal(co_cov.values, cov.T @ cov)
+                self.assertEqual(list(co_mut.index), list(co_mut.columns))
+                self.assertEqual(list(co_cov.columns),
+                                 [f"{base}{pos}" for pos, base
+                                  in enumerate(sequence, start=1)])
+
+    def test_no_batches(self):
+        with self.assertRaises(FileNotFoundError):
+            count_co_mutations(self.bit_vector)
+
+    def test_chunk_reads(self):
+        # Blocks shrink as positions grow, but keep whole bytes and stay
+        # small enough for exact float32 counts.
+        self.assertEqual(_chunk_reads(1), CO_MUT_MAX_CHUNK)
+        self.assertEqual(_chunk_reads(0), CO_MUT_MAX_CHUNK)
+        with mock.patch("dreem.aggregate.mutation_count.CO_MUT_BLOCK_BYTES", 4 * 1000 * 100):
+            self.assertEqual(_chunk_reads(1000), 96)
+            self.assertEqual(_chunk_reads(10 ** 6), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
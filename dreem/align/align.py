@@ -1,56 +1,230 @@
+from functools import partial
 import itertools
 import logging
+import os
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
-from dreem.util.cli import DEFAULT_TRIM, DEFAULT_NEXTSEQ_TRIM
-from dreem.util.dflt import NUM_PROCESSES
+from dreem.util.cli import DEFAULT_TRIM, DEFAULT_NEXTSEQ_TRIM, DEFAULT_ALN_FORMAT, DEFAULT_COMPRESS_LEVEL, \
+    DEFAULT_SAMTOOLS_THREADS, DEFAULT_INDEX_CACHE, INDEX_CACHE_DIR, DEFAULT_MAX_CPUS, \
+    DEFAULT_STREAM, DEFAULT_BT2_MM, DEFAULT_SHARDS, DEFAULT_SCRATCH_DIR, DEFAULT_KEEP_TEMP, \
+    DEFAULT_MAX_MEM
 from dreem.util.seq import FastaParser, FastaWriter
 from dreem.util.reads import FastqAligner, FastqTrimmer, get_demultiplexed_fastq_pairs, FastqUnit, BamAlignSorter, \
-    SamRemoveEqualMappers, BamSplitter
+    SamRemoveEqualMappers, BamSplitter, XamCompression, Bowtie2IndexCache, align_stream, FastqSharder, GZ_EXT
+from dreem.util.excmd import CmdExecutor
+from dreem.util.governor import configure, get_governor, set_governor
 from dreem.util.stargs import starstarmap
 from dreem.util import path
 from dreem.util.seq import DNA
 
 
+# Estimated sizes of temporary files relative to the uncompressed FASTQ
+# file(s), used to check for free scratch space before each step.
+GZ_RATIO = 4.0  # gzip shrinks FASTQ about four-fold
+SAM_RATIO = 2.0  # SAM adds the alignment fields to every read
+BAM_RATIO = 0.5  # sorted BAM, plus the temporary files of samtools sort
+
+
+def _fastq_bytes(fastq: FastqUnit):
+    """ Estimate the size of the reads in fastq once uncompressed. """
+    return sum(int(os.path.getsize(fq.path)
+                   * (GZ_RATIO if str(fq).endswith(GZ_EXT) else 1.0))
+               for fq in fastq.paths)
+
+
+def _align_steps(top_dir: path.TopDirPath,
+                 fasta: path.RefsetSeqInFilePath | path.OneRefSeqTempFilePath,
+                 fastq: FastqUnit,
+                 index_cache: Bowtie2IndexCache,
+                 ext: str,
+                 compression: XamCompression,
+                 executor: CmdExecutor):
+    """ Return the steps that trim, align, remove equal mappers, and sort
+    the reads in fastq. """
+    # Each step takes the output of the previous step as its input, which
+    # determines the paths of its own outputs; those paths can be parsed
+    # only once the directory of the previous step exists.
+    trimmer = FastqTrimmer(top_dir, fastq, executor)
+    trimmer.setup()
+    aligner = FastqAligner(top_dir, trimmer.output, fasta, index_cache,
+                           executor)
+    aligner.setup()
+    remover = SamRemoveEqualMappers(top_dir, aligner.output,
+                                    executor=executor)
+    remover.setup()
+    sorter = BamAlignSorter(top_dir, remover.output, ext=ext, ref_fasta=fasta,
+                            compression=compression, executor=executor)
+    return trimmer, aligner, remover, sorter
+
+
+def _align_mem(aligner: FastqAligner):
+    """ Estimate the memory that aligning needs: Bowtie 2 loads its whole
+    index (0 if the index is not cached, so its size is not known). """
+    if aligner.index_cache is None:
+        return 0
+    return Bowtie2IndexCache.index_size(
+        aligner.index_cache.get_prefix(aligner.fasta.path))
+
+
+def _sort_aligned(trimmer: FastqTrimmer,
+                  aligner: FastqAligner,
+                  remover: SamRemoveEqualMappers,
+                  sorter: BamAlignSorter,
+                  scratch: path.Scratch,
+                  nextseq_trim: bool = DEFAULT_NEXTSEQ_TRIM,
+                  threads: int = DEFAULT_MAX_CPUS,
+                  stream: bool = DEFAULT_STREAM,
+                  bt2_mm: bool = DEFAULT_BT2_MM):
+    """ Run the steps from _align_steps and return the sorted output,
+    once the cores and memory are free, checking for scratch space before
+    each step. """
+    # Wait for the cores of every command that may run at once, and for
+    # memory to load the index, before starting.
+    with get_governor().reserve(threads + sorter.compression.threads,
+                                _align_mem(aligner)):
+        fq_bytes = _fastq_bytes(trimmer.fastq)
+        if stream:
+            # Trim, align, remove equal mappers, and sort through OS pipes.
+            with scratch.step(sorter, fq_bytes * BAM_RATIO):
+                return align_stream(trimmer, aligner, remover, sorter, threads,
+                                    mm=bt2_mm, nextseq_trim=nextseq_trim)
+        # Trim the FASTQ file(s).
+        with scratch.step(trimmer, fq_bytes):
+            trimmer.run(nextseq_trim=nextseq_trim, cores=threads)
+        # Align the FASTQ to the reference.
+        with scratch.step(aligner, fq_bytes * SAM_RATIO):
+            aligner.run(threads=threads, mm=bt2_mm)
+        scratch.clean(trimmer)
+        # Remove equally mapping reads.
+        with scratch.step(remover, fq_bytes * SAM_RATIO):
+            remover.run(processes=threads)
+        scratch.clean(aligner)
+        # Sort the SAM file and output a BAM (or CRAM) file.
+        with scratch.step(sorter, fq_bytes * BAM_RATIO):
+            xam_path = sorter.run()
+        scratch.clean(remover)
+        return xam_path
+
+
+def _sort_shards(top_dir: path.TopDirPath,
+                 fasta: path.RefsetSeqInFilePath | path.OneRefSeqTempFilePath,
+                 fastq: FastqUnit,
+                 shards: int,
+                 index_cache: Bowtie2IndexCache,
+                 sorter: BamAlignSorter,
+                 executor: CmdExecutor,
+                 scratch: path.Scratch,
+                 threads: int = DEFAULT_MAX_CPUS,
+                 **kwargs):
+    """
+    Split the reads in fastq into shards, trim, align, remove equal mappers,
+    and sort each shard concurrently, and merge the sorted shards into the
+    output of sorter. The mates of every pair stay in one shard, and every
+    step handles each read (or pair) independently, so the merged file has
+    the same records as sorting the reads without sharding.
+    """
+    sharder = FastqSharder(top_dir, fastq, shards, executor=executor)
+    fq_bytes = _fastq_bytes(fastq)
+    with get_governor().reserve(), scratch.step(sharder, fq_bytes):
+        shard_fastqs = sharder.run()
+    # Build the index once before the shards would all wait for it.
+    index_cache.get_prefix(fasta.path)
+    shard_steps = [_align_steps(shard_top, fasta, shard_fastq, index_cache,
+                                path.BAM_EXT, sorter.compression, executor)
+                   for shard_top, shard_fastq in zip(sharder.shard_tops,
+                                                     shard_fastqs,
+                                                     strict=True)]
+    n_procs, shard_threads = _split_cpus(len(shard_steps), threads,
+                                         sorter.compression.threads)
+    try:
+        # Threads suffice because the work is done by external commands;
+        # processes could not be started inside workers of each_ref.
+        with ThreadPool(n_procs) as pool:
+            shard_xams = pool.starmap(partial(_sort_aligned,
+                                              scratch=scratch,
+                                              threads=shard_threads,
+                                              **kwargs),
+                                      shard_steps)
+        with get_governor().reserve(1 + sorter.compression.threads):
+            with scratch.step(sorter, fq_bytes * BAM_RATIO):
+                xam_path = sorter.merge(shard_xams)
+    finally:
+        # Delete the shards and all files derived from them.
+        scratch.clean(sharder)
+    return xam_path
+
+
 def _align(top_dir: path.TopDirPath,
            fasta: path.RefsetSeqInFilePath | path.OneRefSeqTempFilePath,
            fastq: FastqUnit,
-           nextseq_trim: bool = DEFAULT_NEXTSEQ_TRIM):
-    # Trim the FASTQ file(s).
-    trimmer = FastqTrimmer(top_dir, fastq)
-    fastq = trimmer.run(nextseq_trim=nextseq_trim)
-    # Align the FASTQ to the reference.
-    aligner = FastqAligner(top_dir, fastq, fasta)
-    xam_path = aligner.run()
-    trimmer.clean()
-    # Remove equally mapping reads.
-    remover = SamRemoveEqualMappers(top_dir, xam_path)
-    xam_path = remover.run()
-    aligner.clean()
-    # Sort the SAM file and output a BAM file.
-    sorter = BamAlignSorter(top_dir, xam_path)
-    xam_path = sorter.run()
-    remover.clean()
+           nextseq_trim: bool = DEFAULT_NEXTSEQ_TRIM,
+           aln_format: str = DEFAULT_ALN_FORMAT,
+           compress_level: int = DEFAULT_COMPRESS_LEVEL,
+           samtools_threads: int = DEFAULT_SAMTOOLS_THREADS,
+           index_cache: str = DEFAULT_INDEX_CACHE,
+           threads: int = DEFAULT_MAX_CPUS,
+           stream: bool = DEFAULT_STREAM,
+           bt2_mm: bool = DEFAULT_BT2_MM,
+           shards: int = DEFAULT_SHARDS,
+           scratch_dir: str = DEFAULT_SCRATCH_DIR,
+           keep_temp: bool = DEFAULT_KEEP_TEMP):
+    # Sorted and split alignments are written as BAM or as CRAM, which is
+    # compressed against the reference.
+    ext = path.CRAM_EXT if aln_format.lower() == "cram" else path.BAM_EXT
+    compression = XamCompression(compress_level, samtools_threads)
+    # Every external command runs through one executor, which logs its
+    # standard error and measures the resources it uses.
+    executor = CmdExecutor()
+    # Indexes are cached by the checksum of the FASTA file, so a reference
+    # is indexed once for all samples, even if its FASTA file is temporary.
+    index_cache = Bowtie2IndexCache(index_cache if index_cache
+                                    else os.path.join(top_dir.top,
+                                                      INDEX_CACHE_DIR),
+                                    executor=executor)
+    # Temporary files go in the scratch space, outputs in top_dir.
+    scratch = path.Scratch(scratch_dir, keep_temp)
+    temp_dir = scratch.top_dir(top_dir)
+    steps = _align_steps(temp_dir, fasta, fastq, index_cache, ext,
+                         compression, executor)
+    sorter = steps[-1]
+    align_kwargs = dict(nextseq_trim=nextseq_trim, stream=stream,
+                        bt2_mm=bt2_mm)
+    if shards > 1:
+        xam_path = _sort_shards(temp_dir, fasta, fastq, shards, index_cache,
+                                sorter, executor, scratch, threads,
+                                **align_kwargs)
+    else:
+        xam_path = _sort_aligned(*steps, scratch, threads=threads,
+                                 **align_kwargs)
     # Split the BAM file into one file for each reference.
-    splitter = BamSplitter(top_dir, xam_path, fasta)
-    bams = splitter.run()
-    sorter.clean()
+    splitter = BamSplitter(top_dir, xam_path, fasta, ext=ext,
+                           compression=compression, executor=executor)
+    with get_governor().reserve(1 + compression.threads):
+        bams = splitter.run()
+    scratch.clean(sorter)
+    for result in executor.results:
+        logging.info(str(result))
     return bams
 
 
 def all_refs(top_dir: str, fasta: str,
              fastqs: str, fastqi: str, fastq1: str, fastq2: str,
-             phred_enc: int = 33, **kwargs):
+             phred_enc: int = 33, max_cpus: int = DEFAULT_MAX_CPUS,
+             max_mem: float = DEFAULT_MAX_MEM, **kwargs):
+    configure(max_cpus, max_mem)
     fqs = path.SampleReadsInFilePath.parse_path(fastqs) if fastqs else None
     fqi = path.SampleReadsInFilePath.parse_path(fastqi) if fastqi else None
     fq1 = path.SampleReads1InFilePath.parse_path(fastq1) if fastq1 else None
     fq2 = path.SampleReads2InFilePath.parse_path(fastq2) if fastq2 else None
+    _, threads = _split_cpus(1, max_cpus, kwargs.get(
+        "samtools_threads", DEFAULT_SAMTOOLS_THREADS))
     return _align(path.TopDirPath.parse_path(top_dir),
                   path.RefsetSeqInFilePath.parse_path(fasta),
                   FastqUnit.wrap(fastqs=fqs, fastqi=fqi,
                                  fastq1=fq1, fastq2=fq2,
                                  phred_enc=phred_enc),
-                  **kwargs)
+                  threads=threads, **kwargs)
 
 
 def _get_fq_inputs(fastqs_dir: str, fastqi_dir: str, fastq12_dir: str):
@@ -75,9 +249,12 @@ def _get_fq_inputs(fastqs_dir: str, fastqi_dir: str, fastq12_dir: str):
     return fq_inputs
 
 
-def _one_ref(top_dir: str, ref: str, seq: DNA, fq_unit: FastqUnit, **kwargs):
-    # Write a temporary FASTA file for the reference.
-    fasta = path.OneRefSeqTempFilePath(top=top_dir,
+def _one_ref(top_dir: str, ref: str, seq: DNA, fq_unit: FastqUnit,
+             scratch_dir: str = DEFAULT_SCRATCH_DIR, **kwargs):
+    # Write a temporary FASTA file for the reference in the scratch space.
+    out_dir = path.TopDirPath.parse_path(top_dir)
+    temp_dir = path.Scratch(scratch_dir).top_dir(out_dir)
+    fasta = path.OneRefSeqTempFilePath(top=temp_dir.top,
                                        partition=path.TEMP_DIR,
                                        module=path.MOD_ALN,
                                        step=path.ALN_ALIGN,
@@ -86,8 +263,8 @@ def _one_ref(top_dir: str, ref: str, seq: DNA, fq_unit: FastqUnit, **kwargs):
     fasta.path.parent.mkdir(parents=True, exist_ok=True)
     try:
         FastaWriter(fasta.path, {ref: seq}).write()
-        bams = _align(path.TopDirPath.parse_path(top_dir),
-                      fasta, fq_unit, **kwargs)
+        bams = _align(out_dir, fasta, fq_unit, scratch_dir=scratch_dir,
+                      **kwargs)
         if len(bams) != 1:
             raise ValueError(f"Expected 1 BAM file, got {len(bams)}")
         return bams[0]
@@ -95,11 +272,23 @@ def _one_ref(top_dir: str, ref: str, seq: DNA, fq_unit: FastqUnit, **kwargs):
         fasta.path.unlink(missing_ok=True)
 
 
+def _split_cpus(n_tasks: int, max_cpus: int, samtools_threads: int = 0):
+    """ Split a budget of CPU cores between tasks that run at once: return
+    the number of tasks to run at once and the threads each may use. Each
+    task may also run samtools with samtools_threads additional threads at
+    the same time, which count towards the budget, so that the tasks use
+    at most max_cpus cores in total (or one thread each, if fewer). """
+    n_procs = max(1, min(n_tasks, max_cpus // (1 + samtools_threads)))
+    return n_procs, max(1, max_cpus // n_procs - samtools_threads)
+
+
 def each_ref(top_dir: str, refs_file: str,
-             fastqs_dir: str, fastqi_dir: str, fastq12_dir: str, **kwargs):
+             fastqs_dir: str, fastqi_dir: str, fastq12_dir: str,
+             max_cpus: int = DEFAULT_MAX_CPUS,
+             max_mem: float = DEFAULT_MAX_MEM, **kwargs):
+    governor = configure(max_cpus, max_mem)
     fq_inputs = _get_fq_inputs(fastqs_dir, fastqi_dir, fastq12_dir)
     align_args = list()
-    align_kwargs = list()
     for ref, seq in FastaParser(refs_file).parse():
         try:
             fq_unit = fq_inputs[ref]
@@ -107,10 +296,22 @@ def each_ref(top_dir: str, refs_file: str,
             logging.warning(f"No FASTQ files for reference '{ref}'")
         else:
             align_args.append((top_dir, ref, seq, fq_unit))
-            align_kwargs.append(kwargs)
     if align_args:
-        n_procs = min(len(align_args), NUM_PROCESSES)
-        with Pool(n_procs) as pool:
+        # Align the references concurrently, giving the processes of each
+        # an equal share of the cores and memory, so that all of them
+        # together use no more than max_cpus and max_mem.
+        n_procs, threads = _split_cpus(len(align_args), max_cpus,
+                                       kwargs.get("samtools_threads",
+                                                  DEFAULT_SAMTOOLS_THREADS))
+        align_kwargs = [{**kwargs, "threads": threads}] * len(align_args)
+        if n_procs > 1:
+            with Pool(n_procs, set_governor,
+                      (governor.share(n_procs),)) as pool:
+                # Pass one reference at a time so that references that take
+                # longer do not hold up those queued behind them.
+                bams = list(starstarmap(partial(pool.starmap, chunksize=1),
+                                        _one_ref, align_args, align_kwargs))
+        else:
             bams = list(starstarmap(itertools.starmap, _one_ref,
                                     align_args, align_kwargs))
     else:
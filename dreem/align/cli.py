@@ -1,6 +1,8 @@
 import click
 from dreem.align.main import run
-from dreem.util.cli import argi_fasta, opti_fastqs, opti_fastqi, opti_fastq1, opti_fastq2, opti_fastqs_dir, opti_fastqi_dir, opti_fastq12_dir, opto_top_dir
+from dreem.util.cli import argi_fasta, opti_fastqs, opti_fastqi, opti_fastq1, opti_fastq2, opti_fastqs_dir, opti_fastqi_dir, opti_fastq12_dir, opto_top_dir, \
+    opti_aln_format, opti_compress_level, opti_samtools_threads, opti_index_cache, opti_max_cpus, opti_max_mem, opti_stream, \
+    opti_bt2_mm, opti_shards, opti_scratch_dir, opti_keep_temp
 
 
 @click.command()
@@ -12,6 +14,17 @@ from dreem.util.cli import argi_fasta, opti_fastqs, opti_fastqi, opti_fastq1, op
 @opti_fastqs_dir
 @opti_fastqi_dir
 @opti_fastq12_dir
+@opti_aln_format
+@opti_compress_level
+@opti_samtools_threads
+@opti_index_cache
+@opti_max_cpus
+@opti_max_mem
+@opti_stream
+@opti_bt2_mm
+@opti_shards
+@opti_scratch_dir
+@opti_keep_temp
 @opto_top_dir
 def cli(*args, **kwargs):
     run(*args, **kwargs)
@@ -10,7 +10,8 @@ def run(top_dir: str, fasta: str,
     Run the alignment module.
 
     Align the reads to the set of reference sequences and output one BAM file
-    for each sample aligned to each reference in the directory 'output'.
+    (or CRAM file, if aln_format='cram') for each sample aligned to each
+    reference in the directory 'output'.
     Temporary intermediary files are written in the directory 'temp' and then
     deleted after they are no longer needed.
 
@@ -61,7 +62,24 @@ def run(top_dir: str, fasta: str,
         Path to a directory containing, for each  FASTQ files of both the 1st and 2nd
         mates of paired-end reads, or '' if none.
     **kwargs
-        Additional keyword arguments to pass to the alignment function.
+        Additional keyword arguments to pass to the alignment function,
+        e.g. aln_format ('bam' or 'cram'), compress_level (0-9, or -1 for
+        the samtools default), samtools_threads, and index_cache (directory
+        of Bowtie 2 indexes, reused for every FASTA file with the same
+        contents; '' for {top_dir}/index), and max_cpus (total number of
+        cores for all concurrent alignments: demultiplexed references are
+        aligned in parallel, each with an equal share of the cores), and
+        max_mem (total GiB of memory for all concurrent alignments, 0 for no
+        limit; alignments also wait while the system is low on memory), and
+        stream (trim, align, filter, and sort through OS pipes, writing no
+        intermediate FASTQ or SAM file; False runs each step separately),
+        and bt2_mm (memory-map the Bowtie 2 index so that alignments running
+        at once with the same cached index share one copy of it in RAM),
+        and shards (split each FASTQ into this many shards, keeping mates
+        together, align them in parallel, and merge the sorted shards), and
+        scratch_dir (directory for temporary files, e.g. a local disk; free
+        space is checked before each step; '' for {top_dir}/temp), and
+        keep_temp (keep temporary files instead of deleting them).
 
     NOTES
     † The file name (minus the extension) will be used as the sample name.
@@ -0,0 +1,117 @@
+import itertools
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import TestCase
+
+from dreem.align.align import _align, _split_cpus
+from dreem.util import path
+from dreem.util.excmd import (BOWTIE2_BUILD_CMD, BOWTIE2_CMD, CUTADAPT_CMD,
+                              SAMTOOLS_CMD)
+from dreem.util.reads import FastqUnit
+from dreem.util.seq import DNA
+
+
+class TestSplitCpus(TestCase):
+    """ Test splitting a budget of CPU cores between alignments. """
+
+    def test_examples(self):
+        self.assertEqual(_split_cpus(4, 8), (4, 2))
+        self.assertEqual(_split_cpus(4, 8, 1), (4, 1))
+        self.assertEqual(_split_cpus(1, 8, 2), (1, 6))
+        self.assertEqual(_split_cpus(10, 8, 3), (2, 1))
+
+    def test_within_budget(self):
+        for n_tasks, max_cpus, samtools_threads in itertools.product(
+                range(1, 10), range(1, 17), range(0, 5)):
+            with self.subTest(n_tasks=n_tasks, max_cpus=max_cpus,
+                              samtools_threads=samtools_threads):
+                n_procs, threads = _split_cpus(n_tasks, max_cpus,
+                                               samtools_threads)
+                self.assertGreaterEqual(n_procs, 1)
+                self.assertLessEqual(n_procs, n_tasks)
+                self.assertGreaterEqual(threads, 1)
+                if max_cpus >= 1 + samtools_threads:
+                    # Samtools threads count towards the budget.
+                    self.assertLessEqual(n_procs * (threads
+                                                    + samtools_threads),
+                                         max_cpus)
+                else:
+                    # The budget cannot run even one task in full.
+                    self.assertEqual((n_procs, threads), (1, 1))
+
+
+@unittest.skipUnless(all(map(shutil.which, [CUTADAPT_CMD, BOWTIE2_CMD,
+                                            BOWTIE2_BUILD_CMD, SAMTOOLS_CMD])),
+                     "cutadapt, bowtie2, or samtools is not installed")
+class TestAlignStream(TestCase):
+    """ Test that aligning through pipes gives the same BAM files as
+    aligning step by step. """
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        rng = random.Random(0)
+        self.refs = {f"ref{i}": "".join(rng.choices("ACGT", k=200))
+                     for i in range(3)}
+        self.fasta = path.RefsetSeqInFilePath(top=self.top, refset="refs",
+                                              ext=path.FASTA_EXTS[0])
+        with open(self.fasta.path, "w") as f:
+            f.writelines(f">{ref}\n{seq}\n" for ref, seq in self.refs.items())
+        fq1 = path.SampleReads1InFilePath(top=self.top, sample="sample",
+                                          ext="_R1.fq")
+        fq2 = path.SampleReads2InFilePath(top=self.top, sample="sample",
+                                          ext="_R2.fq")
+        with open(fq1.path, "w") as f1, open(fq2.path, "w") as f2:
+            for i in range(300):
+                seq = rng.choice(list(self.refs.values()))
+                start = rng.randrange(len(seq) - 120)
+                frag = seq[start: start + 120]
+                rev = DNA(frag[-50:].encode()).rc.decode()
+                f1.write(f"@read{i}/1\n{frag[:50]}\n+\n{'I' * 50}\n")
+                f2.write(f"@read{i}/2\n{rev}\n+\n{'I' * 50}\n")
+        self.fastq = FastqUnit((fq1, fq2), False, 33)
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def align(self, stream: bool):
+        """ Align the reads and return the BAM file of each reference. """
+        top = os.path.join(self.top, f"stream-{stream}")
+        os.makedirs(top)
+        bams = _align(path.TopDirPath(top=top), self.fasta, self.fastq,
+                      index_cache=os.path.join(self.top, "index"), threads=2,
+                      stream=stream)
+        # No intermediate SAM (nor trimmed FASTQ) is left behind.
+        for _, _, filenames in os.walk(top):
+            for filename in filenames:
+                self.assertFalse(filename.endswith(path.SAM_EXT), filename)
+                self.assertFalse(filename.endswith(path.FQ_EXTS), filename)
+        return bams
+
+    @staticmethod
+    def view(*args):
+        # Omit the @PG lines, which record the commands that were run.
+        return [line for line in subprocess.run(
+            [SAMTOOLS_CMD, "view", "-h", *map(str, args)],
+            check=True, capture_output=True).stdout.splitlines(keepends=True)
+            if not line.startswith(b"@PG")]
+
+    def test_same_as_steps(self):
+        staged = self.align(stream=False)
+        streamed = self.align(stream=True)
+        self.assertEqual(len(streamed), len(self.refs))
+        for staged_bam, streamed_bam in zip(staged, streamed, strict=True):
+            with self.subTest(bam=streamed_bam):
+                self.assertEqual(streamed_bam.path.name,
+                                 staged_bam.path.name)
+                lines = self.view(streamed_bam.path)
+                self.assertEqual(lines, self.view(staged_bam.path))
+                self.assertTrue(any(not line.startswith(b"@")
+                                    for line in lines))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,19 +1,24 @@
 
+import os
+
 import numpy as np
 import pyarrow as pa
 import pyarrow.orc as po
 import pyarrow.compute as pc
 
+from dreem.util.path import READ_NAMES_EXT
 from dreem.util.util import *
 
 class BitVector:
     """Container object. Contains the name of the construct, the sequence, the bitvector, the read names and the read count.
     """
     
-    def __init__(self,path, **args) -> None:
-        preprocessing = self.preprocessing(path)
+    def __init__(self,path, first=None, last=None, **args) -> None:
+        preprocessing = self.preprocessing(path, first=first, last=last)
 
         self.name = path.split('/')[-1][:-(len('.orc'))]
+        if first is not None or last is not None:
+            self.name += '_{}-{}'.format(first, last)
         self.sequence = preprocessing[0]
         self.bv = preprocessing[1]
         self.read_index = preprocessing[2]
@@ -22,10 +27,10 @@ class BitVector:
         self.read_names = preprocessing[5]
         self.report = preprocessing[6]
         self.base_to_keep = preprocessing[7]
-        self.publish_preprocessing_report(path=path[:-len('.orc')]+'_preprocessing_report.txt')
+        self.publish_preprocessing_report(path=os.path.join(os.path.dirname(path), self.name+'_preprocessing_report.txt'))
         
     #TODO optimize this 
-    def preprocessing(self, path, low_mut_rate = 0.015, use_G_U = False, max_mut_close_by = 4):
+    def preprocessing(self, path, low_mut_rate = 0.015, use_G_U = False, max_mut_close_by = 4, first = None, last = None):
         """Preprocess the bitvector.
         
         - Remove the bases G and U
@@ -45,6 +50,10 @@ class BitVector:
         use_G_U: bool
             If True, keep the bases G and U.
             
+        first, last: int
+            If given, use only this section (1-indexed, inclusive) of the bitvector, e.g. of the bitvector of a whole
+            reference, and only the reads that cover it (see read_section).
+            
             
         Output:
         -------
@@ -66,12 +75,22 @@ class BitVector:
         
         report = {}
         
-        bv = po.read_table(path)
+        bv, kept = read_section(path, first, last)
         report['total_number_of_reads'] = bv.shape[0]     
         
-        # Take the read names
-        read_names = np.array(bv.column('id'), dtype = str)
-        bv = bv.drop(['id'])   
+        # Take the read names: from the column 'id' if the bit vector has one, otherwise from the names that vectoring
+        # stored next to the bit vector, otherwise number the reads; keep only the names of the reads in the section
+        names_file = path[:-len('.orc')] + READ_NAMES_EXT
+        if 'id' in bv.column_names:
+            read_names = np.array(bv.column('id'), dtype = str)
+            bv = bv.drop(['id'])
+        else:
+            if os.path.isfile(names_file):
+                read_names = np.array(load_read_names(names_file), dtype = str)
+            else:
+                read_names = np.arange(bv.shape[0] if kept is None else len(kept)).astype(str)
+            if kept is not None:
+                read_names = read_names[kept]
         
         ## PER BASE REMOVALS
         # Remove the non-informative bases types
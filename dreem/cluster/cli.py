@@ -27,6 +27,8 @@ from dreem.util.cli import *
 @convergence_cutoff
 @num_runs
 @n_cpus
+@opti_max_cpus
+@opti_max_mem
 
 @optgroup.group('Miscellaneous')
 @verbose
@@ -4,6 +4,8 @@ from bitvector import BitVector
 import numpy as np
 import multiprocessing
 
+from dreem.util.governor import get_governor
+
 class ClusteringAnalysis:
     """Launches the clustering algorithm many times to iterate over K_max the number of clusters and N_runs the number of runs.
     
@@ -71,10 +73,12 @@ class ClusteringAnalysis:
             em = EMclustering(self.bitvector.bv, k, self.bitvector.read_hist, self.bitvector.base_to_keep, self.bitvector.sequence,
                                 **self.clustering_args)
 
-            pool = multiprocessing.Pool(processes=self.clustering_args["n_cpus"])
-            results['K'+str(k)] = sorted(pool.starmap(em.run, [() for _ in range(self.N_runs)]), key=lambda res: res['log_likelihood'], reverse=True)
-            pool.close()
-            pool.join()
+            # Reserve the cores of the pool from the resource governor.
+            with get_governor().reserve(self.clustering_args["n_cpus"]) as n_procs:
+                pool = multiprocessing.Pool(processes=n_procs)
+                results['K'+str(k)] = sorted(pool.starmap(em.run, [() for _ in range(self.N_runs)]), key=lambda res: res['log_likelihood'], reverse=True)
+                pool.close()
+                pool.join()
         
         return results
         
@@ -6,15 +6,17 @@ import os, sys
 import pandas as pd
 import json
 from dreem.util import util as util
+from dreem.util.seq import parse_fasta
 sys.path.append(os.path.join(os.path.dirname(__file__)))
 from bitvector import BitVector
 from clusteringAnalysis import ClusteringAnalysis
 from EMclustering import EMclustering
-from dreem.util.cli import FASTA, INPUT_DIR, TOP_DIR, MAX_CLUSTERS, MIN_ITER, SIGNAL_THRESH, INFO_THRESH, INCLUDE_G_U, INCLUDE_DEL, MIN_READS, CONVERGENCE_CUTOFF, NUM_RUNS, COORDS, PRIMERS, FILL, N_CPUS, VERBOSE
+from dreem.util.cli import FASTA, INPUT_DIR, TOP_DIR, MAX_CLUSTERS, MIN_ITER, SIGNAL_THRESH, INFO_THRESH, INCLUDE_G_U, INCLUDE_DEL, MIN_READS, CONVERGENCE_CUTOFF, NUM_RUNS, COORDS, PRIMERS, FILL, N_CPUS, VERBOSE, DEFAULT_MAX_CPUS, DEFAULT_MAX_MEM
+from dreem.util.governor import configure
 
 
 
-def run(input_dir:str=INPUT_DIR, out_dir:str=TOP_DIR, max_clusters:int=MAX_CLUSTERS, min_iter:int=MIN_ITER, signal_thresh:float=SIGNAL_THRESH, info_thresh:float=INFO_THRESH, include_g_u:bool=INCLUDE_G_U, include_del:bool=INCLUDE_DEL, min_reads:int=MIN_READS, convergence_cutoff:float=CONVERGENCE_CUTOFF, num_runs:int=NUM_RUNS, n_cpus:int=N_CPUS, verbose:bool=VERBOSE):
+def run(input_dir:str=INPUT_DIR, out_dir:str=TOP_DIR, max_clusters:int=MAX_CLUSTERS, min_iter:int=MIN_ITER, signal_thresh:float=SIGNAL_THRESH, info_thresh:float=INFO_THRESH, include_g_u:bool=INCLUDE_G_U, include_del:bool=INCLUDE_DEL, min_reads:int=MIN_READS, convergence_cutoff:float=CONVERGENCE_CUTOFF, num_runs:int=NUM_RUNS, n_cpus:int=N_CPUS, verbose:bool=VERBOSE, fasta:str=FASTA, coords:list=COORDS, max_cpus:int=DEFAULT_MAX_CPUS, max_mem:float=DEFAULT_MAX_MEM):
     """Run the clustering module.
 
     Clusters the reads of all given bitvectors and outputs the likelihoods of the clusters as `name`.json in the directory `output_path`, using `temp_path` as a temp directory.
@@ -47,9 +49,19 @@ def run(input_dir:str=INPUT_DIR, out_dir:str=TOP_DIR, max_clusters:int=MAX_CLUST
     num_runs: int
         Number of runs
     n_cpus: int
-        Number of cpus
+        Number of cpus for the runs of EM clustering, reserved from a budget of max_cpus cores
     verbose: bool
         Verbose
+    fasta: str
+        Path to the fasta file of the references.
+    coords: list
+        Sections to cluster, as (reference, first, last). The bit vectors of a whole reference (vectorized with
+        --whole-refs, so that their region spans the reference in the fasta file) are sliced into each of its sections
+        that has no bit vectors of its own when they are read; bit vectors of any other region are clustered as they are.
+    max_cpus: int
+        Total number of CPU cores that clustering may use at once.
+    max_mem: float
+        Total memory (GiB) that clustering may use at once (0 for no limit besides the available memory).
         
     Returns
     -------
@@ -68,6 +80,8 @@ def run(input_dir:str=INPUT_DIR, out_dir:str=TOP_DIR, max_clusters:int=MAX_CLUST
     
     """
 
+    configure(max_cpus, max_mem)
+
     # Create the output folder
     os.makedirs(out_dir, exist_ok=True)
     os.makedirs(os.path.join(out_dir, 'temp'), exist_ok=True)
@@ -98,20 +112,33 @@ def run(input_dir:str=INPUT_DIR, out_dir:str=TOP_DIR, max_clusters:int=MAX_CLUST
     files_in = []
     for in_dir in input_dir:
         files_in += util.get_files(in_dir, '.orc')
+    # Lengths of the references, to find the bit vectors that span a whole reference
+    ref_lengths = {name: len(seq) for name, seq in parse_fasta(fasta)} if fasta else {}
     for i, f_in in enumerate(files_in):
-        section = f_in.split('/')[-2]
-        print("\n\nSTARTING SAMPLE", i, '|', section)
-        bitvector = BitVector(path=f_in)
-        bitvector.publish_preprocessing_report(path=os.path.join(out_dir,section+'_preprocessing_report.txt'))
-        ca = ClusteringAnalysis(bitvector, max_clusters, num_runs, clustering_args)
-        clusters = ca.run()
-        reads_best_cluster = {}
-        for k in clusters:
-            em = EMclustering(bitvector.bv, int(k[1]), bitvector.read_hist, bitvector.base_to_keep, bitvector.sequence, **clustering_args)
-            likelihood_reads_best_cluster, _, _ = em.expectation(clusters[k][0]['mu'], clusters[k][0]['pi'])
-            reads_best_cluster[k] = bitvector.associate_reads_with_likelihoods(likelihood_reads_best_cluster)
-            
-        best_clusters_samples[section] = reads_best_cluster
+        region = f_in.split('/')[-2]
+        ref = f_in.split('/')[-3]
+        sections = [(None, None)]
+        if ref in ref_lengths and region == '1-{}'.format(ref_lengths[ref]):
+            # Slice the sections that were not vectorized on their own
+            ref_coords = [(first, last) for ref_name, first, last in coords if ref_name == ref]
+            sliced = [(first, last) for first, last in ref_coords if (first, last) != (1, ref_lengths[ref])
+                      and not os.path.isdir(os.path.join(os.path.dirname(os.path.dirname(f_in)), '{}-{}'.format(first, last)))]
+            if sliced:
+                sections = sliced + ([(None, None)] if (1, ref_lengths[ref]) in ref_coords else [])
+        for first, last in sections:
+            section = region if first is None else '{}-{}'.format(first, last)
+            print("\n\nSTARTING SAMPLE", i, '|', section)
+            bitvector = BitVector(path=f_in, first=first, last=last)
+            bitvector.publish_preprocessing_report(path=os.path.join(out_dir,section+'_preprocessing_report.txt'))
+            ca = ClusteringAnalysis(bitvector, max_clusters, num_runs, clustering_args)
+            clusters = ca.run()
+            reads_best_cluster = {}
+            for k in clusters:
+                em = EMclustering(bitvector.bv, int(k[1]), bitvector.read_hist, bitvector.base_to_keep, bitvector.sequence, **clustering_args)
+                likelihood_reads_best_cluster, _, _ = em.expectation(clusters[k][0]['mu'], clusters[k][0]['pi'])
+                reads_best_cluster[k] = bitvector.associate_reads_with_likelihoods(likelihood_reads_best_cluster)
+                
+            best_clusters_samples[section] = reads_best_cluster
 
     # Save the results
     with open(os.path.join(out_dir, 'best_cluster_reads.json'), 'w') as f:
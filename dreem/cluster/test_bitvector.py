@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+import pyarrow.orc as po
+
+from dreem.cluster.bitvector import BitVector
+from dreem.util.cli import (READ_NAMES_FULL, READ_NAMES_PREFIX,
+                            READ_NAMES_HASH, READ_NAMES_NONE,
+                            READ_NAMES_MODES)
+from dreem.util.path import READ_NAMES_EXT
+from dreem.util.seq import DNA
+from dreem.util.util import (BLANK_INT, MATCH_INT, SUB_T_INT, hash_read_name,
+                             save_read_names)
+from dreem.vector.mprofile import VectorWriter
+from dreem.vector.samview import SamReadFilter
+
+
+class TestBitVectorSection(TestCase):
+    """ Test clustering a section sliced from the bit vectors of a whole
+    reference. """
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.ref_seq = "".join(rng.choice(["A", "C"], 40))
+        self.muts = np.where(rng.random((300, 40)) < 0.05,
+                             SUB_T_INT, MATCH_INT).astype(np.uint8)
+        # Reads that cover only part of the reference.
+        for i, row in enumerate(self.muts):
+            row[: i % 25] = BLANK_INT
+        self.names = [f"read{i}" for i in range(len(self.muts))]
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def write_batch(self, first: int = 1, last: int | None = None,
+                    id_column: bool = True):
+        """ Write the vectors (of positions first to last, of the reads that
+        cover any of them) in one batch and return the path of the batch.
+        The read names go in the column 'id' or, as vectoring stores them,
+        in a file next to the batch. """
+        last = len(self.ref_seq) if last is None else last
+        muts = self.muts[:, first - 1: last]
+        covered = np.count_nonzero(muts, axis=1) > 0
+        region = os.path.join(self.top, "sample", "ref", f"{first}-{last}")
+        os.makedirs(region, exist_ok=True)
+        df = pd.DataFrame(muts[covered].view(np.byte),
+                          columns=[f"{base}{pos}" for pos, base in
+                                   enumerate(self.ref_seq[first - 1: last],
+                                             start=first)])
+        orc_file = os.path.join(region, "vectors_0.orc")
+        if id_column:
+            df["id"] = np.array(self.names)[covered]
+        else:
+            save_read_names(orc_file[:-len(".orc")] + READ_NAMES_EXT,
+                            list(np.array(self.names)[covered]),
+                            READ_NAMES_FULL)
+        df.to_orc(orc_file, engine="pyarrow")
+        return orc_file
+
+    def test_slice_section(self):
+        first, last = 3, 15
+        sliced = BitVector(path=self.write_batch(), first=first, last=last)
+        expect = BitVector(path=self.write_batch(first, last))
+        self.assertEqual(sliced.name, f"vectors_0_{first}-{last}")
+        self.assertEqual(sliced.report, expect.report)
+        self.assertEqual(sliced.base_to_keep, expect.base_to_keep)
+        np.testing.assert_array_equal(sliced.bv, expect.bv)
+        np.testing.assert_array_equal(sliced.read_hist, expect.read_hist)
+        np.testing.assert_array_equal(sliced.read_names, expect.read_names)
+        self.assertLess(sliced.report["total_number_of_reads"],
+                        len(self.muts))
+
+    def test_slice_section_names_file(self):
+        # The names of the reads kept are taken from the names file.
+        first, last = 3, 15
+        sliced = BitVector(path=self.write_batch(id_column=False),
+                           first=first, last=last)
+        expect = BitVector(path=self.write_batch(first, last))
+        np.testing.assert_array_equal(sliced.read_names, expect.read_names)
+
+
+class TestBitVectorReadNames(TestCase):
+    """ Test clustering batches of vectors with every mode of storing the
+    read names. """
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.ref_seq = DNA(b"".join(rng.choice([b"A", b"C"], 40)))
+        self.muts = np.where(rng.random((300, 40)) < 0.05,
+                             SUB_T_INT, MATCH_INT).astype(np.uint8)
+        self.names = [f"FS10000136:97:BPN80019-0831:1:1101:{i}:1090"
+                      for i in range(len(self.muts))]
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def write_batch(self, read_names: str):
+        """ Write the vectors in one batch and return the path of the batch.
+        """
+        top = os.path.join(self.top, read_names)
+        os.makedirs(top)
+        writer = VectorWriter(top,
+                              SimpleNamespace(
+                                  sample=SimpleNamespace(name="sample")),
+                              "ref", 1, len(self.ref_seq), self.ref_seq,
+                              False, SamReadFilter(), read_names)
+        mv_file = writer.get_mv_batch_path(0).path
+        mv_file.parent.mkdir(parents=True)
+        writer._write_batch(self.names, [bytes(m) for m in self.muts], 0)
+        # The batch itself has only the positions, whatever the mode.
+        self.assertEqual(po.ORCFile(mv_file).schema.names, writer.columns)
+        return str(mv_file)
+
+    def test_read_names(self):
+        expect = {
+            READ_NAMES_FULL: self.names,
+            READ_NAMES_PREFIX: self.names,
+            READ_NAMES_HASH: [str(hash_read_name(name))
+                              for name in self.names],
+            READ_NAMES_NONE: [str(i) for i in range(len(self.names))],
+        }
+        kept = dict()
+        for read_names in READ_NAMES_MODES:
+            with self.subTest(read_names=read_names):
+                bv = BitVector(path=self.write_batch(read_names))
+                self.assertEqual(len(bv.read_names),
+                                 bv.report["number_of_used_reads"])
+                kept[read_names] = [expect[read_names].index(name)
+                                    for name in bv.read_names]
+                reads = bv.associate_reads_with_likelihoods(
+                    np.ones((len(bv.read_hist), 1)))
+                self.assertEqual(set(reads), set(bv.read_names))
+        # Every mode keeps the names of the same reads.
+        self.assertEqual(len(set(map(tuple, kept.values()))), 1)
+        self.assertGreater(len(kept[READ_NAMES_FULL]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
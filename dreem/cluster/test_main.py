@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from dreem.cluster import main
+
+
+class TestClusterSections(TestCase):
+    """ Test which sections clustering slices from each batch of bit vectors.
+    """
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.top, "refs.fasta")
+        with open(self.fasta, "w") as f:
+            f.write(">ref\n" + "ACGT" * 10 + "\n")
+        # Clustering reads the batches of every region of a reference.
+        self.input_dir = os.path.join(self.top, "sample", "ref")
+        self.out_dir = os.path.join(self.top, "out")
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def batch(self, region: str):
+        """ Create an (empty) batch of bit vectors of a region. """
+        region_dir = os.path.join(self.input_dir, region)
+        os.makedirs(region_dir, exist_ok=True)
+        orc_file = os.path.join(region_dir, "vectors_0.orc")
+        open(orc_file, "w").close()
+        return orc_file
+
+    def cluster(self, coords: list):
+        """ Return the batch and section of every bit vector clustered. """
+        with (mock.patch.object(main, "BitVector") as bit_vector,
+              mock.patch.object(main, "ClusteringAnalysis") as analysis):
+            analysis.return_value.run.return_value = dict()
+            main.run(self.input_dir, self.out_dir, fasta=self.fasta,
+                     coords=coords)
+        return [(kwargs["path"], kwargs["first"], kwargs["last"])
+                for _, kwargs in bit_vector.call_args_list]
+
+    def test_whole_ref(self):
+        whole = self.batch("1-40")
+        coords = [("ref", 1, 40), ("ref", 5, 20), ("ref", 10, 35),
+                  ("other", 2, 8)]
+        self.assertCountEqual(self.cluster(coords),
+                              [(whole, None, None), (whole, 5, 20),
+                               (whole, 10, 35)])
+        # Without sections of the reference, its bit vectors are clustered
+        # as they are.
+        self.assertEqual(self.cluster([("other", 2, 8)]),
+                         [(whole, None, None)])
+
+    def test_sections(self):
+        # Bit vectors of a section are never sliced, and a section that was
+        # vectorized on its own is not also sliced from the whole reference.
+        whole = self.batch("1-40")
+        section = self.batch("5-20")
+        coords = [("ref", 5, 20), ("ref", 10, 35)]
+        self.assertCountEqual(self.cluster(coords),
+                              [(whole, 10, 35), (section, None, None)])
+        shutil.rmtree(os.path.dirname(whole))
+        self.assertEqual(self.cluster(coords), [(section, None, None)])
+
+
+if __name__ == "__main__":
+    unittest.main()
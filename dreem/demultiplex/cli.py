@@ -15,6 +15,8 @@ from dreem.util.cli import *
 @barcode_start
 @barcode_length
 @max_barcode_mismatches
+@barcode_lookup
+@barcode_offset_tolerance
 
 @optgroup.group('Selection')
 @coords
@@ -1,13 +1,196 @@
 import dreem.util as util
+import itertools
+import logging
 import os  
+import re
+from collections import Counter, OrderedDict
 import pandas as pd
 import numpy as np
 from scipy import signal
 import datetime
-from dreem.util.cli import FASTQ1, FASTQ2, LIBRARY, TOP_DIR, MAX_BARCODE_MISMATCHES, VERBOSE, DEFAULT_INTERLEAVED_INPUT, COORDS, PRIMERS, FILL, FASTA
+from dreem.util.cli import FASTQ1, FASTQ2, LIBRARY, TOP_DIR, MAX_BARCODE_MISMATCHES, VERBOSE, DEFAULT_INTERLEAVED_INPUT, COORDS, PRIMERS, FILL, FASTA, \
+    BARCODE_LOOKUP_HASH, DEFAULT_BARCODE_LOOKUP, DEFAULT_BARCODE_OFFSET_TOLERANCE
 from dreem.util.files_sanity import check_library
 
-def demultiplex(f1: str = FASTQ1, f2: str = FASTQ2, fasta: str = FASTA, interleaved: bool = DEFAULT_INTERLEAVED_INPUT, library: str = LIBRARY, output_folder: str = TOP_DIR, max_barcode_mismatches: int = MAX_BARCODE_MISMATCHES, verbose: bool = VERBOSE):
+# Most output FASTQ files to keep open at once
+MAX_OPEN_WRITERS = 256
+# Bytes of buffer of each open output FASTQ file
+WRITER_BUFFER_SIZE = 2**20
+# Bases of the barcode hash table; any other character in a read is an N, which (as in the correlation) matches nothing
+BARCODE_BASES = 'ACGT'
+BARCODE_NON_BASE = re.compile('[^ACGT]')
+
+class FastqWriterPool:
+    """Keep output FASTQ files open with large buffers while reads are written to them.
+
+    Opening, appending to, and closing a file for every read makes demultiplexing bound by system calls. Instead, each
+    file stays open until more than `max_open` files are open, when the least recently used one is closed; if more reads
+    go to it later, it is reopened for appending. All files are flushed and closed when the pool is closed (or exits as a
+    context manager). The files written are identical to those written by opening and closing each file for every read.
+
+    Parameters
+    ----------
+    max_open: int
+        Maximum number of files to keep open at once.
+    buffer_size: int
+        Number of bytes of buffer of each open file.
+    """
+
+    def __init__(self, max_open: int = MAX_OPEN_WRITERS, buffer_size: int = WRITER_BUFFER_SIZE):
+        if max_open < 1:
+            raise ValueError(f"max_open must be >= 1, but got {max_open}")
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        # Open files, from least to most recently used.
+        self._files = OrderedDict()
+        # Every file opened so far, which must be appended to if reopened.
+        self._opened = set()
+
+    def _get_file(self, path: str, mode: str):
+        f = self._files.pop(path, None)
+        if f is None:
+            if len(self._files) >= self.max_open:
+                _, lru = self._files.popitem(last=False)
+                lru.close()
+            f = open(path, 'a' if path in self._opened else mode, buffering=self.buffer_size)
+            self._opened.add(path)
+        # Mark the file as the most recently used.
+        self._files[path] = f
+        return f
+
+    def write(self, path: str, header: str, sequence: str, quality: str, mode: str = 'w'):
+        """Write one read to the file at `path`, which is opened with `mode` ('w' or 'a') the first time."""
+        write_fastq_line(self._get_file(path, mode), header, sequence, quality)
+
+    def close(self):
+        """Flush and close every open file."""
+        while self._files:
+            _, f = self._files.popitem(last=False)
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+class BarcodeTable:
+    """Hash table of every sequence within `max_mismatches` substitutions of each barcode.
+
+    Each key maps to every barcode within `max_mismatches` of it, with the number of mismatches, so a read is searched
+    with one lookup per position instead of one correlation per barcode. A key within `max_mismatches` of more than one
+    barcode is ambiguous; it is kept (the search resolves it the same way as the correlation: the first barcode in the
+    library wins) and reported in `ambiguous`.
+
+    Parameters
+    ----------
+    barcodes: list
+        Barcodes, in the order of the library.
+    max_mismatches: int
+        Maximum number of mismatches between a barcode and a read.
+    """
+
+    def __init__(self, barcodes: list, max_mismatches: int):
+        self.lengths = sorted(set(map(len, barcodes)))
+        self.table = dict()
+        for index, barcode in enumerate(barcodes):
+            for neighbour, n_mismatches in mismatch_neighbours(barcode, max_mismatches):
+                self.table.setdefault(neighbour, []).append((index, n_mismatches))
+        self.ambiguous = {key: sorted({index for index, _ in hits}) for key, hits in self.table.items() if len(hits) > 1}
+
+    def search(self, sequence: str):
+        """Return (index, mismatches, position) of the first barcode in the library that is in `sequence` with at most
+        `max_mismatches`, at the position with the fewest mismatches (the first such position if tied), or None."""
+        sequence = BARCODE_NON_BASE.sub('N', sequence)
+        best = None
+        for length in self.lengths:
+            for position in range(len(sequence) - length + 1):
+                for index, n_mismatches in self.table.get(sequence[position: position + length], ()):
+                    if best is None or (index, n_mismatches, position) < best:
+                        best = index, n_mismatches, position
+        return best
+
+class BarcodeOffsets:
+    """Barcodes to compare with a read only near the position where the library expects them.
+
+    Every barcode is compared with the read at each shift of up to `tolerance` bases from its expected position, with the
+    Hamming distances of all barcodes of one length and all shifts computed at once. The expected position of a barcode
+    follows the barcode positions of the report: `barcode_start` in read 1, and `len(read) - barcode_start - len(barcode)`
+    in read 2, whose barcodes are reverse complemented. Barcodes without a `barcode_start` are never found here.
+
+    Parameters
+    ----------
+    barcodes: list
+        Barcodes, in the order of the library.
+    starts: list
+        Start position of each barcode (NA if unknown).
+    max_mismatches: int
+        Maximum number of mismatches between a barcode and a read.
+    tolerance: int
+        Maximum number of bases between the expected and the actual position of a barcode.
+    reverse: bool
+        Whether the reads are read 2.
+    """
+
+    def __init__(self, barcodes: list, starts: list, max_mismatches: int, tolerance: int, reverse: bool = False):
+        if tolerance < 0:
+            raise ValueError(f"tolerance must be >= 0, but got {tolerance}")
+        self.max_mismatches = max_mismatches
+        self.reverse = reverse
+        self.shifts = np.arange(-tolerance, tolerance + 1)
+        groups = {}
+        for index, (barcode, start) in enumerate(zip(barcodes, starts)):
+            if not pd.isnull(start):
+                groups.setdefault(len(barcode), []).append((index, int(start), barcode))
+        # For each length: indexes and starts of the barcodes, and their bases as a matrix (one row per barcode).
+        self.groups = [(length, np.array([index for index, _, _ in group]), np.array([start for _, start, _ in group]),
+                        np.frombuffer(''.join(barcode for _, _, barcode in group).encode(), dtype=np.uint8)
+                        .reshape(len(group), length))
+                       for length, group in sorted(groups.items())]
+
+    def search(self, sequence: str):
+        """Return (index, mismatches, position) of the first barcode in the library that is within `tolerance` of its
+        expected position in `sequence` with at most `max_mismatches`, at the shift with the fewest mismatches (the first
+        such position if tied), or None."""
+        read = np.frombuffer(sequence.encode(), dtype=np.uint8)
+        best = None
+        for length, indexes, starts, bases in self.groups:
+            last = len(read) - length
+            if last < 0:
+                continue
+            expected = last - starts if self.reverse else starts
+            # Positions of every barcode (rows) at every shift (columns).
+            positions = expected[:, np.newaxis] + self.shifts
+            windows = read[np.clip(positions, 0, last)[:, :, np.newaxis] + np.arange(length)]
+            distances = np.count_nonzero(windows != bases[:, np.newaxis, :], axis=2)
+            for row, col in zip(*np.nonzero((distances <= self.max_mismatches) & (positions >= 0) & (positions <= last))):
+                hit = int(indexes[row]), int(distances[row, col]), int(positions[row, col])
+                if best is None or hit < best:
+                    best = hit
+        return best
+
+def mismatch_neighbours(barcode, max_mismatches):
+    """Yield every sequence (over ACGT and N) within `max_mismatches` substitutions of `barcode`, with its number of
+    substitutions."""
+    for n_mismatches in range(max_mismatches + 1):
+        for positions in itertools.combinations(range(len(barcode)), n_mismatches):
+            for bases in itertools.product(*[[b for b in BARCODE_BASES + 'N' if b != barcode[p]] for p in positions]):
+                neighbour = list(barcode)
+                for position, base in zip(positions, bases):
+                    neighbour[position] = base
+                yield ''.join(neighbour), n_mismatches
+
+def find_barcode_by_correlation(sequence, barcodes, max_mismatches):
+    """Return (index, mismatches, position) of the first barcode in the library whose correlation with `sequence` shows
+    at most `max_mismatches`, at the position of the best correlation, or None."""
+    read = embed_sequence_as_binary(sequence)
+    for index, barcode in enumerate(barcodes):
+        corr = compute_correlation(embed_sequence_as_binary(barcode), read)
+        if barcode_in_read(corr, worst_matching_score(barcode, max_mismatches)):
+            return index, round((1. - max(corr)) * len(barcode)), np.argmax(corr)
+    return None
+
+def demultiplex(f1: str = FASTQ1, f2: str = FASTQ2, fasta: str = FASTA, interleaved: bool = DEFAULT_INTERLEAVED_INPUT, library: str = LIBRARY, output_folder: str = TOP_DIR, max_barcode_mismatches: int = MAX_BARCODE_MISMATCHES, verbose: bool = VERBOSE, barcode_lookup: str = DEFAULT_BARCODE_LOOKUP, barcode_offset_tolerance: int = DEFAULT_BARCODE_OFFSET_TOLERANCE):
     """Demultiplex a pair of FASTQ files.
 
     Publishes to `output_folder` a pair of FASTQ files for each construct, named {construct}_R1.fastq and {construct}_R2.fastq.
@@ -30,6 +213,12 @@ def demultiplex(f1: str = FASTQ1, f2: str = FASTQ2, fasta: str = FASTA, interlea
         Maximum number of mutations allowed on the barcode.
     verbose: bool
         Whether to print the progress.
+    barcode_lookup: str
+        How to find barcodes in reads: 'hash' looks up every position of the read in a hash table of the barcodes and
+        their mismatched neighbours; 'correlation' correlates the read with every barcode. Both find the same barcodes.
+    barcode_offset_tolerance: int
+        If >= 0, look for the barcodes first within this many bases of their expected positions (see BarcodeOffsets), and
+        search the whole read with `barcode_lookup` only if none is there. If -1, always search the whole read.
         
     returns
     -------
@@ -44,6 +233,7 @@ def demultiplex(f1: str = FASTQ1, f2: str = FASTQ2, fasta: str = FASTA, interlea
     for construct, barcode in zip(constructs, barcodes):
         # check if the barcode and the construct are on the same row
         assert library.loc[library['construct']==construct, 'barcode'].values[0] == barcode
+    barcode_starts = [library.loc[library['construct']==construct, 'barcode_start'].values[0] for construct in constructs]
 
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)        
@@ -59,63 +249,72 @@ def demultiplex(f1: str = FASTQ1, f2: str = FASTQ2, fasta: str = FASTA, interlea
         off_matches_count = {k:0 for k in range(1, max_barcode_mismatches+1)}
         lost_reads_count = 0
         count_per_construct = {construct:0 for construct in constructs}
-        barcode_shifts = []  
+        barcode_shifts = Counter()
+        offset_hits_count = 0
+        search_hits_count = 0
         
-        construct_fastq_was_written = {construct:False for construct in constructs}
-                        
-        with open(fq, 'r') as f:
+        primer_barcodes = [reverse_complement(barcode) if primer == 2 else barcode for barcode in barcodes]
+        if barcode_lookup == BARCODE_LOOKUP_HASH:
+            table = BarcodeTable(primer_barcodes, max_barcode_mismatches)
+            if table.ambiguous:
+                logging.warning(f"{len(table.ambiguous)} sequences are within {max_barcode_mismatches} mismatches of "
+                                f"more than one barcode; reads with them go to the first of those constructs")
+        else:
+            table = None
+        if barcode_offset_tolerance >= 0:
+            offsets = BarcodeOffsets(primer_barcodes, barcode_starts, max_barcode_mismatches, barcode_offset_tolerance,
+                                     reverse=primer == 2)
+        else:
+            offsets = None
+        
+        with open(fq, 'r') as f, FastqWriterPool() as writers:
             while True:
                 header, sequence, quality = read_fastq_line(f)
                 if not header:
                     break
                 
-                flag_match = False
-                for construct, barcode in zip(constructs, barcodes):
-                    
-                    minimal_corr_score = worst_matching_score(barcode, max_barcode_mismatches)
-                    
-                    if primer == 2:
-                        barcode = reverse_complement(barcode)
-                    
-                    corr = compute_correlation(embed_sequence_as_binary(barcode), embed_sequence_as_binary(sequence))
-                    is_match = barcode_in_read(corr, minimal_corr_score)
-                    if is_match:
-                        if max(corr) == 1:
-                            perfect_matches_count += 1
-                        else:
-                            for k in range(1, max_barcode_mismatches+1):
-                                if max(corr) >= worst_matching_score(barcode, k):
-                                    off_matches_count[k] += 1
-                                    break
-                            
-                        barcode_start = library.loc[library['construct']==construct, 'barcode_start'].values[0]
-                        if primer == 2:
-                            barcode_shifts.append(len(sequence) - np.argmax(corr) - barcode_start - len(barcode))
-                        else:
-                            barcode_shifts.append(np.argmax(corr) - barcode_start)
-                            
-                        count_per_construct[construct] += 1
-                        
-                        if not construct_fastq_was_written[construct]:
-                            with open(os.path.join(output_folder, construct + '_R' + str(primer) + '.fastq'), 'w') as g:
-                                write_fastq_line(g, header, sequence, quality)
-                            construct_fastq_was_written[construct] = True
-                        else:
-                            with open(os.path.join(output_folder, construct + '_R' + str(primer) + '.fastq'), 'a') as g:
-                                write_fastq_line(g, header, sequence, quality)
-                            
-                        flag_match = True
-                        break
-                    
-                if not flag_match:
+                hit = offsets.search(sequence) if offsets is not None else None
+                if hit is not None:
+                    offset_hits_count += 1
+                else:
+                    if table is not None:
+                        hit = table.search(sequence)
+                    else:
+                        hit = find_barcode_by_correlation(sequence, primer_barcodes, max_barcode_mismatches)
+                    if hit is not None:
+                        search_hits_count += 1
+                
+                if hit is None:
                     lost_reads_count += 1
-                    with open(os.path.join(output_folder, 'lost_reads_R' + str(primer) + '.fastq'), 'a') as g:
-                        write_fastq_line(g, header, sequence, quality)
+                    writers.write(os.path.join(output_folder, 'lost_reads_R' + str(primer) + '.fastq'),
+                                  header, sequence, quality, 'a')
+                    continue
+                
+                index, n_mismatches, position = hit
+                construct, barcode = constructs[index], primer_barcodes[index]
+                if n_mismatches == 0:
+                    perfect_matches_count += 1
+                else:
+                    off_matches_count[n_mismatches] += 1
+                
+                if primer == 2:
+                    barcode_shifts[len(sequence) - position - barcode_starts[index] - len(barcode)] += 1
+                else:
+                    barcode_shifts[position - barcode_starts[index]] += 1
+                
+                count_per_construct[construct] += 1
+                
+                # Each construct's file is overwritten by the first read of this FASTQ file.
+                writers.write(os.path.join(output_folder, construct + '_R' + str(primer) + '.fastq'),
+                              header, sequence, quality, 'w')
                         
-        write_report(fq, output_folder, perfect_matches_count, off_matches_count, lost_reads_count, barcode_shifts, count_per_construct)
+        write_report(fq, output_folder, perfect_matches_count, off_matches_count, lost_reads_count, barcode_shifts, count_per_construct,
+                     table.ambiguous if table is not None else None,
+                     (offset_hits_count, search_hits_count) if offsets is not None else None)
     return 1
 
-def write_report(fastq, output_folder, perfect_matches_count, off_matches_count, lost_reads_count, barcode_shifts, count_per_construct):
+def write_report(fastq, output_folder, perfect_matches_count, off_matches_count, lost_reads_count, barcode_shifts, count_per_construct,
+                 ambiguous=None, path_hits=None):
     """Write a report of the demultiplexing process for the given fastq file."""
     with open(os.path.join(output_folder, 'report.txt'), 'a') as f:
         f.write("Time: " + str(datetime.datetime.now()) + "\n")
@@ -126,6 +325,15 @@ def write_report(fastq, output_folder, perfect_matches_count, off_matches_count,
         for k in off_matches_count:
             f.write('Count of ' + str(k) + '-off matches: ' + str(off_matches_count[k]) + '\n')
         f.write('Count of lost reads: ' + str(lost_reads_count) + '\n')
+        if ambiguous is not None:
+            f.write('Count of sequences within the maximum mismatches of more than one barcode: ' + str(len(ambiguous)) + '\n')
+        if path_hits is not None:
+            offset_hits, search_hits = path_hits
+            n_reads = perfect_matches_count + sum(off_matches_count.values()) + lost_reads_count
+            f.write('Count of reads found near the expected barcode position: ' + str(offset_hits) + ' of ' + str(n_reads)
+                    + ' (' + format_rate(offset_hits, n_reads) + ')\n')
+            f.write('Count of reads found by searching the whole read: ' + str(search_hits) + ' of '
+                    + str(n_reads - offset_hits) + ' (' + format_rate(search_hits, n_reads - offset_hits) + ')\n')
         f.write('Count of reads per barcode position: ' + str(bin_positions(barcode_shifts)) + '\n')
         f.write('\nCount of reads per construct: ' + '\n' + '-'*len('Count of reads per construct:') + '\n')
         for construct in count_per_construct:
@@ -135,15 +343,14 @@ def write_report(fastq, output_folder, perfect_matches_count, off_matches_count,
 def worst_matching_score(barcode, max_muts=1):
     return 1. - float(max_muts)/len(barcode) -1E-9
                                     
+def format_rate(count, total):
+    """Format count/total as a percentage."""
+    return f"{100. * count / total:.1f}%" if total else "n/a"
+
 def bin_positions(positions):
-    """Turns a list of positions into a dictionary of bins."""
-    bins = {}
-    for pos in positions:
-        if pos not in bins:
-            bins[pos] = 0
-        bins[pos] += 1
-    bins = {k: bins[k] for k in sorted(bins)}
-    return bins
+    """Turns a list of positions, or a Counter of them, into a dictionary of bins."""
+    bins = Counter(positions)
+    return {k: bins[k] for k in sorted(bins)}
 
 def read_fastq_line(f):
     """Read the line of a fastq file and return a tuple (header, sequence, quality)"""
@@ -182,7 +389,7 @@ def reverse_complement(seq):
 def next_base(base):
     return {'A':'T','T':'C','C':'G','G':'A',0:1}[base]
 
-def run(fastq1:str = FASTQ1, fastq2:str = FASTQ2, fasta:str = FASTA, interleaved:bool=DEFAULT_INTERLEAVED_INPUT, library:str = LIBRARY, out_dir:str = TOP_DIR, max_barcode_mismatches:str = MAX_BARCODE_MISMATCHES, verbose:bool = VERBOSE):
+def run(fastq1:str = FASTQ1, fastq2:str = FASTQ2, fasta:str = FASTA, interleaved:bool=DEFAULT_INTERLEAVED_INPUT, library:str = LIBRARY, out_dir:str = TOP_DIR, max_barcode_mismatches:str = MAX_BARCODE_MISMATCHES, verbose:bool = VERBOSE, barcode_lookup:str = DEFAULT_BARCODE_LOOKUP, barcode_offset_tolerance:int = DEFAULT_BARCODE_OFFSET_TOLERANCE):
     """Run the demultiplexing pipeline.
 
     Demultiplexes the reads and outputs one fastq file per construct in the directory `output_path`, using `temp_path` as a temp directory.
@@ -205,6 +412,12 @@ def run(fastq1:str = FASTQ1, fastq2:str = FASTQ2, fasta:str = FASTA, interleaved
         Maximum number of mutations allowed on the barcode.
     verbose: bool
         Print progress to stdout (default: no).
+    barcode_lookup: str
+        How to find barcodes in reads: 'hash' (a hash table of the barcodes and their mismatched neighbours) or
+        'correlation' (default: hash).
+    barcode_offset_tolerance: int
+        Look for the barcodes first within this many bases of their expected positions, or -1 to always search the
+        whole read (default: -1).
         
     Returns
     -------
@@ -231,5 +444,5 @@ def run(fastq1:str = FASTQ1, fastq2:str = FASTQ2, fasta:str = FASTA, interleaved
     
     # Demultiplex
     for f1, f2 in zip(fastq1, fastq2):
-        assert demultiplex(f1, f2, fasta, interleaved, library, out_dir, max_barcode_mismatches), "Demultiplexing failed"
+        assert demultiplex(f1, f2, fasta, interleaved, library, out_dir, max_barcode_mismatches, verbose, barcode_lookup, barcode_offset_tolerance), "Demultiplexing failed"
     return 1
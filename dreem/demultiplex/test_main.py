@@ -0,0 +1,217 @@
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+from unittest import TestCase
+
+from dreem.demultiplex.main import (BarcodeOffsets, BarcodeTable,
+                                    FastqWriterPool, bin_positions,
+                                    find_barcode_by_correlation,
+                                    hamming_distance,
+                                    mismatch_neighbours, reverse_complement,
+                                    write_fastq_line)
+
+
+class TestFastqWriterPool(TestCase):
+    """ Test writing reads to many FASTQ files through a pool of writers. """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_reads(self, out_dir: str, reads: list, max_open: int | None):
+        os.makedirs(out_dir)
+        # A file from before, which 'w' overwrites and 'a' appends to.
+        for name in ("c0.fastq", "lost.fastq"):
+            with open(os.path.join(out_dir, name), "w") as f:
+                f.write("@old\nA\n+\nI\n")
+        if max_open is None:
+            # Open and close the file for every read.
+            opened = set()
+            for name, mode, read in reads:
+                path = os.path.join(out_dir, name)
+                with open(path, "a" if path in opened else mode) as f:
+                    write_fastq_line(f, *read)
+                opened.add(path)
+        else:
+            with FastqWriterPool(max_open=max_open) as writers:
+                for name, mode, read in reads:
+                    writers.write(os.path.join(out_dir, name), *read, mode)
+        files = dict()
+        for name in sorted(os.listdir(out_dir)):
+            with open(os.path.join(out_dir, name), "rb") as f:
+                files[name] = f.read()
+        return files
+
+    def test_identical_files(self):
+        r = random.Random(0)
+        names = [(f"c{i}.fastq", "w") for i in range(20)] + [("lost.fastq",
+                                                              "a")]
+        reads = [(*r.choice(names[:-1] if i % 7 else names),
+                  (f"@read{i}", "ACGT" * r.randint(1, 5), "IIII"))
+                 for i in range(500)]
+        expect = self.write_reads(os.path.join(self.dir, "expect"), reads,
+                                  None)
+        for max_open in (1, 2, 5, 100):
+            with self.subTest(max_open=max_open):
+                self.assertEqual(self.write_reads(
+                    os.path.join(self.dir, str(max_open)), reads, max_open),
+                    expect)
+
+    def test_lru(self):
+        pool = FastqWriterPool(max_open=2)
+        for name in ("a", "b", "a", "c"):
+            pool.write(os.path.join(self.dir, name), "@r", "A", "I")
+        # "b" was the least recently used when "c" was opened.
+        self.assertEqual(list(map(os.path.basename, pool._files)), ["a", "c"])
+        pool.close()
+        self.assertEqual(pool._files, {})
+
+
+class TestBarcodeTable(TestCase):
+    """ Test finding barcodes in reads with a hash table. """
+
+    def test_neighbours(self):
+        neighbours = dict(mismatch_neighbours("ACG", 1))
+        # The barcode itself, and 4 substitutions (with N) at each position.
+        self.assertEqual(len(neighbours), 1 + 3 * 4)
+        self.assertEqual(neighbours["ACG"], 0)
+        self.assertEqual(neighbours["ANG"], 1)
+        self.assertEqual(len(dict(mismatch_neighbours("ACGT", 2))),
+                         1 + 4 * 4 + 6 * 4 ** 2)
+
+    def test_same_as_correlation(self):
+        r = random.Random(0)
+        for max_mismatches in range(3):
+            barcodes = ["".join(r.choice("ACGT") for _ in range(8))
+                        for _ in range(12)]
+            for primer_barcodes in (barcodes, list(map(reverse_complement,
+                                                       barcodes))):
+                table = BarcodeTable(primer_barcodes, max_mismatches)
+                for _ in range(300):
+                    barcode = list(r.choice(primer_barcodes))
+                    for p in r.sample(range(8), r.randint(0, 3)):
+                        barcode[p] = r.choice("ACGTN")
+                    # The correlation needs a read longer than the barcode.
+                    read = "".join(r.choice("ACGTN")
+                                   for _ in range(r.randint(1, 12)))
+                    read += "".join(barcode)
+                    read += "".join(r.choice("ACGT")
+                                    for _ in range(r.randint(0, 12)))
+                    with self.subTest(max_mismatches=max_mismatches,
+                                      read=read):
+                        expect = find_barcode_by_correlation(
+                            read, primer_barcodes, max_mismatches)
+                        hit = table.search(read)
+                        if expect is None:
+                            self.assertIsNone(hit)
+                        else:
+                            self.assertEqual(hit, tuple(map(int, expect)))
+
+    def test_ambiguous(self):
+        table = BarcodeTable(["AAAA", "AAAT", "CCCC"], 1)
+        # AAAA and AAAT are 1 apart, so each (and AAAN, AAAC, AAAG) is within
+        # 1 mismatch of both.
+        self.assertEqual(set(table.ambiguous),
+                         {"AAAA", "AAAT", "AAAC", "AAAG", "AAAN"})
+        self.assertEqual(table.ambiguous["AAAC"], [0, 1])
+        # The first barcode in the library wins, as in the correlation.
+        self.assertEqual(table.search("GGAAATGG"), (0, 1, 1))
+
+
+class TestBarcodeOffsets(TestCase):
+    """ Test finding barcodes near their expected positions in reads. """
+
+    @staticmethod
+    def brute_force(read, barcodes, starts, max_mismatches, tolerance,
+                    reverse):
+        hits = list()
+        for index, (barcode, start) in enumerate(zip(barcodes, starts)):
+            if start is None:
+                continue
+            expected = (len(read) - start - len(barcode) if reverse
+                        else start)
+            for position in range(expected - tolerance,
+                                  expected + tolerance + 1):
+                if 0 <= position <= len(read) - len(barcode):
+                    n_mismatches = hamming_distance(
+                        read[position: position + len(barcode)], barcode)
+                    if n_mismatches <= max_mismatches:
+                        hits.append((index, n_mismatches, position))
+        return min(hits, default=None)
+
+    def test_same_as_brute_force(self):
+        r = random.Random(0)
+        for max_mismatches, tolerance, reverse in itertools.product(
+                range(3), range(3), (False, True)):
+            # Barcodes of two lengths, one without a start.
+            barcodes = ["".join(r.choice("ACGT") for _ in range(r.choice(
+                (6, 8)))) for _ in range(10)]
+            starts = [r.randint(0, 10) for _ in barcodes]
+            starts[3] = None
+            offsets = BarcodeOffsets(barcodes, starts, max_mismatches,
+                                     tolerance, reverse)
+            for _ in range(200):
+                index = r.randrange(len(barcodes))
+                barcode = list(barcodes[index])
+                for p in r.sample(range(len(barcode)), r.randint(0, 3)):
+                    barcode[p] = r.choice("ACGTN")
+                read = "".join(r.choice("ACGTN") for _ in range(
+                    max(0, starts[index] or 0) + r.randint(-3, 3)))
+                read += "".join(barcode)
+                read += "".join(r.choice("ACGT")
+                                for _ in range(r.randint(0, 12)))
+                with self.subTest(max_mismatches=max_mismatches,
+                                  tolerance=tolerance, reverse=reverse,
+                                  read=read):
+                    self.assertEqual(offsets.search(read),
+                                     self.brute_force(read, barcodes, starts,
+                                                      max_mismatches,
+                                                      tolerance, reverse))
+
+    def test_same_as_search(self):
+        # A barcode at its expected position is found as by the full search.
+        barcodes = ["ACGTAC", "GGCCTT", "TTAGCA"]
+        starts = [2, 5, 0]
+        table = BarcodeTable(barcodes, 1)
+        offsets = BarcodeOffsets(barcodes, starts, 1, 1)
+        for index, (barcode, start) in enumerate(zip(barcodes, starts)):
+            for shift in (-1, 0, 1):
+                read = "N" * max(0, start + shift) + barcode + "NNNN"
+                with self.subTest(index=index, shift=shift):
+                    self.assertEqual(offsets.search(read), table.search(read))
+                    self.assertEqual(offsets.search(read)[0], index)
+        # A barcode farther than the tolerance is found only by the search.
+        read = "N" * 4 + barcodes[2] + "NNNN"
+        self.assertIsNone(offsets.search(read))
+        self.assertEqual(table.search(read), (2, 0, 4))
+        # So is a read shorter than the barcodes.
+        self.assertIsNone(offsets.search("ACG"))
+
+    def test_reverse(self):
+        barcode = reverse_complement("ACGTAC")
+        offsets = BarcodeOffsets([barcode], [2], 0, 0, reverse=True)
+        # In read 2, the barcode ends 2 bases from the end of the read.
+        self.assertEqual(offsets.search("TTTT" + barcode + "GG"), (0, 0, 4))
+        self.assertIsNone(offsets.search("TTTT" + barcode + "G"))
+        with self.assertRaises(ValueError):
+            BarcodeOffsets([barcode], [2], 0, -1)
+
+
+class TestBinPositions(TestCase):
+    """ Test counting the reads at each barcode position. """
+
+    def test_counter(self):
+        positions = [3, -1, 0, 3, -1, 3]
+        self.assertEqual(bin_positions(positions), {-1: 2, 0: 1, 3: 3})
+        self.assertEqual(str(bin_positions(Counter(positions))),
+                         str(bin_positions(positions)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -51,7 +51,7 @@ opti_library = click.option('--library', '-l', default=LIBRARY, type=click.Path(
 opti_coords = click.option('--coords', '-c', type=(str, int, int), multiple=True, help="coordinates for reference: '-c ref-name first last'", default=COORDS)
 opti_primers = click.option('--primers', '-p', type=(str, int, int), multiple=True, help="primers for reference: '-c ref-name fwd-seq rev-seq'", default=PRIMERS)
 opti_fill = click.option('--fill/--no-fill', type=bool, default=FILL, help="Fill in coordinates of reference sequences for which neither coordinates nor primers were given (default: NO).")
-opti_parallel = click.option('--parallel', '-P', type=click.Choice(["profiles", "reads", "off", "auto"], case_sensitive=False), default=PARALLEL, help="Parallelize the processing of mutational PROFILES or READS within each profile, turn parallelization OFF, or AUTO matically choose the parallelization method (default: AUTO).")
+opti_parallel = click.option('--parallel', '-P', type=click.Choice(["profiles", "reads", "coords", "off", "auto"], case_sensitive=False), default=PARALLEL, help="Parallelize the processing of mutational PROFILES, READS within each profile, or windows of COORDS within each profile (using the BAM index, without sorting by name), turn parallelization OFF, or AUTO matically choose the parallelization method (default: AUTO).")
 opto_top_dir = click.option('--top_dir', '-o', default=TOP_DIR, type=click.Path(exists=True), help=f'Where to output files (default: {TOP_DIR})')
 
 
@@ -66,11 +66,17 @@ DEFAULT_DEMULTIPLEXED = False
 BARCODE_START = None
 BARCODE_LENGTH = None
 MAX_BARCODE_MISMATCHES = 1
+BARCODE_LOOKUP_HASH = "hash"
+BARCODE_LOOKUP_CORRELATION = "correlation"
+DEFAULT_BARCODE_LOOKUP = BARCODE_LOOKUP_HASH
+DEFAULT_BARCODE_OFFSET_TOLERANCE = -1
 
 demultiplexing = optgroup.option('--demultiplexing', '-dx', type=bool, help='Use demultiplexing', default=DEFAULT_DEMULTIPLEXED)
 barcode_start = optgroup.option('--barcode_start', '-bs', type=int, help='Start position of the barcode in the read', default=BARCODE_START)
 barcode_length = optgroup.option('--barcode_length', '-bl', type=int, help='Length of the barcode', default=BARCODE_LENGTH)
 max_barcode_mismatches = optgroup.option('--max_barcode_mismatches', '-mb', type=int, help='Maximum number of mutations on the barcode', default=MAX_BARCODE_MISMATCHES)
+barcode_lookup = optgroup.option('--barcode_lookup', '-bk', type=click.Choice([BARCODE_LOOKUP_HASH, BARCODE_LOOKUP_CORRELATION], case_sensitive=False), help='Find barcodes by looking up each position of a read in a hash table of the barcodes and their mismatched neighbours, or by correlating the read with every barcode; both find the same barcodes', default=DEFAULT_BARCODE_LOOKUP)
+barcode_offset_tolerance = optgroup.option('--barcode_offset_tolerance', '-bo', type=int, help='Look for the barcodes first within this many bases of their barcode_start in the library, and search the whole read only if none is there; -1 to always search the whole read', default=DEFAULT_BARCODE_OFFSET_TOLERANCE)
 
 
 # Cutadapt parameters
@@ -112,6 +118,99 @@ READ_GAP_PENALTY = "0,1"
 IGNORE_QUALS = True
 
 
+# Vectoring read filters
+DEFAULT_MIN_MAPQ = 30
+DEFAULT_FLAGS_REQ = 0
+DEFAULT_FLAGS_EXC = 0
+DEFAULT_MIN_ALN_LEN = 0
+DEFAULT_MAX_SCL_FRAC = 1.0
+DEFAULT_MAX_MISMATCHES = -1
+DEFAULT_MAX_INDELS = -1
+
+opti_min_mapq = click.option('--min-mapq', type=int, default=DEFAULT_MIN_MAPQ, help=f"Skip reads whose mapping quality is below this value (default: {DEFAULT_MIN_MAPQ}).")
+opti_flags_req = click.option('--flags-req', type=int, default=DEFAULT_FLAGS_REQ, help="Skip reads whose SAM flag lacks any of these bits (default: 0).")
+opti_flags_exc = click.option('--flags-exc', type=int, default=DEFAULT_FLAGS_EXC, help="Skip reads whose SAM flag has any of these bits (default: 0).")
+opti_min_aln_len = click.option('--min-aln-len', type=int, default=DEFAULT_MIN_ALN_LEN, help="Skip reads with fewer than this many bases aligned to the reference (default: 0).")
+opti_max_scl_frac = click.option('--max-scl-frac', type=float, default=DEFAULT_MAX_SCL_FRAC, help="Skip reads with a larger fraction of soft-clipped bases (default: 1.0).")
+opti_max_mismatches = click.option('--max-mismatches', type=int, default=DEFAULT_MAX_MISMATCHES, help="Skip reads with more substitutions in the CIGAR string; -1 for no limit (default: -1).")
+opti_max_indels = click.option('--max-indels', type=int, default=DEFAULT_MAX_INDELS, help="Skip reads with more insertions and deletions (CIGAR ops I and D) in the CIGAR string; -1 for no limit (default: -1).")
+
+# Vectoring per-read timing diagnostics
+DEFAULT_SLOW_READS = 0
+DEFAULT_MAX_READ_SECS = 0.0
+
+opti_slow_reads = click.option('--slow-reads', type=int, default=DEFAULT_SLOW_READS, help="Time the vectorization of every read and write the names and CIGAR strings of this many slowest reads next to the report of each mutational profile; 0 to disable (default: 0).")
+opti_max_read_secs = click.option('--max-read-secs', type=float, default=DEFAULT_MAX_READ_SECS, help="Abandon and skip any read that takes longer than this many seconds to vectorize; 0 for no limit (default: 0).")
+
+# Vectoring read names
+READ_NAMES_FULL = "full"
+READ_NAMES_PREFIX = "prefix"
+READ_NAMES_HASH = "hash"
+READ_NAMES_NONE = "none"
+READ_NAMES_MODES = (READ_NAMES_FULL, READ_NAMES_PREFIX, READ_NAMES_HASH,
+                    READ_NAMES_NONE)
+DEFAULT_READ_NAMES = READ_NAMES_FULL
+
+opti_read_names = click.option('--read-names', type=click.Choice(READ_NAMES_MODES, case_sensitive=False), default=DEFAULT_READ_NAMES, help=f"How to store read names in a file next to each vector batch: 'full' names, names minus the prefix shared by the batch ('prefix'), 64-bit hashes of the names, with one table per profile to look the names up ('hash'), or not at all ('none') (default: {DEFAULT_READ_NAMES}).")
+
+# Vectoring read sampling
+DEFAULT_MAX_READS = 0
+DEFAULT_SAMPLE_SEED = 0
+
+opti_max_reads = click.option('--max-reads-per-profile', 'max_reads', type=int, default=DEFAULT_MAX_READS, help="Vectorize a random sample of about this many reads (or pairs) from each mutational profile; 0 for no limit (default: 0).")
+opti_sample_seed = click.option('--sample-seed', type=int, default=DEFAULT_SAMPLE_SEED, help=f"Seed for choosing which reads to sample with --max-reads-per-profile; the same seed always chooses the same reads (default: {DEFAULT_SAMPLE_SEED}).")
+
+# Alignment map files (SAM/BAM/CRAM)
+ALN_FORMATS = ("bam", "cram")
+DEFAULT_ALN_FORMAT = "bam"
+DEFAULT_COMPRESS_LEVEL = -1
+DEFAULT_SAMTOOLS_THREADS = 0
+
+opti_aln_format = click.option('--aln-format', type=click.Choice(ALN_FORMATS, case_sensitive=False), default=DEFAULT_ALN_FORMAT, help=f"Write aligned reads as BAM or as CRAM, which is compressed against the reference FASTA (default: {DEFAULT_ALN_FORMAT}).")
+opti_compress_level = click.option('--compress-level', type=click.IntRange(-1, 9), default=DEFAULT_COMPRESS_LEVEL, help="Compression level (0-9) of BAM and CRAM files written by samtools; -1 for the samtools default (default: -1).")
+opti_samtools_threads = click.option('--samtools-threads', type=int, default=DEFAULT_SAMTOOLS_THREADS, help="Number of additional threads each samtools command may use to compress and decompress (default: 0).")
+
+# Resource budget
+DEFAULT_MAX_CPUS = DEFAULT_ALIGN_THREADS
+DEFAULT_MAX_MEM = 0.0
+
+opti_max_cpus = click.option('--max-cpus', type=click.IntRange(min=1), default=DEFAULT_MAX_CPUS, help=f"Total number of CPU cores shared by all work that runs at once (external tools, their threads, and worker processes), e.g. split between the references aligned concurrently and the threads of each (default: {DEFAULT_MAX_CPUS}).")
+opti_max_mem = click.option('--max-mem', type=click.FloatRange(min=0.0), default=DEFAULT_MAX_MEM, help="Total memory (GiB) shared by all work that runs at once; work also waits while the system is low on memory; 0 for no limit besides the available memory (default: 0).")
+
+# Alignment streaming
+DEFAULT_STREAM = False
+
+opti_stream = click.option('--stream/--no-stream', type=bool, default=DEFAULT_STREAM, help="Trim, align, remove equal mappers, and sort in one pipeline connected by OS pipes, writing only the sorted BAM file instead of a trimmed FASTQ and two SAM files; --no-stream runs and keeps each step separately, for debugging (default: NO).")
+
+# Alignment index cache
+DEFAULT_INDEX_CACHE = ""
+INDEX_CACHE_DIR = "index"
+
+opti_index_cache = click.option('--index-cache', type=click.Path(file_okay=False), default=DEFAULT_INDEX_CACHE, help=f"Directory in which to keep the Bowtie 2 index of every reference, keyed by the checksum of its FASTA file, so that each reference is indexed only once for all samples and runs; '' for '{{top_dir}}/{INDEX_CACHE_DIR}' (default: '').")
+
+# Alignment memory-mapped index
+DEFAULT_BT2_MM = False
+
+opti_bt2_mm = click.option('--bt2-mm/--no-bt2-mm', type=bool, default=DEFAULT_BT2_MM, help="Run Bowtie 2 with its index memory-mapped (--mm), so that alignments running at once on one node with the same cached index share one copy of it in RAM; the index cache should be on a local disk (default: NO).")
+
+# Alignment sharding
+DEFAULT_SHARDS = 1
+
+opti_shards = click.option('--shards', type=click.IntRange(min=1), default=DEFAULT_SHARDS, help="Split the FASTQ file(s) of each sample into this many shards (keeping mates together), trim, align, and sort the shards in parallel, and merge them with samtools merge; 1 aligns without sharding (default: 1).")
+
+# Alignment scratch space
+DEFAULT_SCRATCH_DIR = ""
+DEFAULT_KEEP_TEMP = False
+
+opti_scratch_dir = click.option('--scratch-dir', type=click.Path(file_okay=False, exists=True), default=DEFAULT_SCRATCH_DIR, help="Directory in which to write temporary files (trimmed FASTQs, SAMs, and unsplit BAMs), e.g. a fast local disk or tmpfs such as $TMPDIR; free space is checked before each step; '' to write them in {top_dir}/temp (default: '').")
+opti_keep_temp = click.option('--keep-temp/--no-keep-temp', type=bool, default=DEFAULT_KEEP_TEMP, help="Keep temporary files instead of deleting each once it is no longer needed (default: NO).")
+
+# Vectoring whole references
+WHOLE_REFS = False
+
+opti_whole_refs = click.option('--whole-refs/--no-whole-refs', type=bool, default=WHOLE_REFS, help="Vectorize each reference end-to-end once, instead of vectorizing each section separately; clustering and aggregation then slice the vectors of every section from those of its reference (default: NO).")
+
+
 # Clustering
 CLUSTERING = False
 MAX_CLUSTERS = 3
@@ -147,6 +246,7 @@ RNASTRUCTURE_DMS_MAX_PAIRED_VALUE = 0.01
 RNASTRUCTURE_PARTITION = False
 RNASTRUCTURE_PROBABILITY = False
 POISSON = True
+CO_MUTATIONS = False
 
 rnastructure_path = optgroup.option('--rnastructure_path', '-rs', type=click.Path(exists=True), help='Path to RNAstructure, to predict structure and free energy', default=RNASTRUCTURE_PATH)
 rnastructure_temperature = optgroup.option('--rnastructure_temperature', '-rst', type=bool, help='Use sample.csv temperature values for RNAstructure', default=RNASTRUCTURE_TEMPERATURE)
@@ -157,6 +257,7 @@ rnastructure_dms_max_paired_value = optgroup.option('--rnastructure_dms_max_pair
 rnastructure_partition = optgroup.option('--rnastructure_partition', '-rspa', type=bool, help='Use RNAstructure partition function to predict free energy', default=RNASTRUCTURE_PARTITION)
 rnastructure_probability = optgroup.option('--rnastructure_probability', '-rspr', type=bool, help='Use RNAstructure partition function to predict per-base mutation probability', default=RNASTRUCTURE_PROBABILITY)
 poisson = optgroup.option('--poisson', '-po', type=bool, help='Predict Poisson confidence intervals', default=POISSON)
+co_mutations = optgroup.option('--co_mutations', '-cm', type=bool, help='Count the reads mutated at and covering every pair of positions of each section', default=CO_MUTATIONS)
 
 # Misc
 VERBOSE = False
@@ -1,7 +1,13 @@
+from collections import namedtuple
+import contextlib
+import logging
+import os
 import shlex
-import subprocess,os
+import subprocess
+import threading
+import time
 
-from typing import Any, List
+from typing import Any, BinaryIO, Callable, List
 
 
 # Commands for external applications
@@ -15,13 +21,245 @@ SAMTOOLS_CMD = "samtools"
 
 # Command utility functions
 
+class CmdResult(namedtuple("CmdResult", ["cmd", "returncode", "wall_secs",
+                                         "cpu_secs", "max_rss_kib", "log"])):
+    """ Exit status and resources used by one command. """
+
+    def __str__(self):
+        return (f"'{self.cmd}' exited with {self.returncode} after "
+                f"{self.wall_secs:.2f} s wall, {self.cpu_secs:.2f} s CPU, "
+                f"{self.max_rss_kib / 1024:.1f} MiB peak RSS")
+
+
+class CmdExecutor(object):
+    """
+    Run commands (lists of arguments) as subprocesses without a shell. The
+    standard error of each command is appended to a log file named after
+    the command in a log directory (if given, else it is inherited), and
+    the wall time, CPU time, and peak resident memory of each command are
+    measured with os.wait4 (which, unlike getrusage, attributes them to
+    one process even when several run at once) and kept in results.
+
+    Arguments
+    max_jobs (int):    maximum number of commands or pipelines to run at
+                       once from threads sharing this executor (0: no limit)
+    timeout (float):   default number of seconds after which to kill each
+                       command or pipeline (None: no limit)
+    """
+
+    __slots__ = ["timeout", "results", "_jobs"]
+
+    def __init__(self, max_jobs: int = 0, timeout: float | None = None):
+        if max_jobs < 0:
+            raise ValueError(f"max_jobs must be >= 0, but got {max_jobs}")
+        self.timeout = timeout
+        self.results: list[CmdResult] = list()
+        self._jobs = (threading.BoundedSemaphore(max_jobs) if max_jobs
+                      else contextlib.nullcontext())
+
+    @staticmethod
+    def _open_log(args: tuple[str, ...], log_dir: str | os.PathLike | None):
+        if log_dir is None:
+            return None
+        os.makedirs(log_dir, exist_ok=True)
+        log = open(os.path.join(log_dir,
+                                f"{os.path.basename(args[0])}.log"), "ab")
+        log.write(f"$ {shlex.join(args)}\n".encode())
+        log.flush()
+        return log
+
+    def start(self, args: List[Any],
+              log_dir: str | os.PathLike | None = None,
+              **kwargs):
+        """ Start a command (with keyword arguments for subprocess.Popen)
+        and return its process, which must be passed to finish. """
+        args_str = tuple(map(str, args))
+        log = self._open_log(args_str, log_dir)
+        try:
+            proc = subprocess.Popen(args_str, stderr=log, **kwargs)
+        except BaseException:
+            if log is not None:
+                log.close()
+            raise
+        proc.log = log
+        proc.start_time = time.perf_counter()
+        return proc
+
+    def finish(self, proc: subprocess.Popen, check: bool = True):
+        """ Wait for a process from start to exit, record its resource use,
+        and raise OSError if check and it failed. """
+        if proc.returncode is None:
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            cpu_secs = usage.ru_utime + usage.ru_stime
+            max_rss_kib = usage.ru_maxrss
+        else:
+            # Already reaped by subprocess, so its usage is unknown.
+            cpu_secs = float("nan")
+            max_rss_kib = 0
+        wall_secs = time.perf_counter() - proc.start_time
+        log = proc.log
+        result = CmdResult(shlex.join(proc.args), proc.returncode, wall_secs,
+                           cpu_secs, max_rss_kib,
+                           log.name if log is not None else None)
+        if log is not None:
+            log.write(f"# {result}\n".encode())
+            log.close()
+        self.results.append(result)
+        logging.debug(str(result))
+        if check and proc.returncode:
+            msg = (f"Command '{result.cmd}' returned exit code "
+                   f"{proc.returncode}")
+            if log is not None:
+                msg += f" (see {log.name})"
+            raise OSError(msg)
+        return result
+
+    def _timer(self, procs: List[subprocess.Popen], timeout: float | None):
+        """ Return a started timer that kills procs after timeout. """
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return None
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            for proc in procs:
+                proc.kill()
+
+        timer = threading.Timer(timeout, kill)
+        timer.timed_out = timed_out
+        timer.start()
+        return timer
+
+    @staticmethod
+    def _check_timer(timer: threading.Timer | None, args, timeout):
+        if timer is not None:
+            timer.cancel()
+            if timer.timed_out.is_set():
+                raise subprocess.TimeoutExpired(args, timer.interval)
+
+    def run(self, args: List[Any],
+            log_dir: str | os.PathLike | None = None,
+            timeout: float | None = None,
+            **kwargs):
+        """ Run a command to completion and return its CmdResult; raise
+        OSError if it fails or TimeoutExpired if it times out. """
+        with self._jobs:
+            proc = self.start(args, log_dir, **kwargs)
+            timer = self._timer([proc], timeout)
+            try:
+                result = self.finish(proc, check=False)
+            except BaseException:
+                proc.kill()
+                self.finish(proc, check=False)
+                raise
+            finally:
+                self._check_timer(timer, proc.args, timeout)
+            if result.returncode:
+                raise OSError(f"Command '{result.cmd}' returned exit code "
+                              f"{result.returncode}"
+                              + (f" (see {result.log})" if result.log
+                                 else ""))
+            return result
+
+    def iter_stdout(self, args: List[Any],
+                    log_dir: str | os.PathLike | None = None,
+                    timeout: float | None = None,
+                    **kwargs):
+        """ Run a command and yield each line (as bytes) that it writes to
+        standard output, without buffering the whole output in memory; when
+        the output ends, record its CmdResult and raise OSError if it failed
+        or TimeoutExpired if it timed out. A command whose output is not
+        read to the end (e.g. the generator is closed) is killed. """
+        with self._jobs:
+            proc = self.start(args, log_dir, stdout=subprocess.PIPE, **kwargs)
+            timer = self._timer([proc], timeout)
+            try:
+                with proc.stdout:
+                    yield from proc.stdout
+            except BaseException:
+                proc.kill()
+                raise
+            finally:
+                result = self.finish(proc, check=False)
+                self._check_timer(timer, proc.args, timeout)
+            if result.returncode:
+                raise OSError(f"Command '{result.cmd}' returned exit code "
+                              f"{result.returncode}"
+                              + (f" (see {result.log})" if result.log
+                                 else ""))
+
+    def run_pipeline(self,
+                     upstream: List[List[Any]],
+                     through: Callable[[BinaryIO, BinaryIO], Any],
+                     downstream: List[Any],
+                     log_dir: str | os.PathLike | None = None,
+                     timeout: float | None = None):
+        """
+        Run a pipeline of commands connected by OS pipes without writing any
+        intermediate file: each command in upstream writes to standard input
+        of the next; the standard output of the last is passed through the
+        function through(stdin, stdout) in this process, which writes to
+        standard input of the command downstream. Raise OSError if any
+        command fails.
+        """
+        with self._jobs:
+            procs: List[subprocess.Popen] = list()
+            timer = self._timer(procs, timeout)
+            try:
+                stdin = None
+                for args in upstream:
+                    proc = self.start(args, log_dir, stdin=stdin,
+                                      stdout=subprocess.PIPE)
+                    if stdin is not None:
+                        # Close this process's copy of the pipe so that the
+                        # command upstream gets SIGPIPE if the one downstream
+                        # exits early.
+                        stdin.close()
+                    procs.append(proc)
+                    stdin = proc.stdout
+                last = self.start(downstream, log_dir, stdin=subprocess.PIPE)
+                procs.append(last)
+                with stdin, last.stdin:
+                    through(stdin, last.stdin)
+            except BaseException:
+                for proc in procs:
+                    proc.kill()
+                raise
+            finally:
+                results = [self.finish(proc, check=False) for proc in procs]
+                self._check_timer(timer, [proc.args for proc in procs],
+                                  timeout)
+            for result in results:
+                if result.returncode:
+                    raise OSError(f"Command '{result.cmd}' returned exit code "
+                                  f"{result.returncode}")
+            return results
+
+
 def run_cmd(args: List[Any], shell: bool = False):
-    args_str = tuple(map(str, args))
-    # FIXME: decide on either subprocess or os.system
-    #subprocess.run(args_str, check=True, shell=shell)
-    #cmd = shlex.join(args)
-    cmd = ' '.join(args_str)
-    excode = os.system(cmd)
-    if excode:
-        raise OSError(f"Command '{cmd}' returned exit code {excode}")
-    return cmd
+    """ Run a command (without a shell unless shell, in which case the
+    arguments are joined into one command for sh) and return it as a
+    string; raise OSError if it fails. """
+    if shell:
+        cmd = " ".join(map(str, args))
+        CmdExecutor().run(["sh", "-c", cmd])
+        return cmd
+    return CmdExecutor().run(args).cmd
+
+
+def iter_cmd_stdout(args: List[Any],
+                    log_dir: str | os.PathLike | None = None,
+                    timeout: float | None = None):
+    """ Yield each line of standard output of a command (see
+    CmdExecutor.iter_stdout). """
+    return CmdExecutor().iter_stdout(args, log_dir, timeout)
+
+
+def run_pipeline(upstream: List[List[Any]],
+                 through: Callable[[BinaryIO, BinaryIO], Any],
+                 downstream: List[Any]):
+    """ Run a pipeline (see CmdExecutor.run_pipeline) without logs. """
+    return CmdExecutor().run_pipeline(upstream, through, downstream)
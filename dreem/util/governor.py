@@ -0,0 +1,134 @@
+"""
+Resource governor of DREEM
+
+One budget of CPU cores and memory, set by --max-cpus and --max-mem, from
+which every stage reserves what it needs before it launches external
+commands or worker processes, so that the stages, samples, and references
+that run at once do not oversubscribe the machine. A process that starts
+workers gives each a share of its budget (see ResourceGovernor.share).
+"""
+
+from contextlib import contextmanager
+import logging
+import threading
+
+import psutil
+
+from dreem.util.dflt import NUM_PROCESSES
+
+
+# Fraction of the total memory to leave available to the system
+MIN_FREE_MEM_FRAC = 0.05
+# Seconds to wait between checks of the memory while backing off
+MEM_POLL_SECS = 1.0
+# Bytes per GiB (the unit of --max-mem)
+GIB = 2 ** 30
+
+
+class ResourceGovernor(object):
+    """
+    Budget of CPU cores and memory shared by the threads of one process.
+
+    Arguments
+    max_cpus (int): number of CPU cores that all work may use at once
+    max_mem (int):  number of bytes of memory that all work may use at
+                    once, or 0 for no limit besides the available memory
+    """
+
+    __slots__ = ["max_cpus", "max_mem", "_free_cpus", "_free_mem", "_cond"]
+
+    def __init__(self, max_cpus: int = NUM_PROCESSES, max_mem: int = 0):
+        if max_cpus < 1:
+            raise ValueError(f"max_cpus must be >= 1, but got {max_cpus}")
+        if max_mem < 0:
+            raise ValueError(f"max_mem must be >= 0, but got {max_mem}")
+        self.max_cpus = max_cpus
+        self.max_mem = max_mem
+        self._free_cpus = max_cpus
+        self._free_mem = max_mem
+        self._cond = threading.Condition()
+
+    def __getstate__(self):
+        # A copy in another process gets the whole budget, not what is left
+        # of it in this process.
+        return self.max_cpus, self.max_mem
+
+    def __setstate__(self, state: tuple[int, int]):
+        self.__init__(*state)
+
+    def share(self, n_procs: int):
+        """ Return the budget of each of n_procs worker processes that run
+        at once, which together use no more than this budget. """
+        n_procs = max(1, n_procs)
+        return self.__class__(max(1, self.max_cpus // n_procs),
+                              self.max_mem // n_procs)
+
+    def mem_available(self):
+        """ Return the number of bytes of memory that work may use now:
+        the memory available to the system (minus a reserve), and no more
+        than the memory left in the budget, if it is limited. """
+        vmem = psutil.virtual_memory()
+        avail = max(0, vmem.available - int(vmem.total * MIN_FREE_MEM_FRAC))
+        return min(avail, self._free_mem) if self.max_mem else avail
+
+    def _can_start(self, cpus: int, mem: int):
+        if self._free_cpus < cpus:
+            return False
+        if self.max_mem and self._free_mem < mem:
+            return False
+        if mem and mem > self.mem_available():
+            # Back off under memory pressure, unless nothing else in this
+            # budget is running, in which case waiting would not help.
+            return (self._free_cpus == self.max_cpus
+                    and self._free_mem == self.max_mem)
+        return True
+
+    @contextmanager
+    def reserve(self, cpus: int = 1, mem: int = 0):
+        """
+        Wait until cpus cores and mem bytes of memory are free in the budget
+        (and, if mem > 0, available in the system), hold them until the
+        context exits, and yield the number of cores reserved. Requests for
+        more than the whole budget are reduced to the whole budget.
+        """
+        cpus = max(1, min(cpus, self.max_cpus))
+        if self.max_mem:
+            mem = min(mem, self.max_mem)
+        with self._cond:
+            backed_off = False
+            while not self._can_start(cpus, mem):
+                if not backed_off and self._free_cpus >= cpus:
+                    logging.info(f"Waiting for {mem} bytes of memory")
+                    backed_off = True
+                self._cond.wait(MEM_POLL_SECS)
+            self._free_cpus -= cpus
+            self._free_mem -= mem
+        try:
+            yield cpus
+        finally:
+            with self._cond:
+                self._free_cpus += cpus
+                self._free_mem += mem
+                self._cond.notify_all()
+
+
+_governor = ResourceGovernor()
+
+
+def get_governor():
+    """ Return the resource governor of this process. """
+    return _governor
+
+
+def set_governor(governor: ResourceGovernor):
+    """ Set the resource governor of this process (e.g. as the initializer
+    of a worker process, with a share of its parent's budget). """
+    global _governor
+    _governor = governor
+    return governor
+
+
+def configure(max_cpus: int = NUM_PROCESSES, max_mem: float = 0.0):
+    """ Set the resource governor of this process from --max-cpus and
+    --max-mem (in GiB, or 0 for no limit). """
+    return set_governor(ResourceGovernor(max_cpus, int(max_mem * GIB)))
@@ -166,6 +166,8 @@ Subclass of ExtenSeg    Also subclass of
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 MutVectorBatchSeg       -
 MutVectorReportSeg	    RegionSeg
+MutVectorSlowReadsSeg   RegionSeg
+MutVectorReadNamesSeg   RegionSeg
 XamSeg                  -
     XamMixedSeg         RefsetSeg
     XamSplitSeg         RefSeg
@@ -193,12 +195,15 @@ Implementation of path and path segment classes as Pydantic models
 # Imports ######################################################################
 
 from __future__ import annotations
+from contextlib import contextmanager
 from functools import cache
+import hashlib
 from inspect import getmembers, isclass, signature
 import itertools
 import os
 from pathlib import Path
 import re
+import shutil
 from string import ascii_letters, digits
 import sys
 from typing import Any, ClassVar, Iterable
@@ -231,12 +236,13 @@ MOD_AGG = "aggregation"
 MODULES = (MOD_DMX, MOD_ALN, MOD_VEC, MOD_CLS, MOD_AGG)
 
 # Alignment steps
+ALN_SHARD = "align_0_shard"
 ALN_TRIM = "align_1_trim"
 ALN_ALIGN = "align_2_align"
 ALN_REM = "align_3_rem"
 ALN_SORT = "align_4_sort"
 ALN_SPLIT = "align_5_split"
-ALN_STEPS = (ALN_TRIM, ALN_ALIGN, ALN_REM, ALN_SORT, ALN_SPLIT)
+ALN_STEPS = (ALN_SHARD, ALN_TRIM, ALN_ALIGN, ALN_REM, ALN_SORT, ALN_SPLIT)
 
 # Vectoring steps
 VEC_SELECT = "vector_1_select"
@@ -263,12 +269,21 @@ BAM_EXT = ".bam"
 CRAM_EXT = ".cram"
 XAM_EXTS = (SAM_EXT, BAM_EXT, CRAM_EXT)
 BAI_EXT = f"{BAM_EXT}.bai"
-XAI_EXTS = (BAI_EXT,)
+CRAI_EXT = f"{CRAM_EXT}.crai"
+XAI_EXTS = (BAI_EXT, CRAI_EXT)
 XAMI_EXTS = XAM_EXTS + XAI_EXTS
+ORC_EXT = ".orc"
+MUT_COUNTS_EXT = ".counts.npz"
+READ_NAMES_EXT = ".names.npz"
+READ_NAMES_LOOKUP_EXT = ".lookup.npz"
 
 VALID_CHARS_MAP = {TOP_KEY: VALID_CHARS_TOP,
                    EXT_KEY: VALID_CHARS_EXT}
 
+# Scratch space
+SCRATCH_PREFIX = "dreem-"
+SCRATCH_MARGIN = 1.2
+
 
 # Path functions ###############################################################
 
@@ -361,6 +376,10 @@ class PathOrderError(PathError):
     pass
 
 
+class ScratchSpaceError(OSError):
+    """ The scratch space has too little free space for a step. """
+
+
 # Path segment classes #########################################################
 
 class BaseSeg(BaseModel):
@@ -445,7 +464,7 @@ class SubSeg(BaseSeg):
     def fields_must_contain_only_valid_characters(cls, values: dict[str, Any]):
         """ Validate that all fields contain no invalid field characters. """
         for key, value in values.items():
-            if set(value) - VALID_CHARS_MAP.get(key, VALID_CHARS_SET):
+            if set(str(value)) - VALID_CHARS_MAP.get(key, VALID_CHARS_SET):
                 raise FieldContainsIllegalCharacterError(key, value)
         return values
 
@@ -740,11 +759,27 @@ class MutVectorReportFileSeg(FileSeg, RegionSeg):
     exts = (".txt",)
 
 
+class MutVectorSlowReadsFileSeg(FileSeg, RegionSeg):
+    """ Segment for a table of the reads that were slowest to vectorize. """
+    format_str = "{}-{}_slow_reads{}"
+    pattern_str = f"([0-9]+)-([0-9]+)_slow_reads{EXT_PATTERN}"
+    exts = (".txt",)
+
+
+class MutVectorReadNamesFileSeg(FileSeg, RegionSeg):
+    """ Segment for a table of the names of the reads of a mutational
+    profile, looked up by the hashes of the names. """
+    format_str = "{}-{}_read_names{}"
+    pattern_str = f"([0-9]+)-([0-9]+)_read_names{EXT_PATTERN}"
+    exts = (".npz",)
+
+
 class MutVectorBatchFileSeg(FileSeg, BatchSeg):
-    """ Segment for a mutation vector batch file. """
+    """ Segment for a mutation vector batch file (.orc) or its sidecar of
+    per-position counts of every byte value (.counts.npz). """
     format_str = "vectors_{}{}"
     pattern_str = "vectors_([0-9]+)" + EXT_PATTERN
-    exts = (".orc",)
+    exts = (ORC_EXT, MUT_COUNTS_EXT, READ_NAMES_EXT, READ_NAMES_LOOKUP_EXT)
 
 
 class AbstractRefFileSeg(FileSeg):
@@ -812,7 +847,7 @@ class DemultReads2FileSeg(AbstractReads2FileSeg, OneRefSeg):
 
 class AbstractAlignmentFileSeg(FileSeg):
     """ Segment representing both alignment map files (.sam, .bam, .cram)
-    and index files (.bam.bai) """
+    and index files (.bam.bai, .cram.crai) """
     exts = XAMI_EXTS
 
 
@@ -1186,6 +1221,14 @@ class MutVectorReportFilePath(MutVectorReportFileSeg, RefOutDirPath):
     pass
 
 
+class MutVectorSlowReadsFilePath(MutVectorSlowReadsFileSeg, RefOutDirPath):
+    pass
+
+
+class MutVectorReadNamesFilePath(MutVectorReadNamesFileSeg, RefOutDirPath):
+    pass
+
+
 # Path managing functions ######################################################
 
 def is_path_class(item: type):
@@ -1413,3 +1456,88 @@ class AlignmentTempToAlignmentOut(PathTypeMapper):
 AlignmentInToAlignmentOut = PathTypeMapper.chain("AlignmentInToAlignmentOut",
                                                  AlignmentInToAlignmentTemp,
                                                  AlignmentTempToAlignmentOut)
+
+
+# Scratch space ################################################################
+
+class Scratch(object):
+    """
+    Policy for temporary files: where they are written, whether there is
+    room for them before each step, and whether they are kept afterwards.
+
+    Temporary files go in the 'temp' partition of a top-level directory:
+    by default, that of the outputs; if a scratch root is given (e.g. a
+    local disk or tmpfs in $TMPDIR), then a directory in the scratch root
+    named after the top-level directory of the outputs, so that different
+    runs sharing one scratch root do not collide.
+    """
+
+    def __init__(self, root: str = "", keep: bool = False,
+                 margin: float = SCRATCH_MARGIN):
+        """
+        Parameters
+        ----------
+        root: str
+            Directory in which to write temporary files; '' to write them
+            in the top-level directory of the outputs.
+        keep: bool
+            Whether to keep temporary files instead of deleting each once
+            it is no longer needed.
+        margin: float
+            Factor by which to inflate estimated sizes of temporary files
+            when checking for free space.
+        """
+        self.root = root
+        self.keep = keep
+        self.margin = margin
+
+    def top_dir(self, out_dir: TopDirPath):
+        """ Return the top-level directory of the temporary files of the
+        outputs in out_dir (created if it does not exist). """
+        if not self.root:
+            return out_dir
+        digest = hashlib.sha1(sanitize(out_dir.top).encode()).hexdigest()
+        top = os.path.join(self.root, f"{SCRATCH_PREFIX}"
+                                      f"{os.path.basename(out_dir.top)}-"
+                                      f"{digest[:12]}")
+        os.makedirs(top, exist_ok=True)
+        return TopDirPath(top=top)
+
+    def check_free(self, top_dir: TopDirPath, n_bytes: int, what: str):
+        """ Raise ScratchSpaceError if the file system of top_dir has less
+        free space than about n_bytes (inflated by the margin) for what. """
+        need = int(n_bytes * self.margin)
+        free = shutil.disk_usage(top_dir.top).free
+        if need > free:
+            raise ScratchSpaceError(f"{what} needs about {need} bytes in "
+                                    f"{top_dir.top}, but only {free} bytes "
+                                    f"are free; free some space or choose "
+                                    f"another scratch directory")
+
+    @contextmanager
+    def step(self, step: Any, n_bytes: int):
+        """
+        Check that there is room for about n_bytes of temporary files before
+        running a step, and delete its output if it fails, so that a failed
+        step leaves no half-written files.
+
+        Parameters
+        ----------
+        step: Any
+            Step with a top-level directory (attribute 'top'), a name
+            (attribute 'step'), and a method 'clean' that deletes its output
+            (e.g. a step of the align module).
+        n_bytes: int
+            Estimated size of the temporary files the step writes.
+        """
+        self.check_free(step.top, n_bytes, f"Step '{step.step}'")
+        try:
+            yield
+        except BaseException:
+            step.clean()
+            raise
+
+    def clean(self, step: Any):
+        """ Delete the output of a step unless temporary files are kept. """
+        if not self.keep:
+            step.clean()
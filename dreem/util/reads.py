@@ -1,23 +1,37 @@
 from abc import ABC, abstractmethod
-from collections import namedtuple
+from collections import deque, namedtuple
+import contextlib
+from contextlib import contextmanager
+import fcntl
+import gzip
+import hashlib
 import itertools
 import logging
+import multiprocessing
 import os
+import pathlib
 import re
-from functools import cached_property
+import shutil
+import subprocess
+import tempfile
+import threading
+from functools import cached_property, partial
 from typing import BinaryIO
 
+import numpy as np
+
 from dreem.util import path
 from dreem.util.cli import DEFAULT_LOCAL, DEFAULT_UNALIGNED, DEFAULT_DISCORDANT, DEFAULT_MIXED, DEFAULT_DOVETAIL, \
     DEFAULT_CONTAIN, DEFAULT_FRAG_LEN_MIN, DEFAULT_FRAG_LEN_MAX, DEFAULT_N_CEILING, DEFAULT_SEED_INTERVAL, \
     DEFAULT_GAP_BAR, DEFAULT_SEED_SIZE, DEFAULT_EXTENSIONS, DEFAULT_RESEED, DEFAULT_PADDING, DEFAULT_ALIGN_THREADS, \
-    MATCH_BONUS, MISMATCH_PENALTY, N_PENALTY, REF_GAP_PENALTY, READ_GAP_PENALTY, IGNORE_QUALS
+    MATCH_BONUS, MISMATCH_PENALTY, N_PENALTY, REF_GAP_PENALTY, READ_GAP_PENALTY, IGNORE_QUALS, DEFAULT_MIN_MAPQ
 from dreem.util.cli import DEFAULT_MIN_BASE_QUALITY, DEFAULT_ILLUMINA_ADAPTER, DEFAULT_MIN_OVERLAP, DEFAULT_MAX_ERROR, \
     DEFAULT_INDELS, DEFAULT_NEXTSEQ_TRIM, DEFAULT_DISCARD_TRIMMED, DEFAULT_DISCARD_UNTRIMMED, DEFAULT_MIN_LENGTH, \
     DEFAULT_SCORE_MIN
-from dreem.util.dflt import BUFFER_LENGTH, NUM_PROCESSES
+from dreem.util.cli import DEFAULT_COMPRESS_LEVEL, DEFAULT_SAMTOOLS_THREADS, DEFAULT_BT2_MM
 from dreem.util.excmd import FASTQC_CMD, CUTADAPT_CMD, BOWTIE2_CMD, \
-    BOWTIE2_BUILD_CMD, SAMTOOLS_CMD, run_cmd
+    BOWTIE2_BUILD_CMD, SAMTOOLS_CMD, CmdExecutor
+from dreem.util.governor import get_governor
 from dreem.util.seq import FastaParser
 
 # General parameters
@@ -25,8 +39,13 @@ DEFAULT_INTERLEAVED = False
 SAM_HEADER = b"@"
 SAM_ALIGN_SCORE = b"AS:i:"
 SAM_EXTRA_SCORE = b"XS:i:"
+SAM_UNMAPPED_REF = b"*"
 FASTQ_REC_LENGTH = 4
-DEFAULT_MIN_MAPQ = 30
+FASTQ_CHUNK_SIZE = 2 ** 22  # bytes of FASTQ to read at a time
+SHARD_BLOCK_RECORDS = 2 ** 16  # records dealt to each shard at a time
+GZ_EXT = ".gz"
+SAM_CHUNK_SIZE = 2 ** 20  # bytes of SAM lines to process at a time
+MAX_SPLIT_WRITERS = 8  # samtools processes writing split files at once
 
 # FastQC parameters
 DEFAULT_EXTRACT = False
@@ -126,6 +145,12 @@ class FastqUnit(object):
             return "--interleaved",
         return "-U",
 
+    @property
+    def bowtie2_stdin_args(self):
+        """ Arguments for bowtie2 to read these reads from standard input,
+        to which the mates of paired-end reads must be interleaved. """
+        return ("--interleaved", "-") if self.paired else ("-U", "-")
+
     @property
     def bowtie2_inputs(self):
         return tuple(itertools.chain(*map(list, zip(self._bowtie2_flags,
@@ -276,8 +301,10 @@ class ReadsFileBase(ABC):
     step = ""
     ext = ""
 
-    def __init__(self, top_dir: path.TopDirPath) -> None:
+    def __init__(self, top_dir: path.TopDirPath,
+                 executor: CmdExecutor | None = None) -> None:
         self.top = top_dir
+        self.executor = executor if executor is not None else CmdExecutor()
 
     @property
     @abstractmethod
@@ -305,6 +332,19 @@ class ReadsFileBase(ABC):
     def output(self):
         raise NotImplementedError
 
+    @cached_property
+    def log_dir(self):
+        """ Directory of the logs of the commands that this step runs. """
+        return path.SampleTempDirPath(top=self.top.top,
+                                      partition=path.TEMP_DIR,
+                                      module=self.module,
+                                      sample=self.sample,
+                                      step=self.step).path
+
+    def _run_cmd(self, args: list, **kwargs):
+        """ Run a command through the executor, logging to log_dir. """
+        return self.executor.run(args, self.log_dir, **kwargs)
+
     def setup(self):
         self.output_dir.path.mkdir(parents=True, exist_ok=True)
 
@@ -318,8 +358,9 @@ class ReadsFileBase(ABC):
 
 
 class FastqBase(ReadsFileBase):
-    def __init__(self, top_dir: path.TopDirPath, fastq: FastqUnit):
-        super().__init__(top_dir)
+    def __init__(self, top_dir: path.TopDirPath, fastq: FastqUnit,
+                 executor: CmdExecutor | None = None):
+        super().__init__(top_dir, executor)
         self.fastq = fastq
 
     @property
@@ -335,7 +376,127 @@ class FastqBase(ReadsFileBase):
         if extract:
             cmd.append("--extract")
         cmd.extend(map(str, self.fastq.paths))
-        run_cmd(cmd)
+        self._run_cmd(cmd)
+
+
+def iter_fastq_blocks(fastq: BinaryIO, n_records: int,
+                      lines_per_record: int = FASTQ_REC_LENGTH,
+                      chunk_size: int = FASTQ_CHUNK_SIZE):
+    """
+    Yield (pieces, n_lines) for consecutive blocks of a FASTQ file, where
+    pieces is a list of bytes that together make up exactly n_records whole
+    records (except for the last block, which may have fewer), and n_lines
+    is the number of lines in the block. Raise ValueError if the file ends
+    within a record.
+    """
+    lines_per_block = n_records * lines_per_record
+    pieces: list[bytes] = list()
+    n_lines = 0
+    while data := fastq.read(chunk_size):
+        newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8)
+                                  == ord(b"\n"))
+        start = 0
+        # Index of the newline in data that completes the current block.
+        end_line = lines_per_block - n_lines - 1
+        while end_line < newlines.size:
+            end = int(newlines[end_line]) + 1
+            pieces.append(data[start: end])
+            yield pieces, lines_per_block
+            pieces = list()
+            start = end
+            end_line += lines_per_block
+        n_lines = newlines.size - (end_line - lines_per_block + 1)
+        if start < len(data):
+            pieces.append(data[start:])
+    if pieces:
+        if not pieces[-1].endswith(b"\n"):
+            # The last line of the file has no newline.
+            pieces.append(b"\n")
+            n_lines += 1
+        if n_lines % lines_per_record:
+            raise ValueError(f"FASTQ file ends within a record: got "
+                             f"{n_lines} lines after the last whole block")
+        yield pieces, n_lines
+
+
+class FastqSharder(FastqBase):
+    """
+    Split the FASTQ file(s) of a sample into shards that can be aligned
+    independently: blocks of records are dealt to the shards in turn, with
+    the same blocks of both mate files (or of both mates, if interleaved)
+    going to the same shard, so that the mates of every pair stay together.
+    Each shard is written (uncompressed) in its own top-level directory, so
+    the files of each shard in the steps downstream have distinct paths.
+    """
+    step = path.ALN_SHARD
+
+    def __init__(self, top_dir: path.TopDirPath, fastq: FastqUnit,
+                 n_shards: int, block_records: int = SHARD_BLOCK_RECORDS,
+                 executor: CmdExecutor | None = None):
+        super().__init__(top_dir, fastq, executor)
+        if n_shards < 1:
+            raise ValueError(f"n_shards must be >= 1, but got {n_shards}")
+        self.n_shards = n_shards
+        self.block_records = block_records
+
+    @cached_property
+    def shard_tops(self):
+        """ Top-level directory of each shard (created, since a top-level
+        directory must exist). """
+        tops = list()
+        for i in range(self.n_shards):
+            top = self.output_dir.path.joinpath(f"shard{i}")
+            top.mkdir(parents=True, exist_ok=True)
+            tops.append(path.TopDirPath(top=str(top)))
+        return tuple(tops)
+
+    @cached_property
+    def output(self):
+        """ FASTQ file(s) of each shard. """
+        return tuple(FastqUnit(tuple(fq.replace(top=shard.top,
+                                                ext=fq.ext.removesuffix(GZ_EXT))
+                                     for fq in self.fastq.paths),
+                               self.fastq.interleaved,
+                               self.fastq.phred_enc)
+                     for shard in self.shard_tops)
+
+    @staticmethod
+    def _open(fq: path.BasePath):
+        if str(fq).endswith(GZ_EXT):
+            return gzip.open(fq.path, "rb")
+        return open(fq.path, "rb")
+
+    def _shard(self):
+        # Records of interleaved paired-end reads are dealt in pairs.
+        lines_per_record = FASTQ_REC_LENGTH * (2 if self.fastq.interleaved
+                                               else 1)
+        with contextlib.ExitStack() as stack:
+            inputs = [iter_fastq_blocks(stack.enter_context(self._open(fq)),
+                                        self.block_records, lines_per_record)
+                      for fq in self.fastq.paths]
+            outputs = list()
+            for unit in self.output:
+                for fq in unit.paths:
+                    fq.path.parent.mkdir(parents=True, exist_ok=True)
+                outputs.append([stack.enter_context(open(fq.path, "wb"))
+                                for fq in unit.paths])
+            for i, blocks in enumerate(itertools.zip_longest(*inputs)):
+                if None in blocks or len({n for _, n in blocks}) > 1:
+                    raise ValueError(f"Mate files {self.fastq.paths} have "
+                                     f"different numbers of records")
+                for (pieces, _), out in zip(blocks, outputs[i % self.n_shards],
+                                            strict=True):
+                    out.writelines(pieces)
+        return self.output
+
+    def run(self):
+        logging.info(f"\nSplitting {self.fastq.paths} into {self.n_shards} "
+                     f"shards\n")
+        self.setup()
+        return self._shard()
+
+    def clean(self):
+        shutil.rmtree(self.output_dir.path, ignore_errors=True)
 
 
 class FastqTrimmer(FastqBase):
@@ -364,22 +525,26 @@ class FastqTrimmer(FastqBase):
                                           self._output_fastqs,
                                           strict=False)))
 
-    def _cutadapt(self,
-                  qual1: int = DEFAULT_MIN_BASE_QUALITY,
-                  qual2: int = 0,
-                  adapters15: tuple[str] = (),
-                  adapters13: tuple[str] = (DEFAULT_ILLUMINA_ADAPTER,),
-                  adapters25: tuple[str] = (),
-                  adapters23: tuple[str] = (DEFAULT_ILLUMINA_ADAPTER,),
-                  min_overlap: int = DEFAULT_MIN_OVERLAP,
-                  max_error: float = DEFAULT_MAX_ERROR,
-                  indels: bool = DEFAULT_INDELS,
-                  nextseq_trim: bool = DEFAULT_NEXTSEQ_TRIM,
-                  discard_trimmed: bool = DEFAULT_DISCARD_TRIMMED,
-                  discard_untrimmed: bool = DEFAULT_DISCARD_UNTRIMMED,
-                  min_length: bool = DEFAULT_MIN_LENGTH,
-                  cores: int = NUM_PROCESSES):
+    def _cutadapt_cmd(self,
+                      stdout: bool = False,
+                      qual1: int = DEFAULT_MIN_BASE_QUALITY,
+                      qual2: int = 0,
+                      adapters15: tuple[str] = (),
+                      adapters13: tuple[str] = (DEFAULT_ILLUMINA_ADAPTER,),
+                      adapters25: tuple[str] = (),
+                      adapters23: tuple[str] = (DEFAULT_ILLUMINA_ADAPTER,),
+                      min_overlap: int = DEFAULT_MIN_OVERLAP,
+                      max_error: float = DEFAULT_MAX_ERROR,
+                      indels: bool = DEFAULT_INDELS,
+                      nextseq_trim: bool = DEFAULT_NEXTSEQ_TRIM,
+                      discard_trimmed: bool = DEFAULT_DISCARD_TRIMMED,
+                      discard_untrimmed: bool = DEFAULT_DISCARD_UNTRIMMED,
+                      min_length: bool = DEFAULT_MIN_LENGTH,
+                      cores: int | None = None):
         cmd = [CUTADAPT_CMD]
+        if cores is None:
+            # Never more than the budget of the resource governor.
+            cores = get_governor().max_cpus
         if cores >= 0:
             cmd.extend(["--cores", cores])
         if nextseq_trim:
@@ -411,29 +576,203 @@ class FastqTrimmer(FastqBase):
         cmd.extend(["--report", "minimal"])
         if self.fastq.interleaved:
             cmd.append("--interleaved")
-        cmd.extend(self._cutadapt_output_args)
+        if stdout:
+            # Write the trimmed reads to standard output (with the mates of
+            # paired-end reads interleaved) instead of to FASTQ files; the
+            # report then goes to standard error.
+            if self.fastq.paired and not self.fastq.interleaved:
+                cmd.append("--interleaved")
+            cmd.extend(["-o", "-"])
+        else:
+            cmd.extend(self._cutadapt_output_args)
         cmd.extend(self.fastq.cutadapt_input_args)
-        run_cmd(cmd)
+        return cmd
+
+    def _cutadapt(self, **kwargs):
+        self._run_cmd(self._cutadapt_cmd(**kwargs))
         return self.output
 
-    def run(self, **kwargs):
+    def run(self, cores: int | None = None, **kwargs):
         self.setup()
-        return self._cutadapt(**kwargs)
+        if cores is not None:
+            # The caller has reserved the cores from the resource governor.
+            return self._cutadapt(cores=cores, **kwargs)
+        governor = get_governor()
+        with governor.reserve(governor.max_cpus) as cores:
+            return self._cutadapt(cores=cores, **kwargs)
 
     def clean(self):
         for out_path in self.output.paths:
-            out_path.path.unlink()
+            out_path.path.unlink(missing_ok=True)
+
+
+class Bowtie2IndexCache(object):
+    """
+    Persistent cache of Bowtie 2 indexes. Each index is kept in a directory
+    named after the checksum of the contents of its FASTA file and of the
+    options with which it was built, so every reference is indexed only once
+    no matter how many samples (or runs) are aligned to it, and an index is
+    never reused after its FASTA file changes. Indexes are built in a
+    temporary directory and renamed into place once complete, so any index
+    in the cache is valid; a lock file ensures that concurrent processes that
+    need the same index wait for one of them to build it.
+
+    Arguments
+    cache_dir (str):            directory of the cache (created if needed)
+    build_opts (tuple[str]):    extra options for bowtie2-build that change
+                                the index
+    """
+
+    __slots__ = ["cache_dir", "build_opts", "executor"]
+
+    INDEX_NAME = "index"
+    INDEX_EXTS = (".1", ".2", ".3", ".4", ".rev.1", ".rev.2")
+    # Small indexes end in .bt2, and large (> 4 Gb) indexes in .bt2l.
+    INDEX_SUFFIXES = (".bt2", ".bt2l")
+    # File systems whose pages are not shared through the local page cache
+    # of one node, so that memory-mapping an index on them saves no RAM.
+    NETWORK_FS_TYPES = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "afs",
+                        "9p", "fuse.sshfs", "lustre", "gpfs", "beegfs")
+    MOUNTS_FILE = "/proc/mounts"
+
+    def __init__(self, cache_dir: str | os.PathLike,
+                 build_opts: tuple[str, ...] = (),
+                 executor: CmdExecutor | None = None):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.build_opts = tuple(map(str, build_opts))
+        self.executor = executor if executor is not None else CmdExecutor()
+
+    def get_key(self, fasta: str | os.PathLike):
+        """ Return the checksum of a FASTA file and the build options. """
+        with open(fasta, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256")
+        digest.update("\0".join(self.build_opts).encode())
+        return digest.hexdigest()
+
+    @classmethod
+    def is_complete(cls, prefix: pathlib.Path):
+        """ Return whether every file of the index with the prefix exists. """
+        return any(all(prefix.with_name(f"{prefix.name}{ext}{suffix}").is_file()
+                       for ext in cls.INDEX_EXTS)
+                   for suffix in cls.INDEX_SUFFIXES)
+
+    def _build(self, fasta: str | os.PathLike, index_dir: pathlib.Path):
+        temp_dir = pathlib.Path(tempfile.mkdtemp(prefix=f"{index_dir.name}.",
+                                                 dir=self.cache_dir))
+        try:
+            self.executor.run([BOWTIE2_BUILD_CMD, "-q", *self.build_opts,
+                               fasta, temp_dir.joinpath(self.INDEX_NAME)],
+                              temp_dir)
+            if index_dir.exists():
+                # Remove an incomplete index, e.g. one with missing files.
+                shutil.rmtree(index_dir)
+            temp_dir.rename(index_dir)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def get_prefix(self, fasta: str | os.PathLike):
+        """ Return the prefix of the index of a FASTA file (to be given to
+        bowtie2 -x), building the index only if it is not in the cache. """
+        key = self.get_key(fasta)
+        index_dir = self.cache_dir.joinpath(key)
+        prefix = index_dir.joinpath(self.INDEX_NAME)
+        if not self.is_complete(prefix):
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.cache_dir.joinpath(f"{key}.lock"), "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Another process may have built the index while this one
+                # was waiting for the lock.
+                if not self.is_complete(prefix):
+                    logging.info(f"Building Bowtie 2 index of {fasta} in "
+                                 f"{index_dir}")
+                    self._build(fasta, index_dir)
+        return prefix
+
+    @classmethod
+    def index_size(cls, prefix: pathlib.Path):
+        """ Return the number of bytes in the files of an index. """
+        return sum(file.stat().st_size
+                   for file in prefix.parent.glob(f"{prefix.name}.*"))
+
+    def fs_type(self):
+        """ Return the type of the file system of the cache (as listed in
+        /proc/mounts), or '' if it cannot be determined. """
+        cache_dir = os.path.realpath(self.cache_dir)
+        fs_type = ""
+        mount_len = -1
+        try:
+            with open(self.MOUNTS_FILE) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 3:
+                        continue
+                    # Use the deepest mount point containing the cache.
+                    mount = fields[1]
+                    if (len(mount) > mount_len
+                            and os.path.commonpath([mount, cache_dir]) == mount):
+                        fs_type = fields[2]
+                        mount_len = len(mount)
+        except OSError:
+            return ""
+        return fs_type
+
+    def check_shareable(self):
+        """ Warn if memory-mapped indexes in the cache cannot share pages
+        between processes (i.e. the cache is on a network file system). """
+        if (fs_type := self.fs_type()) in self.NETWORK_FS_TYPES:
+            logging.warning(f"Index cache {self.cache_dir} is on a network "
+                            f"file system ({fs_type}), so processes that "
+                            f"memory-map the same index may not share it; "
+                            f"use an index cache on a local disk instead")
+
+    @contextmanager
+    def sharing(self, prefix: pathlib.Path):
+        """
+        Register this process as memory-mapping the index with the prefix
+        while in the context, with one file per process in a directory next
+        to the index, and yield a function that returns how many processes
+        (including this one) are mapping the index at the time.
+        """
+        users_dir = prefix.parent.with_name(f"{prefix.parent.name}.users")
+        users_dir.mkdir(parents=True, exist_ok=True)
+        user = users_dir.joinpath(str(os.getpid()))
+        user.touch()
+
+        def count_users():
+            count = 0
+            for file in users_dir.iterdir():
+                try:
+                    os.kill(int(file.name), 0)
+                except ProcessLookupError:
+                    # The process exited without unregistering.
+                    file.unlink(missing_ok=True)
+                except PermissionError:
+                    count += 1
+                except ValueError:
+                    continue
+                else:
+                    count += 1
+            return count
+
+        try:
+            yield count_users
+        finally:
+            user.unlink(missing_ok=True)
 
 
 class FastqAligner(FastqBase):
     step = path.ALN_ALIGN
     ext = path.SAM_EXT
+    # Seconds between counts of the alignments sharing a memory-mapped index
+    SHARE_POLL_SECS = 5.
 
     def __init__(self,
                  top_dir: path.TopDirPath,
                  fastq: FastqUnit,
-                 fasta: path.RefsetSeqInFilePath | path.OneRefSeqTempFilePath):
-        super().__init__(top_dir, fastq)
+                 fasta: path.RefsetSeqInFilePath | path.OneRefSeqTempFilePath,
+                 index_cache: Bowtie2IndexCache | None = None,
+                 executor: CmdExecutor | None = None):
+        super().__init__(top_dir, fastq, executor)
         if isinstance(fasta, path.RefsetSeqInFilePath):
             if self.demult:
                 raise TypeError("Got a multi-FASTA but a demultiplexed FASTQ")
@@ -443,6 +782,7 @@ class FastqAligner(FastqBase):
         else:
             raise TypeError(fasta)
         self.fasta = fasta
+        self.index_cache = index_cache
 
     @property
     def fasta_prefix(self):
@@ -470,32 +810,48 @@ class FastqAligner(FastqBase):
         return outputs[0]
 
     def _bowtie2_build(self):
-        """ Build an index of a reference genome using Bowtie 2. """
+        """ Build an index of a reference genome using Bowtie 2, or get it
+        from the index cache, and return the prefix of the index. """
+        if self.index_cache is not None:
+            return self.index_cache.get_prefix(self.fasta.path)
         cmd = [BOWTIE2_BUILD_CMD, "-q", self.fasta, self.fasta_prefix]
-        run_cmd(cmd)
-
-    def _bowtie2(self,
-                 local=DEFAULT_LOCAL,
-                 unaligned=DEFAULT_UNALIGNED,
-                 discordant=DEFAULT_DISCORDANT,
-                 mixed=DEFAULT_MIXED,
-                 dovetail=DEFAULT_DOVETAIL,
-                 contain=DEFAULT_CONTAIN,
-                 score_min=DEFAULT_SCORE_MIN,
-                 frag_len_min=DEFAULT_FRAG_LEN_MIN,
-                 frag_len_max=DEFAULT_FRAG_LEN_MAX,
-                 n_ceil=DEFAULT_N_CEILING,
-                 gap_bar=DEFAULT_GAP_BAR,
-                 seed_size=DEFAULT_SEED_SIZE,
-                 seed_interval=DEFAULT_SEED_INTERVAL,
-                 extensions=DEFAULT_EXTENSIONS,
-                 reseed=DEFAULT_RESEED,
-                 padding=DEFAULT_PADDING,
-                 threads=DEFAULT_ALIGN_THREADS):
+        self._run_cmd(cmd)
+        return self.fasta_prefix
+
+    def _bowtie2_cmd(self,
+                     index_prefix,
+                     stream: bool = False,
+                     mm: bool = DEFAULT_BT2_MM,
+                     local=DEFAULT_LOCAL,
+                     unaligned=DEFAULT_UNALIGNED,
+                     discordant=DEFAULT_DISCORDANT,
+                     mixed=DEFAULT_MIXED,
+                     dovetail=DEFAULT_DOVETAIL,
+                     contain=DEFAULT_CONTAIN,
+                     score_min=DEFAULT_SCORE_MIN,
+                     frag_len_min=DEFAULT_FRAG_LEN_MIN,
+                     frag_len_max=DEFAULT_FRAG_LEN_MAX,
+                     n_ceil=DEFAULT_N_CEILING,
+                     gap_bar=DEFAULT_GAP_BAR,
+                     seed_size=DEFAULT_SEED_SIZE,
+                     seed_interval=DEFAULT_SEED_INTERVAL,
+                     extensions=DEFAULT_EXTENSIONS,
+                     reseed=DEFAULT_RESEED,
+                     padding=DEFAULT_PADDING,
+                     threads=DEFAULT_ALIGN_THREADS):
         cmd = [BOWTIE2_CMD]
-        cmd.extend(self.fastq.bowtie2_inputs)
-        cmd.extend(["-x", self.fasta_prefix])
-        cmd.extend(["-S", self.output])
+        if stream:
+            # Read from standard input and write SAM to standard output.
+            cmd.extend(self.fastq.bowtie2_stdin_args)
+        else:
+            cmd.extend(self.fastq.bowtie2_inputs)
+        cmd.extend(["-x", index_prefix])
+        if mm:
+            # Memory-map the index so that concurrent bowtie2 processes that
+            # use it share its pages in the page cache.
+            cmd.append("--mm")
+        if not stream:
+            cmd.extend(["-S", self.output])
         cmd.append(self.fastq.phred_arg)
         cmd.append("--xeq")
         cmd.extend(["--ma", MATCH_BONUS])
@@ -539,25 +895,148 @@ class FastqAligner(FastqBase):
             cmd.extend(["-p", threads])
         if IGNORE_QUALS:
             cmd.append("--ignore-quals")
-        run_cmd(cmd)
+        return cmd
+
+    @contextmanager
+    def share_index(self, index_prefix, mm: bool = DEFAULT_BT2_MM):
+        """ Context in which to run bowtie2 with the index; if mm (i.e. the
+        index is memory-mapped), log how much RAM sharing it saved. """
+        if not mm:
+            yield
+            return
+        if self.index_cache is None:
+            logging.warning(f"Index {index_prefix} is not in an index cache, "
+                            f"so no other alignment can share it")
+            yield
+            return
+        self.index_cache.check_shareable()
+        with self.index_cache.sharing(index_prefix) as count_users:
+            # Count the alignments sharing the index throughout this one,
+            # not only at its ends, which could miss alignments that start
+            # after it and finish before it.
+            counts = [count_users()]
+            done = threading.Event()
+
+            def poll():
+                while not done.wait(self.SHARE_POLL_SECS):
+                    counts.append(count_users())
+
+            poller = threading.Thread(target=poll, daemon=True)
+            poller.start()
+            try:
+                yield
+            finally:
+                done.set()
+                poller.join()
+            counts.append(count_users())
+        users = max(counts)
+        size = self.index_cache.index_size(index_prefix) / 2 ** 20
+        logging.info(f"Memory-mapped index {index_prefix} ({size:.1f} MiB) "
+                     f"was shared by up to {users} concurrent alignments, "
+                     f"saving about {(users - 1) * size:.1f} MiB of RAM")
+
+    def _bowtie2(self, index_prefix, mm: bool = DEFAULT_BT2_MM, **kwargs):
+        with self.share_index(index_prefix, mm):
+            self._run_cmd(self._bowtie2_cmd(index_prefix, mm=mm, **kwargs))
         return self.output
 
     def run(self, **kwargs):
         self.setup()
-        self._bowtie2_build()
-        return self._bowtie2(**kwargs)
+        return self._bowtie2(self._bowtie2_build(), **kwargs)
 
     def clean(self):
-        self.output.path.unlink()
+        self.output.path.unlink(missing_ok=True)
+
+
+class XamCompression(object):
+    """
+    Compression policy for the alignment map files that samtools writes.
+
+    Arguments
+    level (int):    compression level (0-9) of BAM and CRAM files, or -1 for
+                    the default level of samtools
+    threads (int):  number of additional threads for each samtools command
+    """
+
+    __slots__ = ["level", "threads"]
+
+    FORMATS = {path.SAM_EXT: "sam", path.BAM_EXT: "bam", path.CRAM_EXT: "cram"}
+
+    def __init__(self,
+                 level: int = DEFAULT_COMPRESS_LEVEL,
+                 threads: int = DEFAULT_SAMTOOLS_THREADS):
+        if not -1 <= level <= 9:
+            raise ValueError(f"level must be from -1 to 9, but got {level}")
+        if threads < 0:
+            raise ValueError(f"threads must be >= 0, but got {threads}")
+        self.level = level
+        self.threads = threads
+
+    def thread_args(self):
+        """ Arguments for samtools to use additional threads. """
+        return ["-@", self.threads] if self.threads else []
+
+    def format_args(self, ext: str):
+        """ Arguments for samtools to write a file with an extension. """
+        fmt = self.FORMATS[ext]
+        if self.level >= 0 and ext != path.SAM_EXT:
+            fmt = f"{fmt},level={self.level}"
+        return ["-O", fmt, *self.thread_args()]
+
+
+def get_cram_ref_args(exts: tuple[str, ...],
+                      ref_fasta: path.BasePath | None):
+    """ Return the arguments giving samtools the reference FASTA if any of
+    the files it reads or writes (with extensions exts) is a CRAM file. """
+    if path.CRAM_EXT not in exts:
+        return []
+    if ref_fasta is None:
+        raise ValueError("samtools needs a reference FASTA to read or write "
+                         "CRAM files")
+    return ["--reference", ref_fasta]
 
 
 class XamBase(ReadsFileBase):
     def __init__(self,
                  top_dir: path.TopDirPath,
                  xam: path.RefsetAlignmentInFilePath |
-                      path.OneRefAlignmentInFilePath):
-        super().__init__(top_dir)
+                      path.OneRefAlignmentInFilePath,
+                 *,
+                 ext: str = "",
+                 ref_fasta: path.BasePath | None = None,
+                 compression: XamCompression | None = None,
+                 executor: CmdExecutor | None = None):
+        """
+        ** Arguments **
+        top_dir (TopDirPath) ---------> top-level directory
+        xam (path) -------------------> input alignment map file
+        ext (str) --------------------> extension (i.e. format) of the output
+                                        file, if not the default of the class
+        ref_fasta (path) -------------> FASTA file of the reference(s), which
+                                        samtools needs to read or write CRAM
+        compression (XamCompression) -> compression policy for samtools
+        executor (CmdExecutor) -------> executor to run external commands
+        """
+        super().__init__(top_dir, executor)
         self.xam = xam
+        if ext:
+            if ext not in path.XAM_EXTS:
+                raise ValueError(f"Invalid extension for {self}: '{ext}'")
+            self.ext = ext
+        self.ref_fasta = ref_fasta
+        self.compression = (compression if compression is not None
+                            else XamCompression())
+
+    @property
+    def ref_args(self):
+        """ Arguments giving samtools the reference if it will read or
+        write a CRAM file. """
+        return get_cram_ref_args((self.xam.ext, self.ext), self.ref_fasta)
+
+    @property
+    def output_args(self):
+        """ Arguments for samtools to write the output file. """
+        return [*self.compression.format_args(self.ext), *self.ref_args]
 
     @property
     def sample(self):
@@ -586,11 +1065,14 @@ class XamBase(ReadsFileBase):
 
     @cached_property
     def xam_index(self):
+        if self.xam.ext == path.CRAM_EXT:
+            return self.xam.replace(ext=path.CRAI_EXT)
         return self.xam.replace(ext=path.BAI_EXT)
 
     def create_index(self):
-        cmd = [SAMTOOLS_CMD, "index", self.xam]
-        run_cmd(cmd)
+        cmd = [SAMTOOLS_CMD, "index", *self.compression.thread_args(),
+               self.xam]
+        self._run_cmd(cmd)
         if not self.xam_index.path.is_file():
             raise FileNotFoundError(self.xam_index.path)
         return self.xam_index
@@ -604,21 +1086,11 @@ class SamRemoveEqualMappers(XamBase):
     ext = path.SAM_EXT
 
     pattern_a = re.compile(SAM_ALIGN_SCORE + rb"(\d+)")
-    pattern_x = re.compile(SAM_EXTRA_SCORE + rb"(\d+)")
+    pattern_d = re.compile(rb"\d+")
 
     _MIN_SAM_FIELDS = 11
     _MAX_SAM_FLAG = 4095  # 2^12 - 1
 
-    @staticmethod
-    def _get_score(line: bytes, ptn: re.Pattern[bytes]):
-        return (float(match.groups()[0])
-                if (match := ptn.search(line)) else None)
-
-    @classmethod
-    def _is_best_alignment(cls, line: bytes):
-        return ((score_x := cls._get_score(line, cls.pattern_x)) is None
-                or score_x < cls._get_score(line, cls.pattern_a))
-
     @classmethod
     def _read_is_paired(cls, line: bytes):
         info = line.split()
@@ -629,47 +1101,160 @@ class SamRemoveEqualMappers(XamBase):
             return bool(flag % 2)
         raise ValueError(f"Invalid SAM flag: {flag}")
 
-    def _iter_paired(self, sam: BinaryIO, line: bytes):
-        for line2 in sam:
-            if self._is_best_alignment(line) or self._is_best_alignment(line2):
-                yield b"".join((line, line2))
-            line = sam.readline()
+    @classmethod
+    def _find_drops(cls, data: bytes, paired: bool):
+        """
+        Return the (start, end) byte ranges of the records in a chunk of SAM
+        lines (with an even number of lines if paired) that must be dropped.
+        A line is a best alignment unless its XS score is at least its AS
+        score; a pair is dropped only if neither mate is a best alignment.
+        Only lines containing an XS tag can fail, so the chunk is scanned
+        with bytes.find for XS tags instead of parsing every line.
+        """
+        # Positions of all XS tags.
+        tags = list()
+        p = data.find(SAM_EXTRA_SCORE)
+        while p >= 0:
+            tags.append(p)
+            p = data.find(SAM_EXTRA_SCORE, p + len(SAM_EXTRA_SCORE))
+        # Number, start, and end of the line containing each XS tag.
+        bounds = np.flatnonzero(np.frombuffer(data, dtype=np.uint8)
+                                == ord(b"\n")) + 1
+        lines = np.searchsorted(bounds, tags, side="right")
+        bounds = np.concatenate([[0], bounds, [len(data)]])
+        drops: list[tuple[int, int]] = list()
+        # Number of the last line whose XS score was checked.
+        done_line = -1
+        # Number and start of the last line (i.e. mate) that failed.
+        fail_line = -2
+        fail_start = 0
+        for p, line, start, end in zip(tags, lines.tolist(),
+                                       bounds[lines].tolist(),
+                                       bounds[lines + 1].tolist()):
+            # Only the first XS score in each line counts.
+            if line == done_line or (match_x := cls.pattern_d.match(
+                    data, p + len(SAM_EXTRA_SCORE))) is None:
+                continue
+            done_line = line
+            if (match_a := cls.pattern_a.search(data, start, end)) is None:
+                raise ValueError("Missing alignment score in SAM line:\n"
+                                 f"{data[start: end].decode()}")
+            if int(match_x.group()) >= int(match_a.group(1)):
+                if not paired:
+                    drops.append((start, end))
+                elif line % 2 == 1 and fail_line == line - 1:
+                    # Both mates failed: drop the whole pair.
+                    drops.append((fail_start, end))
+                else:
+                    fail_line = line
+                    fail_start = start
+        return drops
 
-    def _iter_single(self, sam: BinaryIO, line: bytes):
-        while line:
-            if self._is_best_alignment(line):
-                yield line
-            line = sam.readline()
+    @staticmethod
+    def _iter_chunks(sam: BinaryIO, line: bytes, paired: bool,
+                     chunk_size: int):
+        """ Yield chunks of whole SAM lines (whole pairs if paired),
+        starting with line; drop a trailing unpaired line if paired. """
+        rest = line
+        while data := sam.read(chunk_size):
+            data = rest + data
+            cut = data.rfind(b"\n") + 1
+            if paired and np.count_nonzero(np.frombuffer(
+                    data, dtype=np.uint8, count=cut) == ord(b"\n")) % 2:
+                cut = data.rfind(b"\n", 0, cut - 1) + 1
+            if cut:
+                yield data[:cut]
+            rest = data[cut:]
+        if paired:
+            # The last line may lack a newline; keep only whole pairs.
+            n_lines = rest.count(b"\n") + (not rest.endswith(b"\n"))
+            if n_lines % 2:
+                rest = rest[: rest.rfind(b"\n", 0, len(rest) - 1) + 1]
+        if rest:
+            yield rest
 
-    def _remove_equal_mappers(self, buffer_length=BUFFER_LENGTH):
+    @staticmethod
+    def _write_kept(samo: BinaryIO, data: bytes,
+                    drops: list[tuple[int, int]]):
+        view = memoryview(data)
+        kept = 0
+        for start, end in drops:
+            samo.write(view[kept: start])
+            kept = end
+        samo.write(view[kept:])
+
+    def filter_stream(self, sami: BinaryIO, samo: BinaryIO,
+                      processes: int = 1,
+                      chunk_size: int = SAM_CHUNK_SIZE):
+        """ Copy SAM from sami to samo, except reads that map equally well
+        to multiple locations; either may be a file or a pipe. Chunks of
+        lines are scanned in up to processes worker processes, and written
+        in their original order. """
+        # Copy the header from the input to the output SAM file.
+        while (line := sami.readline()).startswith(SAM_HEADER):
+            samo.write(line)
+        if not line:
+            return
+        paired = self._read_is_paired(line)
+        chunks = self._iter_chunks(sami, line, paired, chunk_size)
+        # Daemonic processes (e.g. workers aligning references in
+        # parallel) may not have children, so they must filter in serial.
+        if processes > 1 and not multiprocessing.current_process().daemon:
+            with multiprocessing.Pool(processes) as pool:
+                # Submit at most two chunks per process ahead of the writer
+                # to bound the memory used when reading from a pipe.
+                pending = deque()
+                for chunk in chunks:
+                    pending.append((chunk, pool.apply_async(
+                        self._find_drops, (chunk, paired))))
+                    if len(pending) > 2 * processes:
+                        chunk, drops = pending.popleft()
+                        self._write_kept(samo, chunk, drops.get())
+                for chunk, drops in pending:
+                    self._write_kept(samo, chunk, drops.get())
+        else:
+            for chunk in chunks:
+                self._write_kept(samo, chunk, self._find_drops(chunk, paired))
+
+    def _remove_equal_mappers(self, processes: int = 1):
         with (open(self.xam.path, "rb") as sami,
               open(self.output.path, "wb") as samo):
-            # Copy the header from the input to the output SAM file.
-            while (line := sami.readline()).startswith(SAM_HEADER):
-                samo.write(line)
-            if line:
-                if self._read_is_paired(line):
-                    lines = self._iter_paired(sami, line)
-                else:
-                    lines = self._iter_single(sami, line)
-                while text := b"".join(itertools.islice(lines, buffer_length)):
-                    samo.write(text)
+            self.filter_stream(sami, samo, processes)
         return self.output
 
-    def run(self):
+    def run(self, processes: int = 1):
         logging.info("\nRemoving Reads Mapping Equally to Multiple Locations"
                      f" in {self.xam}\n")
         self.setup()
-        return self._remove_equal_mappers()
+        return self._remove_equal_mappers(processes)
 
 
 class XamSorter(XamBase):
-    def _sort(self, name: bool):
+    def _sort_cmd(self, name: bool, stdin: bool = False):
         cmd = [SAMTOOLS_CMD, "sort"]
         if name:
             cmd.append("-n")
-        cmd.extend(["-o", self.output, self.xam])
-        run_cmd(cmd)
+        # With stdin, sort the SAM read from standard input instead of xam.
+        cmd.extend([*self.output_args, "-o", self.output,
+                    "-" if stdin else self.xam])
+        return cmd
+
+    def _sort(self, name: bool):
+        self._run_cmd(self._sort_cmd(name))
+        return self.output
+
+    def _merge_cmd(self, xams: list[path.BasePath]):
+        return [SAMTOOLS_CMD, "merge", "-f", *self.output_args, self.output,
+                *xams]
+
+    def merge(self, xams: list[path.BasePath]):
+        """ Write the output by merging files that are each sorted by
+        coordinate (e.g. the sorted outputs of shards of the input),
+        instead of sorting the input. """
+        logging.info(f"\nMerging {len(xams)} Sorted Files into "
+                     f"{self.output}\n")
+        self.setup()
+        self._run_cmd(self._merge_cmd(xams))
         return self.output
 
     def run(self, name: bool = False):
@@ -683,6 +1268,43 @@ class BamAlignSorter(XamSorter):
     ext = path.BAM_EXT
 
 
+def align_stream(trimmer: FastqTrimmer,
+                 aligner: FastqAligner,
+                 remover: SamRemoveEqualMappers,
+                 sorter: XamSorter,
+                 threads: int = DEFAULT_ALIGN_THREADS,
+                 mm: bool = DEFAULT_BT2_MM,
+                 **cutadapt_kwargs):
+    """
+    Trim, align, remove equal mappers, and sort in one pipeline connected by
+    OS pipes (cutadapt | bowtie2 | filter | samtools sort), so that only the
+    sorted output of the sorter is written: no trimmed FASTQ nor SAM file.
+    The aligner and remover must take the outputs of the trimmer and aligner,
+    respectively, as inputs (which need not exist), and threads are divided
+    among cutadapt, bowtie2, and the remover, which run at the same time;
+    mm makes bowtie2 memory-map its index.
+    """
+    trim_cores = max(1, threads // 4)
+    filter_procs = max(1, threads // 4)
+    index_prefix = aligner._bowtie2_build()
+    sorter.setup()
+    try:
+        with aligner.share_index(index_prefix, mm):
+            sorter.executor.run_pipeline(
+                [trimmer._cutadapt_cmd(stdout=True, cores=trim_cores,
+                                       **cutadapt_kwargs),
+                 aligner._bowtie2_cmd(index_prefix, stream=True, mm=mm,
+                                      threads=max(1, threads - trim_cores
+                                                  - filter_procs))],
+                partial(remover.filter_stream, processes=filter_procs),
+                sorter._sort_cmd(name=False, stdin=True),
+                sorter.log_dir)
+    except BaseException:
+        sorter.clean()
+        raise
+    return sorter.output
+
+
 class SamVectorSorter(XamSorter):
     module = path.MOD_VEC
     step = path.VEC_SORT
@@ -699,8 +1321,9 @@ class BamSplitter(XamBase):
                  xam: path.RefsetAlignmentInFilePath |
                       path.OneRefAlignmentInFilePath,
                  fasta: path.RefsetSeqInFilePath |
-                        path.OneRefSeqTempFilePath):
-        super().__init__(top_dir, xam)
+                        path.OneRefSeqTempFilePath,
+                 **kwargs):
+        super().__init__(top_dir, xam, ref_fasta=fasta, **kwargs)
         if isinstance(fasta, path.RefsetSeqInFilePath):
             if self.demult:
                 raise TypeError("Got multi-FASTA but demultiplexed BAM")
@@ -715,41 +1338,172 @@ class BamSplitter(XamBase):
     def refs(self):
         return tuple(ref for ref, _ in FastaParser(self.fasta.path).parse())
 
-    def _get_cmd(self, output: path.OneRefAlignmentOutFilePath, ref: str = ""):
-        cmd = [SAMTOOLS_CMD, "view"]
-        if self.ext == path.BAM_EXT:
-            cmd.append("-b")
-        cmd.extend(("-o", output, self.xam))
-        if ref:
-            cmd.append(ref)
-        return cmd
+    def _get_cmd(self, output: path.OneRefAlignmentOutFilePath,
+                 stdin: bool = False):
+        # With stdin, write the SAM read from standard input instead of xam.
+        return [SAMTOOLS_CMD, "view", *self.output_args,
+                "-o", output, "-" if stdin else self.xam]
 
-    def _extract_one_ref(self, ref: str):
-        output = path.OneRefAlignmentOutFilePath(**self.output_dir.dict(),
-                                                 ref=ref, ext=self.ext)
-        cmd = self._get_cmd(output, ref)
-        run_cmd(cmd)
-        return output
+    def _view_cmd(self):
+        """ Command to decompress xam to SAM (with its header) on standard
+        output, reading it once from beginning to end. """
+        return [SAMTOOLS_CMD, "view", "-h", "--no-PG",
+                *self.compression.thread_args(), *self.ref_args, self.xam]
+
+    def _ref_output(self, ref: str):
+        return path.OneRefAlignmentOutFilePath(**self.output_dir.dict(),
+                                               ref=ref, ext=self.ext)
+
+    @staticmethod
+    def _get_ref(data: bytes, start: int):
+        """ Return the reference name (RNAME) of the SAM line that begins
+        at position start of data. """
+        flag_end = data.index(b"\t", data.index(b"\t", start) + 1)
+        return data[flag_end + 1: data.index(b"\t", flag_end + 1)]
 
-    def _split_xam(self):
-        self.create_index()
-        return tuple(map(self._extract_one_ref, self.refs))
+    @classmethod
+    def _iter_ref_runs(cls, sam: BinaryIO, line: bytes,
+                       chunk_size: int = SAM_CHUNK_SIZE):
+        """
+        Yield (ref, lines) for each run of consecutive SAM lines with the
+        same reference name, in chunks of about chunk_size bytes, starting
+        with line. Because lines sorted by coordinate come in one run per
+        reference, the end of each run is found by bisecting each chunk on
+        the reference name instead of parsing every line.
+        """
+        rest = line
+        eof = False
+        while not eof:
+            data = sam.read(chunk_size)
+            eof = not data
+            data = rest + data
+            # Process only whole lines, unless at the end of the input.
+            end = len(data) if eof else data.rfind(b"\n") + 1
+            pos = 0
+            while pos < end:
+                ref = cls._get_ref(data, pos)
+                # Start of the last line in the chunk.
+                hi = data.rfind(b"\n", pos, end - 1) + 1 or pos
+                if cls._get_ref(data, hi) == ref:
+                    # The rest of the chunk belongs to the same reference.
+                    hi = end
+                else:
+                    # Bisect between a line of this reference (lo) and one
+                    # of another reference (hi) until they are adjacent.
+                    lo = pos
+                    while (after := data.find(b"\n", lo) + 1) < hi:
+                        mid = data.find(b"\n", (lo + hi) // 2, hi) + 1
+                        if not lo < mid < hi:
+                            mid = after
+                        if cls._get_ref(data, mid) == ref:
+                            lo = mid
+                        else:
+                            hi = mid
+                yield ref, data[pos: hi]
+                pos = hi
+            rest = data[end:]
+
+    def _split_stream(self, max_writers: int = MAX_SPLIT_WRITERS):
+        """
+        Split xam (sorted by coordinate) into one file per reference while
+        decompressing it only once: every record is routed to the writer of
+        its reference, a samtools process that compresses its output (with
+        the threads of the compression policy) after this process moves on
+        to the next reference. At most max_writers writers run at once, and
+        unmapped reads (reference '*') are discarded, as with a region query.
+        """
+        outputs = {ref.encode(): self._ref_output(ref) for ref in self.refs}
+        finished: dict[bytes, subprocess.Popen] = dict()
+        running: deque[subprocess.Popen] = deque()
+        procs: list[subprocess.Popen] = list()
+
+        def start_writer(ref: bytes, header: bytes):
+            if ref in finished:
+                raise ValueError(f"{self.xam} is not sorted by coordinate: "
+                                 f"got reference '{ref.decode()}' again")
+            # Bound the number of writers (and pipes) open at once.
+            while len(running) >= max_writers:
+                self.executor.finish(running.popleft())
+            writer = self.executor.start(self._get_cmd(outputs[ref],
+                                                       stdin=True),
+                                         self.log_dir, stdin=subprocess.PIPE)
+            procs.append(writer)
+            running.append(writer)
+            finished[ref] = writer
+            writer.stdin.write(header)
+            return writer
+
+        try:
+            reader = self.executor.start(self._view_cmd(), self.log_dir,
+                                         stdout=subprocess.PIPE)
+            procs.append(reader)
+            with reader.stdout as sam:
+                header = list()
+                while (line := sam.readline()).startswith(SAM_HEADER):
+                    header.append(line)
+                header = b"".join(header)
+                writer = None
+                for ref, lines in self._iter_ref_runs(sam, line):
+                    if ref not in outputs:
+                        if ref != SAM_UNMAPPED_REF:
+                            raise ValueError(f"Reference '{ref.decode()}' "
+                                             f"is not in {self.fasta}")
+                        continue
+                    if writer is None or finished.get(ref) is not writer:
+                        if writer is not None:
+                            writer.stdin.close()
+                        writer = start_writer(ref, header)
+                    writer.stdin.write(lines)
+                if writer is not None:
+                    writer.stdin.close()
+            # Write files with only the header for references without reads.
+            for ref in outputs:
+                if ref not in finished:
+                    start_writer(ref, header).stdin.close()
+        except BaseException:
+            for proc in procs:
+                proc.kill()
+            raise
+        finally:
+            results = [self.executor.finish(proc, check=False)
+                       for proc in procs if proc.returncode is None]
+        for result in results:
+            if result.returncode:
+                raise OSError(f"Command '{result.cmd}' returned exit code "
+                              f"{result.returncode} (see {result.log})")
+        return tuple(outputs.values())
 
     def _move_xam(self):
         if self.ext == self.xam.ext:
             os.rename(self.xam.path, self.output.path)
         else:
             cmd = self._get_cmd(self.output)
-            run_cmd(cmd)
+            self._run_cmd(cmd)
         return self.output,
 
-    def run(self) -> tuple[path.OneRefAlignmentOutFilePath, ...]:
+    def run(self, max_writers: int = MAX_SPLIT_WRITERS
+            ) -> tuple[path.OneRefAlignmentOutFilePath, ...]:
         logging.info(f"\nSplitting {self.xam} into Individual References\n")
         self.setup()
         if self.demult:
             return self._move_xam()
         else:
-            return self._split_xam()
+            return self._split_stream(max_writers)
+
+    def clean(self):
+        return
+
+
+class XamIndexer(XamBase):
+    """ Index an alignment map file, if it has no index yet, so that the
+    reads of a region can be fetched from it. """
+    module = path.MOD_VEC
+    step = path.VEC_SELECT
+
+    def run(self):
+        if not self.xam_index.path.is_file():
+            return self.create_index()
+        return self.xam_index
 
     def clean(self):
         return
@@ -766,8 +1520,9 @@ class BamVectorSelector(XamBase):
                       path.OneRefAlignmentInFilePath,
                  ref: str,
                  first: int,
-                 last: int):
-        super().__init__(top_dir, xam)
+                 last: int,
+                 **kwargs):
+        super().__init__(top_dir, xam, **kwargs)
         self.ref = ref
         self.first = first
         self.last = last
@@ -777,9 +1532,10 @@ class BamVectorSelector(XamBase):
         return f"{ref}:{first}-{last}"
 
     def _select(self):
-        cmd = [SAMTOOLS_CMD, "view", "-h", "-o", self.output, self.xam,
+        cmd = [SAMTOOLS_CMD, "view", "-h", *self.output_args,
+               "-o", self.output, self.xam,
                self.ref_coords(self.ref, self.first, self.last)]
-        run_cmd(cmd)
+        self._run_cmd(cmd)
         return self.output
 
     def run(self):
@@ -0,0 +1,196 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import TestCase
+
+from dreem.util.excmd import CmdExecutor, run_pipeline
+
+
+def python_cmd(code: str):
+    return [sys.executable, "-c", code]
+
+
+class TestCmdExecutor(TestCase):
+    """ Test running commands and measuring their resources. """
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def test_run_logs_stderr(self):
+        executor = CmdExecutor()
+        result = executor.run(python_cmd("import sys; "
+                                         "sys.stderr.write('warning')"),
+                              self.log_dir)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(executor.results, [result])
+        self.assertEqual(os.path.dirname(result.log), self.log_dir)
+        with open(result.log) as f:
+            log = f.read()
+        self.assertIn("warning", log)
+        self.assertTrue(log.startswith(f"$ {sys.executable} -c"))
+
+    def test_run_measures_resources(self):
+        # Use about 50 MiB of memory and a burst of CPU time.
+        result = CmdExecutor().run(python_cmd(
+            "x = bytearray(50 * 2 ** 20); sum(range(3 * 10 ** 6))"))
+        self.assertGreaterEqual(result.max_rss_kib, 50 * 1024)
+        self.assertGreater(result.cpu_secs, 0.)
+        self.assertGreaterEqual(result.wall_secs, result.cpu_secs / 2)
+
+    def test_run_fails(self):
+        executor = CmdExecutor()
+        with self.assertRaisesRegex(OSError, "exit code 3"):
+            executor.run(python_cmd("raise SystemExit(3)"), self.log_dir)
+        self.assertEqual(executor.results[0].returncode, 3)
+
+    def test_run_times_out(self):
+        executor = CmdExecutor(timeout=0.2)
+        start = time.perf_counter()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            executor.run(python_cmd("import time; time.sleep(30)"))
+        self.assertLess(time.perf_counter() - start, 10.)
+
+    def test_max_jobs(self):
+        executor = CmdExecutor(max_jobs=2)
+        # Each command marks itself running with a file, then records how
+        # many commands are running (i.e. have files) at that moment.
+        code = ("import os, sys, time; d = sys.argv[1]; "
+                "f = os.path.join(d, str(os.getpid())); open(f, 'w').close(); "
+                "time.sleep(0.2); n = len(os.listdir(d)); os.remove(f); "
+                "sys.stderr.write(f'{n}\\n')")
+        marks = os.path.join(self.log_dir, "marks")
+        os.mkdir(marks)
+        threads = [threading.Thread(target=executor.run,
+                                    args=(python_cmd(code)
+                                          + [marks],
+                                          os.path.join(self.log_dir,
+                                                       f"log{i}")))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(executor.results), 6)
+        running = list()
+        for result in executor.results:
+            with open(result.log) as f:
+                running.append(int(f.read().splitlines()[1]))
+        self.assertLessEqual(max(running), 2)
+
+    def test_iter_stdout(self):
+        executor = CmdExecutor()
+        lines = executor.iter_stdout(python_cmd(
+            "import sys; print('a'); print('b'); sys.stderr.write('warning')"),
+            self.log_dir)
+        self.assertEqual(list(lines), [b"a\n", b"b\n"])
+        result, = executor.results
+        self.assertEqual(result.returncode, 0)
+        with open(result.log) as f:
+            self.assertIn("warning", f.read())
+
+    def test_iter_stdout_fails(self):
+        executor = CmdExecutor()
+        lines = executor.iter_stdout(python_cmd("print('a'); raise SystemExit(3)"))
+        self.assertEqual(next(lines), b"a\n")
+        with self.assertRaisesRegex(OSError, "exit code 3"):
+            next(lines)
+        self.assertEqual(executor.results[0].returncode, 3)
+
+    def test_iter_stdout_times_out(self):
+        executor = CmdExecutor(timeout=0.2)
+        start = time.perf_counter()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            list(executor.iter_stdout(python_cmd(
+                "import time; print('a', flush=True); time.sleep(30)")))
+        self.assertLess(time.perf_counter() - start, 10.)
+
+    def test_iter_stdout_closed(self):
+        # A command whose output is no longer read is killed and reaped.
+        executor = CmdExecutor()
+        lines = executor.iter_stdout(python_cmd(
+            "import time\nwhile True: print('a', flush=True); time.sleep(0.01)"))
+        self.assertEqual(next(lines), b"a\n")
+        lines.close()
+        result, = executor.results
+        self.assertNotEqual(result.returncode, 0)
+
+    def test_run_pipeline(self):
+        executor = CmdExecutor()
+        with tempfile.NamedTemporaryFile(delete=False) as out:
+            pass
+        try:
+            def through(stdin, stdout):
+                stdout.write(stdin.read().upper())
+
+            results = executor.run_pipeline(
+                [python_cmd("print('a' * 5)"),
+                 python_cmd("import sys; "
+                            "sys.stdout.write(sys.stdin.read() * 2)")],
+                through,
+                python_cmd("import sys; "
+                           f"open({out.name!r}, 'w').write(sys.stdin.read())"),
+                self.log_dir)
+            self.assertEqual([result.returncode for result in results],
+                             [0, 0, 0])
+            with open(out.name) as f:
+                self.assertEqual(f.read(), "AAAAA\nAAAAA\n")
+        finally:
+            os.unlink(out.name)
+
+
+class TestRunPipeline(TestCase):
+    """ Test connecting commands and a function in this process by pipes.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.dir, "output.txt")
+        self.write = python_cmd("import sys; "
+                                f"open({self.output!r}, 'wb').write("
+                                "sys.stdin.buffer.read())")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    @staticmethod
+    def upper(stdin, stdout):
+        for line in stdin:
+            stdout.write(line.upper())
+
+    def test_pipeline(self):
+        lines = [f"line {i}" for i in range(10000)]
+        run_pipeline([python_cmd(f"print(*{lines!r}, sep='\\n')"),
+                      ["cat"]], self.upper, self.write)
+        with open(self.output) as f:
+            self.assertEqual(f.read().splitlines(),
+                             [line.upper() for line in lines])
+        # Only the output of the last command is written.
+        self.assertEqual(os.listdir(self.dir), ["output.txt"])
+
+    def test_fails(self):
+        for upstream, downstream in [
+            ([python_cmd("raise SystemExit(3)"), ["cat"]], self.write),
+            ([["cat", os.devnull]], python_cmd("raise SystemExit(3)")),
+        ]:
+            with self.subTest(upstream=upstream, downstream=downstream):
+                with self.assertRaisesRegex(OSError, "exit code 3"):
+                    run_pipeline(upstream, self.upper, downstream)
+
+    def test_function_fails(self):
+        def fail(stdin, stdout):
+            raise ValueError("filter failed")
+
+        with self.assertRaisesRegex(ValueError, "filter failed"):
+            run_pipeline([python_cmd("print('line')")], fail, self.write)
+
+
+if __name__ == "__main__":
+    unittest.main()
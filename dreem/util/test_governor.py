@@ -0,0 +1,108 @@
+import pickle
+import threading
+import time
+import unittest
+from unittest import TestCase, mock
+
+from dreem.util import governor
+from dreem.util.governor import ResourceGovernor, GIB
+
+
+def vmem(available: int, total: int = 100 * GIB):
+    return mock.Mock(available=available, total=total)
+
+
+class TestResourceGovernor(TestCase):
+    """ Test sharing a budget of cores and memory between threads. """
+
+    def test_reserve_cpus(self):
+        gov = ResourceGovernor(4)
+        running = list()
+        peak = list()
+        lock = threading.Lock()
+
+        def work(cpus: int):
+            with gov.reserve(cpus) as reserved:
+                with lock:
+                    running.append(reserved)
+                    peak.append(sum(running))
+                time.sleep(0.05)
+                with lock:
+                    running.remove(reserved)
+
+        threads = [threading.Thread(target=work, args=(cpus,))
+                   for cpus in [3, 2, 2, 1, 4, 9]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # The threads never held more cores at once than the budget, and a
+        # request for more than the budget was reduced to the budget.
+        self.assertLessEqual(max(peak), 4)
+        self.assertIn(4, peak)
+        self.assertEqual(gov._free_cpus, 4)
+
+    def test_reserve_mem(self):
+        gov = ResourceGovernor(8, 10)
+        with gov.reserve(1, 6):
+            acquired = threading.Event()
+
+            def work():
+                with gov.reserve(1, 6):
+                    acquired.set()
+
+            thread = threading.Thread(target=work)
+            thread.start()
+            # Cores are free, but the memory budget is not.
+            self.assertFalse(acquired.wait(0.2))
+        thread.join()
+        self.assertTrue(acquired.is_set())
+        self.assertEqual(gov._free_mem, 10)
+
+    def test_memory_pressure(self):
+        gov = ResourceGovernor(8)
+        with mock.patch("psutil.virtual_memory",
+                        return_value=vmem(GIB)) as virtual_memory:
+            # Nothing else is running, so waiting would not help.
+            with gov.reserve(1, 2 * GIB):
+                acquired = threading.Event()
+
+                def work():
+                    with gov.reserve(1, 2 * GIB):
+                        acquired.set()
+
+                with mock.patch.object(governor, "MEM_POLL_SECS", 0.01):
+                    thread = threading.Thread(target=work)
+                    thread.start()
+                    # The second request backs off while memory is short.
+                    self.assertFalse(acquired.wait(0.2))
+                    virtual_memory.return_value = vmem(50 * GIB)
+                    self.assertTrue(acquired.wait(1.0))
+                thread.join()
+
+    def test_share(self):
+        gov = ResourceGovernor(10, 9 * GIB)
+        share = gov.share(4)
+        self.assertEqual((share.max_cpus, share.max_mem), (2, 9 * GIB // 4))
+        self.assertEqual(gov.share(20).max_cpus, 1)
+
+    def test_pickle(self):
+        gov = ResourceGovernor(4, 100)
+        with gov.reserve(3, 60):
+            copy = pickle.loads(pickle.dumps(gov))
+        # The copy has the whole budget.
+        self.assertEqual((copy.max_cpus, copy.max_mem), (4, 100))
+        self.assertEqual((copy._free_cpus, copy._free_mem), (4, 100))
+
+    def test_configure(self):
+        original = governor.get_governor()
+        try:
+            gov = governor.configure(3, 1.5)
+            self.assertIs(governor.get_governor(), gov)
+            self.assertEqual((gov.max_cpus, gov.max_mem), (3, 3 * GIB // 2))
+        finally:
+            governor.set_governor(original)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from dreem.util import path
+
+
+class Step(object):
+    """ Minimal step that writes one file in its top-level directory. """
+    step = path.ALN_TRIM
+
+    def __init__(self, top: path.TopDirPath):
+        self.top = top
+        self.output = os.path.join(top.top, "output.txt")
+
+    def run(self, fail: bool = False):
+        with open(self.output, "w") as f:
+            f.write("half-written")
+            if fail:
+                raise RuntimeError("step failed")
+
+    def clean(self):
+        if os.path.isfile(self.output):
+            os.remove(self.output)
+
+
+class TestScratch(TestCase):
+    """ Test the policy for temporary files. """
+
+    def setUp(self):
+        self.out = tempfile.mkdtemp()
+        self.root = tempfile.mkdtemp()
+        self.out_dir = path.TopDirPath(top=self.out)
+
+    def tearDown(self):
+        shutil.rmtree(self.out)
+        shutil.rmtree(self.root)
+
+    def test_top_dir_default(self):
+        self.assertEqual(path.Scratch().top_dir(self.out_dir), self.out_dir)
+
+    def test_top_dir_root(self):
+        scratch = path.Scratch(self.root)
+        top = scratch.top_dir(self.out_dir)
+        self.assertTrue(os.path.isdir(top.top))
+        self.assertEqual(os.path.dirname(top.top), self.root)
+        # The same outputs always get the same scratch directory, and
+        # other outputs get a different one.
+        self.assertEqual(scratch.top_dir(self.out_dir), top)
+        other = tempfile.mkdtemp()
+        try:
+            self.assertNotEqual(
+                scratch.top_dir(path.TopDirPath(top=other)), top)
+        finally:
+            shutil.rmtree(other)
+
+    def test_step_failure_cleans(self):
+        step = Step(path.Scratch(self.root).top_dir(self.out_dir))
+        with self.assertRaises(RuntimeError):
+            with path.Scratch(self.root).step(step, 0):
+                step.run(fail=True)
+        self.assertFalse(os.path.exists(step.output))
+
+    def test_step_no_space(self):
+        scratch = path.Scratch(self.root)
+        step = Step(scratch.top_dir(self.out_dir))
+        free = shutil.disk_usage(self.root).free
+        with self.assertRaises(path.ScratchSpaceError):
+            with scratch.step(step, free + 1):
+                step.run()
+        # The step did not run.
+        self.assertFalse(os.path.exists(step.output))
+        with mock.patch("shutil.disk_usage",
+                        return_value=shutil.disk_usage(self.root)
+                        ._replace(free=1000)):
+            with self.assertRaises(path.ScratchSpaceError):
+                scratch.check_free(step.top, 900, "step")
+            scratch.check_free(step.top, 800, "step")
+
+    def test_clean_keep(self):
+        for keep in (False, True):
+            with self.subTest(keep=keep):
+                step = Step(self.out_dir)
+                with path.Scratch(keep=keep).step(step, 0):
+                    step.run()
+                path.Scratch(keep=keep).clean(step)
+                self.assertEqual(os.path.exists(step.output), keep)
+                step.clean()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,672 @@
+import gzip
+import io
+import itertools
+import os
+import pathlib
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import TestCase, mock
+
+from dreem.util import path
+from dreem.util.excmd import CmdExecutor, SAMTOOLS_CMD
+from dreem.util.governor import ResourceGovernor, get_governor, set_governor
+from dreem.util.reads import (BamAlignSorter, BamSplitter, Bowtie2IndexCache,
+                               FastqAligner, FastqSharder, FastqTrimmer, FastqUnit, MAX_SPLIT_WRITERS,
+                               SamRemoveEqualMappers, SamVectorSorter,
+                               XamCompression, XamIndexer, get_cram_ref_args,
+                               iter_fastq_blocks)
+
+
+def make_sam_lines(refs: list[str], n_reads: int, n_unmapped: int):
+    """ Return SAM lines (without a header) sorted by coordinate, with
+    n_reads reads for each reference in refs, then unmapped reads. """
+    lines = list()
+    for ref in refs:
+        for i in range(n_reads):
+            lines.append(f"{ref}-{i}\t0\t{ref}\t{i % 10 + 1}\t42\t4M\t*\t0\t0"
+                         f"\tACGT\tIIII\n".encode())
+    for i in range(n_unmapped):
+        lines.append(f"unmapped-{i}\t4\t*\t0\t0\t*\t*\t0\t0"
+                     f"\tACGT\tIIII\n".encode())
+    return lines
+
+
+def make_scored_sam_lines(n_reads: int, paired: bool, seed: int = 0):
+    """ Return SAM lines (without a header) with random alignment scores,
+    some of which have an XS score: lower, equal, higher, negative, or
+    followed by another XS score later in the line. """
+    rng = random.Random(seed)
+    lines = list()
+    for i in range(n_reads * (2 if paired else 1)):
+        score_a = rng.randint(0, 40)
+        tags = [f"AS:i:{score_a}"]
+        kind = rng.randrange(6)
+        if kind == 1:
+            tags.append(f"XS:i:{rng.randint(0, score_a)}")
+        elif kind == 2:
+            tags.append(f"XS:i:{score_a + rng.randint(0, 5)}")
+        elif kind == 3:
+            tags.append(f"XS:i:-{rng.randint(1, 40)}")
+        elif kind == 4:
+            tags.extend([f"XS:i:{max(score_a - 1, 0)}", f"XS:i:{score_a}"])
+        elif kind == 5:
+            tags.extend([f"XS:i:-{rng.randint(1, 40)}", f"XS:i:{score_a}"])
+        flag = (1 | (64 if i % 2 == 0 else 128)) if paired else 0
+        fields = [f"read{i // 2 if paired else i}", str(flag), "ref", "1",
+                  "42", "4M", "*", "0", "0", "ACGT", "IIII", *tags]
+        lines.append(("\t".join(fields) + "\n").encode())
+    return lines
+
+
+def filter_line_by_line(data: bytes):
+    """ Filter equal mappers from SAM lines one line at a time, as the
+    filter did before it scanned chunks, to compare against. """
+    pattern_a = re.compile(rb"AS:i:(\d+)")
+    pattern_x = re.compile(rb"XS:i:(\d+)")
+
+    def is_best(line: bytes):
+        return ((match_x := pattern_x.search(line)) is None
+                or float(match_x.group(1))
+                < float(pattern_a.search(line).group(1)))
+
+    sam = io.BytesIO(data)
+    line = sam.readline()
+    if not line:
+        return b""
+    kept = list()
+    if int(line.split()[1]) % 2:
+        for line2 in sam:
+            if is_best(line) or is_best(line2):
+                kept.append(line + line2)
+            line = sam.readline()
+    else:
+        while line:
+            if is_best(line):
+                kept.append(line)
+            line = sam.readline()
+    return b"".join(kept)
+
+
+def make_fastq_records(n_reads: int, mate: int):
+    """ Return records of FASTQ (one bytes per record) of varying length. """
+    return [f"@read{i}/{mate}\n{'ACGT' * (i % 5 + 1)}\n+\n"
+            f"{'I' * 4 * (i % 5 + 1)}\n".encode() for i in range(n_reads)]
+
+
+class TestIterFastqBlocks(TestCase):
+    """ Test splitting a FASTQ file into blocks of whole records. """
+
+    def test_blocks(self):
+        for n_reads, n_records, chunk_size in itertools.product(
+                [0, 1, 10, 100], [1, 3, 64], [1, 7, 1000]):
+            with self.subTest(n_reads=n_reads, n_records=n_records,
+                              chunk_size=chunk_size):
+                records = make_fastq_records(n_reads, 1)
+                blocks = list(iter_fastq_blocks(io.BytesIO(b"".join(records)),
+                                                n_records,
+                                                chunk_size=chunk_size))
+                # Every block has n_records records, except maybe the last.
+                self.assertEqual([b"".join(pieces) for pieces, _ in blocks],
+                                 [b"".join(records[i: i + n_records])
+                                  for i in range(0, n_reads, n_records)])
+                self.assertEqual([n_lines for _, n_lines in blocks],
+                                 [4 * len(records[i: i + n_records])
+                                  for i in range(0, n_reads, n_records)])
+
+    def test_missing_final_newline(self):
+        data = b"".join(make_fastq_records(5, 1))[:-1]
+        blocks = list(iter_fastq_blocks(io.BytesIO(data), 2, chunk_size=7))
+        self.assertEqual(b"".join(b"".join(pieces) for pieces, _ in blocks),
+                         data + b"\n")
+
+    def test_truncated_record(self):
+        data = b"".join(make_fastq_records(5, 1)).rsplit(b"\n", 3)[0]
+        with self.assertRaises(ValueError):
+            list(iter_fastq_blocks(io.BytesIO(data), 2))
+
+
+class TestFastqTrimmerCores(TestCase):
+    """ Test that cutadapt uses no more cores than the resource governor
+    allows. """
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.previous = get_governor()
+        self.governor = set_governor(ResourceGovernor(max_cpus=3))
+        fq = path.SampleReadsInFilePath(top=self.top, sample="sample",
+                                        ext=".fq")
+        self.executor = mock.Mock(spec=CmdExecutor)
+        self.trimmer = FastqTrimmer(path.TopDirPath(top=self.top),
+                                    FastqUnit((fq,), False, 33),
+                                    self.executor)
+
+    def tearDown(self):
+        set_governor(self.previous)
+        shutil.rmtree(self.top)
+
+    def cores(self):
+        args = self.executor.run.call_args.args[0]
+        return args[args.index("--cores") + 1]
+
+    def test_reserve_budget(self):
+        # Cores are reserved from the governor while cutadapt runs.
+        self.executor.run.side_effect = lambda *args, **kwargs: \
+            self.assertEqual(self.governor._free_cpus, 0)
+        self.trimmer.run()
+        self.assertEqual(self.cores(), 3)
+        self.assertEqual(self.governor._free_cpus, 3)
+
+    def test_reserved_by_caller(self):
+        self.trimmer.run(cores=2)
+        self.assertEqual(self.cores(), 2)
+        self.assertEqual(self.governor._free_cpus, 3)
+
+
+class TestFastqSharder(TestCase):
+    """ Test splitting the FASTQ file(s) of a sample into shards. """
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.top_dir = path.TopDirPath(top=self.top)
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    @staticmethod
+    def names(fq: path.BasePath):
+        with open(fq.path, "rb") as f:
+            return [line.split(b"/")[0] for line in f.read().splitlines()[::4]]
+
+    def test_paired(self):
+        fq1 = path.SampleReads1InFilePath(top=self.top, sample="sample",
+                                          ext="_R1.fq.gz")
+        fq2 = path.SampleReads2InFilePath(top=self.top, sample="sample",
+                                          ext="_R2.fq")
+        records1 = make_fastq_records(1000, 1)
+        records2 = make_fastq_records(1000, 2)
+        with gzip.open(fq1.path, "wb") as f:
+            f.writelines(records1)
+        with open(fq2.path, "wb") as f:
+            f.writelines(records2)
+        sharder = FastqSharder(self.top_dir, FastqUnit((fq1, fq2), False, 33),
+                               3, block_records=64)
+        shards = sharder.run()
+        self.assertEqual(len(shards), 3)
+        names = list()
+        for shard in shards:
+            # Shards are uncompressed, and the mates stay together.
+            self.assertFalse(str(shard.paths[0]).endswith(".gz"))
+            self.assertEqual(shard.sample, "sample")
+            self.assertEqual(self.names(shard.paths[0]),
+                             self.names(shard.paths[1]))
+            names.extend(self.names(shard.paths[0]))
+        # Every read is in exactly one shard.
+        self.assertEqual(sorted(names),
+                         sorted(record.split(b"/")[0]
+                                for record in records1))
+        sharder.clean()
+        self.assertFalse(sharder.output_dir.path.exists())
+
+    def test_interleaved(self):
+        fq = path.SampleReadsInFilePath(top=self.top, sample="sample",
+                                        ext=".fq")
+        with open(fq.path, "wb") as f:
+            f.writelines(itertools.chain(*zip(make_fastq_records(99, 1),
+                                              make_fastq_records(99, 2))))
+        shards = FastqSharder(self.top_dir, FastqUnit((fq,), True, 33), 2,
+                              block_records=10).run()
+        for shard in shards:
+            # Both mates of each pair go to the same shard.
+            names = self.names(shard.paths[0])
+            self.assertEqual(names[0::2], names[1::2])
+
+    def test_mates_mismatched(self):
+        fq1 = path.SampleReads1InFilePath(top=self.top, sample="sample",
+                                          ext="_R1.fq")
+        fq2 = path.SampleReads2InFilePath(top=self.top, sample="sample",
+                                          ext="_R2.fq")
+        with open(fq1.path, "wb") as f:
+            f.writelines(make_fastq_records(100, 1))
+        with open(fq2.path, "wb") as f:
+            f.writelines(make_fastq_records(90, 2))
+        sharder = FastqSharder(self.top_dir, FastqUnit((fq1, fq2), False, 33),
+                               2, block_records=10)
+        with self.assertRaises(ValueError):
+            sharder.run()
+
+
+class TestIterRefRuns(TestCase):
+    """ Test grouping lines of SAM into runs of one reference. """
+
+    def test_runs(self):
+        refs = ["ref1", "ref2", "ref3"]
+        lines = make_sam_lines(refs, 25, 5)
+        # Include chunks smaller than one line and a missing final newline.
+        for chunk_size, data in itertools.product(
+                [1, 7, 100, 1000, 2 ** 20],
+                [b"".join(lines), b"".join(lines)[:-1]]):
+            with self.subTest(chunk_size=chunk_size, end=data[-1:]):
+                line, _, rest = data.partition(b"\n")
+                runs = list(BamSplitter._iter_ref_runs(
+                    io.BytesIO(rest), line + b"\n", chunk_size))
+                # Every run has lines of only its own reference.
+                for ref, run in runs:
+                    self.assertEqual({line.split(b"\t")[2]
+                                      for line in run.splitlines()}, {ref})
+                # Concatenated in order, the runs reproduce the input.
+                self.assertEqual(b"".join(run for _, run in runs), data)
+                self.assertEqual([ref for ref, _ in itertools.groupby(
+                    ref for ref, _ in runs)],
+                    [ref.encode() for ref in refs] + [b"*"])
+
+
+@unittest.skipUnless(shutil.which(SAMTOOLS_CMD), "samtools is not installed")
+class TestBamSplitter(TestCase):
+    """ Test splitting a BAM file into one file per reference. """
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        # More references than writers may run at once, one without reads.
+        self.refs = [f"ref{i}" for i in range(MAX_SPLIT_WRITERS + 3)]
+        fasta = path.RefsetSeqInFilePath(top=self.top, refset="refs",
+                                         ext=path.FASTA_EXTS[0])
+        with open(fasta.path, "w") as f:
+            f.writelines(f">{ref}\nACGTACGTACGTACGTACGT\n"
+                         for ref in self.refs)
+        self.fasta = fasta
+        sample_dir = os.path.join(self.top, "sample")
+        os.makedirs(sample_dir)
+        self.xam = path.RefsetAlignmentInFilePath(top=self.top,
+                                                  sample="sample",
+                                                  refset="refs",
+                                                  ext=path.BAM_EXT)
+        header = "".join(f"@SQ\tSN:{ref}\tLN:20\n" for ref in self.refs)
+        sam = os.path.join(self.top, "refs.sam")
+        with open(sam, "wb") as f:
+            f.write(b"@HD\tVN:1.6\tSO:coordinate\n" + header.encode())
+            f.writelines(make_sam_lines(self.refs[:-1], 30, 12))
+        subprocess.run([SAMTOOLS_CMD, "sort", "-o", str(self.xam.path), sam],
+                       check=True)
+        subprocess.run([SAMTOOLS_CMD, "index", str(self.xam.path)],
+                       check=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    @staticmethod
+    def view(*args):
+        return subprocess.run([SAMTOOLS_CMD, "view", *map(str, args)],
+                              check=True, capture_output=True).stdout
+
+    def test_split_matches_view(self):
+        top_dir = path.TopDirPath(top=self.top)
+        outputs = BamSplitter(top_dir, self.xam, self.fasta).run()
+        self.assertEqual(len(outputs), len(self.refs))
+        for ref, output in zip(self.refs, outputs, strict=True):
+            with self.subTest(ref=ref):
+                self.assertEqual(output.ref, ref)
+                self.assertEqual(self.view(output.path),
+                                 self.view(self.xam.path, ref))
+                # Every file keeps the header of the input.
+                self.assertEqual(self.view("-H", output.path).count(b"@SQ"),
+                                 len(self.refs))
+        # No file has the unmapped reads.
+        self.assertEqual(self.view(outputs[-1].path), b"")
+        self.assertNotIn(b"unmapped",
+                         b"".join(self.view(output.path)
+                                  for output in outputs))
+
+
+class TestCram(TestCase):
+    """ Test writing alignment maps as CRAM against the reference FASTA and
+    reading them back. """
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.top_dir = path.TopDirPath(top=self.top)
+        self.refs = ["ref0", "ref1", "ref2"]
+        rng = random.Random(0)
+        fasta = path.RefsetSeqInFilePath(top=self.top, refset="refs",
+                                         ext=path.FASTA_EXTS[0])
+        with open(fasta.path, "w") as f:
+            f.writelines(f">{ref}\n"
+                         f"{''.join(rng.choice('ACGT') for _ in range(20))}\n"
+                         for ref in self.refs)
+        self.fasta = fasta
+        sample_dir = os.path.join(self.top, "sample")
+        os.makedirs(sample_dir)
+        self.xam = path.RefsetAlignmentInFilePath(top=self.top,
+                                                  sample="sample",
+                                                  refset="refs",
+                                                  ext=path.BAM_EXT)
+        self.sam = os.path.join(self.top, "refs.sam")
+        header = "".join(f"@SQ\tSN:{ref}\tLN:20\n" for ref in self.refs)
+        with open(self.sam, "wb") as f:
+            f.write(b"@HD\tVN:1.6\tSO:coordinate\n" + header.encode())
+            f.writelines(make_sam_lines(self.refs, 30, 0))
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    @staticmethod
+    def view(*args):
+        return subprocess.run([SAMTOOLS_CMD, "view", *map(str, args)],
+                              check=True, capture_output=True).stdout
+
+    def test_format_args(self):
+        compression = XamCompression(level=7, threads=2)
+        self.assertEqual(compression.format_args(path.CRAM_EXT),
+                         ["-O", "cram,level=7", "-@", 2])
+        self.assertEqual(compression.format_args(path.SAM_EXT),
+                         ["-O", "sam", "-@", 2])
+        self.assertEqual(XamCompression(level=-1, threads=0)
+                         .format_args(path.BAM_EXT), ["-O", "bam"])
+
+    def test_reference_args(self):
+        self.assertEqual(get_cram_ref_args((path.BAM_EXT, path.SAM_EXT),
+                                           None), [])
+        self.assertEqual(get_cram_ref_args((path.BAM_EXT, path.CRAM_EXT),
+                                           self.fasta),
+                         ["--reference", self.fasta])
+
+    def test_no_reference(self):
+        # Writing CRAM without the reference fails before running samtools.
+        executor = mock.Mock(spec=CmdExecutor)
+        sorter = BamAlignSorter(self.top_dir, self.xam, ext=path.CRAM_EXT,
+                                executor=executor)
+        with self.assertRaisesRegex(ValueError, "reference FASTA"):
+            sorter.run()
+        # So does reading CRAM without the reference.
+        cram = self.xam.replace(ext=path.CRAM_EXT)
+        with self.assertRaisesRegex(ValueError, "reference FASTA"):
+            SamVectorSorter(self.top_dir, cram, executor=executor).run(
+                name=True)
+        with self.assertRaisesRegex(ValueError, "reference FASTA"):
+            XamIndexer(self.top_dir, cram, executor=executor).ref_args
+        self.assertEqual(executor.method_calls, [])
+
+    def test_split_commands(self):
+        # Every command that writes CRAM gets the reference and the format.
+        splitter = BamSplitter(self.top_dir, self.xam, self.fasta,
+                               ext=path.CRAM_EXT,
+                               compression=XamCompression(level=3))
+        for ref in self.refs:
+            with self.subTest(ref=ref):
+                cmd = list(map(str, splitter._get_cmd(
+                    splitter._ref_output(ref), stdin=True)))
+                self.assertEqual(cmd[-1], "-")
+                self.assertIn("cram,level=3", cmd)
+                self.assertEqual(cmd[cmd.index("--reference") + 1],
+                                 str(self.fasta))
+                self.assertTrue(cmd[cmd.index("-o") + 1]
+                                .endswith(f"{ref}{path.CRAM_EXT}"))
+
+    @unittest.skipUnless(shutil.which(SAMTOOLS_CMD),
+                         "samtools is not installed")
+    def test_round_trip(self):
+        subprocess.run([SAMTOOLS_CMD, "sort", "-o", str(self.xam.path),
+                        self.sam], check=True)
+        outputs = BamSplitter(self.top_dir, self.xam, self.fasta,
+                              ext=path.CRAM_EXT).run()
+        self.assertEqual(len(outputs), len(self.refs))
+        for ref, output in zip(self.refs, outputs, strict=True):
+            with self.subTest(ref=ref):
+                self.assertEqual(output.ext, path.CRAM_EXT)
+                cram = path.OneRefAlignmentInFilePath(top=self.top,
+                                                      sample="sample",
+                                                      ref=ref,
+                                                      ext=path.CRAM_EXT)
+                os.replace(output.path, cram.path)
+                self.assertEqual(self.view("--reference", self.fasta.path,
+                                           cram.path),
+                                 self.view(self.xam.path, ref))
+                # CRAM is indexed as .cram.crai.
+                index = XamIndexer(self.top_dir, cram,
+                                   ref_fasta=self.fasta).run()
+                self.assertEqual(index.ext, path.CRAI_EXT)
+                self.assertTrue(index.path.is_file())
+                # Reading the CRAM to vectorize it gives the same reads.
+                sam = SamVectorSorter(self.top_dir, cram,
+                                      ref_fasta=self.fasta).run(name=True)
+                self.assertEqual(sorted(self.view(sam.path).splitlines()),
+                                 sorted(self.view(self.xam.path,
+                                                  ref).splitlines()))
+
+
+class TestSamRemoveEqualMappers(TestCase):
+    """ Test filtering reads that map equally well to multiple locations. """
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.remover = SamRemoveEqualMappers(
+            path.TopDirPath(top=self.top),
+            path.RefsetAlignmentInFilePath(top=self.top, sample="sample",
+                                           refset="refs", ext=path.SAM_EXT))
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def filter(self, data: bytes, **kwargs):
+        header = b"@HD\tVN:1.6\tSO:unsorted\n@SQ\tSN:ref\tLN:4\n"
+        samo = io.BytesIO()
+        self.remover.filter_stream(io.BytesIO(header + data), samo, **kwargs)
+        output = samo.getvalue()
+        self.assertTrue(output.startswith(header))
+        return output[len(header):]
+
+    def test_same_as_line_by_line(self):
+        for paired in (False, True):
+            lines = make_scored_sam_lines(500, paired, seed=int(paired))
+            data = b"".join(lines)
+            # Include chunks smaller than one line, a missing final newline,
+            # and (if paired) a trailing mate without its partner.
+            for chunk_size, sam in itertools.product(
+                    [1, 7, 100, 1000, 2 ** 20],
+                    [data, data[:-1], data + lines[0], data + lines[0][:-1]]):
+                with self.subTest(paired=paired, chunk_size=chunk_size,
+                                  n_lines=sam.count(b"\n"), end=sam[-1:]):
+                    expect = filter_line_by_line(sam)
+                    self.assertEqual(self.filter(sam, chunk_size=chunk_size),
+                                     expect)
+                    # Some but not all reads are dropped.
+                    self.assertLess(len(expect), len(sam))
+                    self.assertGreater(len(expect), 0)
+
+    def test_processes(self):
+        for paired in (False, True):
+            with self.subTest(paired=paired):
+                data = b"".join(make_scored_sam_lines(2000, paired))
+                self.assertEqual(self.filter(data, processes=2,
+                                             chunk_size=1000),
+                                 filter_line_by_line(data))
+
+    def test_empty(self):
+        self.assertEqual(self.filter(b""), b"")
+
+    def test_missing_alignment_score(self):
+        data = b"read\t0\tref\t1\t42\t4M\t*\t0\t0\tACGT\tIIII\tXS:i:3\n"
+        with self.assertRaises(ValueError):
+            self.filter(data)
+
+
+class IndexBuilder(CmdExecutor):
+    """ Executor that stands in for bowtie2-build: it writes every file of
+    an index (containing the FASTA) and records each build. """
+
+    def __init__(self, secs: float = 0.0):
+        super().__init__()
+        self.secs = secs
+        self.builds = list()
+        self._lock = threading.Lock()
+
+    def run(self, args, log_dir=None, timeout=None, **kwargs):
+        *_, fasta, prefix = map(str, args)
+        with self._lock:
+            self.builds.append(fasta)
+        # Take long enough for other builds of the same index to overlap.
+        time.sleep(self.secs)
+        with open(fasta, "rb") as f:
+            data = f.read()
+        for ext in Bowtie2IndexCache.INDEX_EXTS:
+            with open(f"{prefix}{ext}.bt2", "wb") as f:
+                f.write(data)
+
+
+class TestBowtie2IndexCache(TestCase):
+    """ Test building each Bowtie 2 index only once. """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.cache_dir, "refs.fa")
+        self.write_fasta(">ref\nACGTACGTACGT\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def write_fasta(self, text: str):
+        with open(self.fasta, "w") as f:
+            f.write(text)
+
+    def read_index(self, prefix: pathlib.Path):
+        with open(f"{prefix}{Bowtie2IndexCache.INDEX_EXTS[0]}.bt2") as f:
+            return f.read()
+
+    def test_hit(self):
+        builder = IndexBuilder()
+        prefix = Bowtie2IndexCache(self.cache_dir,
+                                   executor=builder).get_prefix(self.fasta)
+        self.assertTrue(Bowtie2IndexCache.is_complete(prefix))
+        self.assertEqual(len(builder.builds), 1)
+        # The same contents (even touched, or in another file) hit the cache.
+        os.utime(self.fasta)
+        other = os.path.join(self.cache_dir, "copy.fa")
+        shutil.copyfile(self.fasta, other)
+        for fasta in (self.fasta, other):
+            with self.subTest(fasta=fasta):
+                self.assertEqual(Bowtie2IndexCache(
+                    self.cache_dir, executor=builder).get_prefix(fasta),
+                                 prefix)
+        self.assertEqual(len(builder.builds), 1)
+
+    def test_rebuild_changed(self):
+        builder = IndexBuilder()
+        cache = Bowtie2IndexCache(self.cache_dir, executor=builder)
+        prefix1 = cache.get_prefix(self.fasta)
+        self.write_fasta(">ref\nACGTACGTACGA\n")
+        prefix2 = cache.get_prefix(self.fasta)
+        self.assertNotEqual(prefix2, prefix1)
+        self.assertEqual(len(builder.builds), 2)
+        self.assertEqual(self.read_index(prefix2), ">ref\nACGTACGTACGA\n")
+        # So do different build options.
+        prefix3 = Bowtie2IndexCache(self.cache_dir, ("--seed", 1),
+                                    executor=builder).get_prefix(self.fasta)
+        self.assertNotIn(prefix3, (prefix1, prefix2))
+        self.assertEqual(len(builder.builds), 3)
+
+    def test_rebuild_incomplete(self):
+        builder = IndexBuilder()
+        cache = Bowtie2IndexCache(self.cache_dir, executor=builder)
+        prefix = cache.get_prefix(self.fasta)
+        os.remove(f"{prefix}{Bowtie2IndexCache.INDEX_EXTS[-1]}.bt2")
+        self.assertEqual(cache.get_prefix(self.fasta), prefix)
+        self.assertTrue(Bowtie2IndexCache.is_complete(prefix))
+        self.assertEqual(len(builder.builds), 2)
+
+    def test_concurrent(self):
+        builder = IndexBuilder(secs=0.2)
+        prefixes = list()
+
+        def get_prefix():
+            # Each caller opens the lock file itself, as another process
+            # would.
+            prefixes.append(Bowtie2IndexCache(
+                self.cache_dir, executor=builder).get_prefix(self.fasta))
+
+        threads = [threading.Thread(target=get_prefix) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(builder.builds), 1)
+        self.assertEqual(len(set(prefixes)), 1)
+        self.assertEqual(len(prefixes), 4)
+        self.assertTrue(Bowtie2IndexCache.is_complete(prefixes[0]))
+        # No temporary build directory is left in the cache.
+        self.assertEqual(sorted(file.name for file in
+                                pathlib.Path(self.cache_dir).iterdir()
+                                if file.is_dir()),
+                         [prefixes[0].parent.name])
+
+
+class TestBowtie2IndexSharing(TestCase):
+    """ Test tracking processes that memory-map a cached index. """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = Bowtie2IndexCache(self.cache_dir)
+        self.prefix = pathlib.Path(self.cache_dir, "key",
+                                   Bowtie2IndexCache.INDEX_NAME)
+        self.prefix.parent.mkdir()
+        for ext in Bowtie2IndexCache.INDEX_EXTS:
+            with open(f"{self.prefix}{ext}.bt2", "wb") as f:
+                f.write(b"x" * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_index_size(self):
+        self.assertEqual(Bowtie2IndexCache.index_size(self.prefix),
+                         100 * len(Bowtie2IndexCache.INDEX_EXTS))
+
+    def test_count_users(self):
+        users_dir = pathlib.Path(self.cache_dir, "key.users")
+        with self.cache.sharing(self.prefix) as count_users:
+            self.assertEqual(count_users(), 1)
+            # Another live process using the index.
+            with subprocess.Popen(["sleep", "10"]) as other:
+                users_dir.joinpath(str(other.pid)).touch()
+                self.assertEqual(count_users(), 2)
+                other.kill()
+            # A process that exited without unregistering is not counted.
+            self.assertEqual(count_users(), 1)
+            self.assertFalse(users_dir.joinpath(str(other.pid)).exists())
+        self.assertEqual(list(users_dir.iterdir()), [])
+
+    def test_share_index_during_run(self):
+        # An alignment that starts and finishes while this one runs is
+        # counted, though it is not running at either end of this one.
+        users_dir = pathlib.Path(self.cache_dir, "key.users")
+        aligner = SimpleNamespace(index_cache=self.cache, SHARE_POLL_SECS=0.02)
+        with self.assertLogs(level="INFO") as logs:
+            with FastqAligner.share_index(aligner, self.prefix, True):
+                with subprocess.Popen(["sleep", "10"]) as other:
+                    users_dir.joinpath(str(other.pid)).touch()
+                    time.sleep(0.2)
+                    users_dir.joinpath(str(other.pid)).unlink()
+                    other.kill()
+        self.assertIn("up to 2 concurrent alignments", logs.output[-1])
+
+    def test_fs_type(self):
+        mounts = os.path.join(self.cache_dir, "mounts")
+        with open(mounts, "w") as f:
+            f.write(f"/dev/sda1 / ext4 rw 0 0\n"
+                    f"server:/share {self.cache_dir} nfs4 rw 0 0\n")
+
+        class Cache(Bowtie2IndexCache):
+            MOUNTS_FILE = mounts
+
+        self.assertEqual(Cache(self.cache_dir).fs_type(), "nfs4")
+        self.assertEqual(Cache("/somewhere/else").fs_type(), "ext4")
+        with self.assertLogs(level="WARNING"):
+            Cache(self.cache_dir).check_shareable()
+
+
+if __name__ == "__main__":
+    unittest.main()
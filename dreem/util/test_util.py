@@ -0,0 +1,176 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from dreem.util.util import (AMBIG_INT, MutsBitmap, count_mut_bytes,
+                             query_counts, query_muts, read_section,
+                             read_section_counts)
+
+
+def make_muts(n_vectors: int, n_positions: int, seed: int = 0):
+    """ Return random mutation vectors with every byte value, in which most
+    bytes are those of actual vectors (blank, match, deletion, and one
+    substitution). """
+    rng = np.random.default_rng(seed)
+    muts = rng.integers(0, 256, size=(n_vectors, n_positions), dtype=np.uint8)
+    common = np.array([0, 1, 2, 3, 16, 32, 64, 128, 225], dtype=np.uint8)
+    replace = rng.random(muts.shape) < 0.8
+    muts[replace] = rng.choice(common, size=np.count_nonzero(replace))
+    return muts
+
+
+class TestMutsBitmap(TestCase):
+    """ Test answering queries from a bitmap index of mutation vectors. """
+
+    def test_every_query(self):
+        # Numbers of vectors that do and do not fill the last packed byte.
+        for n_vectors in (1, 8, 203):
+            muts = make_muts(n_vectors, 17, seed=n_vectors)
+            index = MutsBitmap(muts)
+            for set_type in ("subset", "superset"):
+                for bits in range(256):
+                    with self.subTest(n_vectors=n_vectors, set_type=set_type,
+                                      bits=bits):
+                        for axis in (0, 1):
+                            self.assertTrue(np.array_equal(
+                                index.query(bits, axis=axis,
+                                            set_type=set_type),
+                                query_muts(muts, bits, axis=axis,
+                                           set_type=set_type)))
+                        self.assertTrue(np.array_equal(
+                            index.query(bits, sum_up=False,
+                                        set_type=set_type),
+                            query_muts(muts, bits, sum_up=False,
+                                       set_type=set_type)))
+
+    def test_coverage(self):
+        muts = make_muts(100, 10)
+        self.assertTrue(np.array_equal(MutsBitmap(muts).coverage(),
+                                       np.count_nonzero(muts, axis=0)))
+        self.assertTrue(np.array_equal(MutsBitmap(muts).coverage(),
+                                       query_muts(muts, AMBIG_INT)))
+
+    def test_invalid(self):
+        with self.assertRaises(TypeError):
+            MutsBitmap(make_muts(10, 5).astype(np.int8))
+        with self.assertRaises(ValueError):
+            MutsBitmap(make_muts(10, 5)[0])
+        with self.assertRaises(ValueError):
+            MutsBitmap(make_muts(10, 5)).query(1, set_type="other")
+        with self.assertRaises(ValueError):
+            MutsBitmap(make_muts(10, 5)).query(1, axis=2)
+
+
+class TestReadSection(TestCase):
+    """ Test reading one section from a batch of vectors of a longer region.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.orc_file = os.path.join(self.dir, "vectors_0.orc")
+        # Reads that cover only part of the region, as in amplicons.
+        self.muts = make_muts(200, 30)
+        for i, row in enumerate(self.muts):
+            row[: i % 15] = 0
+            row[30 - i % 7:] = 0
+        self.columns = [f"{base}{pos}" for pos, base
+                        in enumerate("ACGTAC" * 5, start=1)]
+        self.names = [f"read{i}" for i in range(len(self.muts))]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, names: bool = False):
+        df = pd.DataFrame(self.muts.view(np.byte), columns=self.columns)
+        if names:
+            df["id"] = self.names
+        df.to_orc(self.orc_file, engine="pyarrow")
+
+    def test_whole(self):
+        self.write()
+        table, kept = read_section(self.orc_file)
+        self.assertIsNone(kept)
+        self.assertEqual(table.column_names, self.columns)
+        np.testing.assert_array_equal(np.array(table, dtype=np.uint8).T,
+                                      self.muts)
+
+    def test_sections(self):
+        self.write(names=True)
+        for first, last, min_cov in [(1, 30, 1), (4, 12, 1), (20, 30, 1),
+                                     (16, 16, 1), (4, 12, 5), (4, 12, 0),
+                                     (None, 10, 1), (25, None, 1)]:
+            with self.subTest(first=first, last=last, min_cov=min_cov):
+                table, kept = read_section(self.orc_file, first, last,
+                                           min_cov)
+                start = 0 if first is None else first - 1
+                end = len(self.columns) if last is None else last
+                section = self.muts[:, start: end]
+                expect = np.count_nonzero(section, axis=1) >= min_cov
+                np.testing.assert_array_equal(kept, expect)
+                self.assertEqual(table.column_names,
+                                 self.columns[start: end] + ["id"])
+                np.testing.assert_array_equal(
+                    np.array(table.drop(["id"]), dtype=np.uint8).T,
+                    section[expect])
+                self.assertEqual(table.column("id").to_pylist(),
+                                 np.array(self.names)[expect].tolist())
+        # Reads that do not cover the section are dropped by default.
+        self.assertLess(len(read_section(self.orc_file, 1, 5)[0]),
+                        len(self.muts))
+
+    def test_outside(self):
+        self.write()
+        for first, last in [(0, 10), (10, 31), (12, 11)]:
+            with self.subTest(first=first, last=last):
+                with self.assertRaises(ValueError):
+                    read_section(self.orc_file, first, last)
+
+    def test_counts(self):
+        self.write(names=True)
+        counts_file = os.path.join(self.dir, "vectors_0.counts.npz")
+        np.savez_compressed(counts_file, counts=count_mut_bytes(self.muts))
+        for first, last in [(None, None), (1, 30), (4, 12), (16, 16),
+                            (25, None)]:
+            with self.subTest(first=first, last=last):
+                counts, columns = read_section_counts(counts_file,
+                                                      self.orc_file,
+                                                      first, last)
+                table, _ = read_section(self.orc_file, first, last)
+                self.assertEqual(columns, table.drop(["id"]).column_names)
+                section = np.array(table.drop(["id"]), dtype=np.uint8).T
+                # The counts differ only in the blanks of reads not kept.
+                np.testing.assert_array_equal(counts[:, 1:],
+                                              count_mut_bytes(section)[:, 1:])
+                self.assertTrue(np.all(counts.sum(axis=1) == len(self.muts)))
+
+
+class TestQueryCounts(TestCase):
+    """ Test answering queries from per-position byte counts. """
+
+    def test_count_mut_bytes(self):
+        muts = make_muts(500, 30)
+        counts = count_mut_bytes(muts)
+        self.assertEqual(counts.shape, (30, 256))
+        self.assertTrue(np.all(counts.sum(axis=1) == 500))
+        for j in range(30):
+            self.assertTrue(np.array_equal(
+                counts[j], np.bincount(muts[:, j], minlength=256)))
+
+    def test_every_query(self):
+        muts = make_muts(500, 30)
+        counts = count_mut_bytes(muts)
+        for set_type in ("subset", "superset"):
+            for bits in range(256):
+                with self.subTest(set_type=set_type, bits=bits):
+                    self.assertTrue(np.array_equal(
+                        query_counts(counts, bits, set_type=set_type),
+                        query_muts(muts, bits, set_type=set_type)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,11 @@
+from hashlib import blake2b
 import json
 import os
 import random
-import shlex
 import subprocess
 import sys
 from tempfile import NamedTemporaryFile
-from typing import List, Set, Dict
+from typing import List, Sequence, Set, Dict
 import yaml
 
 import numpy as np
@@ -13,6 +13,9 @@ import pandas as pd
 import pyarrow.orc  # This prevents: AttributeError: module 'pyarrow' has no attribute 'orc'
 
 from dreem.aggregate import poisson
+from dreem.util import excmd
+from dreem.util.cli import (READ_NAMES_FULL, READ_NAMES_PREFIX,
+                            READ_NAMES_HASH, READ_NAMES_NONE)
 
 
 # CONSTANTS
@@ -95,9 +98,7 @@ def make_cmd(args, module):
     return cmd
 
 def run_cmd(args: List[str], shell: bool = False):
-    os.system(' '.join(args))#, check=True, shell=shell)
-    cmd = shlex.join(args)
-    return cmd
+    return excmd.run_cmd(args, shell)
 
 def name_temp_file(dirname: str, prefix: str, suffix: str):
     file = NamedTemporaryFile(dir=dirname, prefix=prefix, suffix=suffix,
@@ -279,6 +280,324 @@ def sort_fastq_pairs(fq1s, fq2s):
     return fq1s, fq2s, samples
 
 
+def count_mut_bytes(muts: np.ndarray):
+    """
+    Count how many times every byte value occurs at every position of a set
+    of mutation vectors.
+
+    Arguments
+    muts: NDArray (uint8) of a set of mutation vectors (2-dimensional), with
+          one row per vector and one column per position.
+
+    Returns
+    NDArray (int64) with one row per position and 256 columns, one for each
+    byte value, such that counts[j, v] is the number of vectors with byte
+    value v at position j. Each row sums to the number of vectors.
+    """
+    if not muts.dtype == np.uint8:
+        raise TypeError('muts must be of type uint8 and not {}'.format(muts.dtype))
+    # Count column by column to avoid copying the whole array to a wider type.
+    return np.array([np.bincount(col, minlength=256) for col in muts.T],
+                    dtype=np.int64).reshape((muts.shape[1], 256))
+
+
+def read_section(orc_file, first: int | None = None, last: int | None = None,
+                 min_cov: int = 1):
+    """
+    Read the mutation vectors of one section of a reference from a batch of
+    vectors of a longer region (e.g. the whole reference, as vectorized with
+    --whole-refs), so that the vectors of a section need not be written
+    separately. ORC stores each position in its own column, so only the
+    columns of the section are read.
+
+    Arguments
+    orc_file: path of the batch of mutation vectors (.orc)
+    first: 5'-most position of the section (1-indexed), or None for the
+           first position of the batch
+    last: 3'-most position of the section (1-indexed), or None for the last
+          position of the batch
+    min_cov: minimum number of positions of the section that a read must
+             cover (i.e. that are not blank) to be kept, if the batch is
+             sliced
+
+    Returns
+    table: pyarrow Table of the vectors of the section (and of the read
+           names, if the batch has a column 'id') of the reads kept
+    kept: bool NDArray that is True for every read in the batch that was
+          kept, or None if the batch was not sliced (i.e. all reads kept)
+    """
+    orc = pyarrow.orc.ORCFile(orc_file)
+    if first is None and last is None:
+        return orc.read(), None
+    _, columns = _section_columns(orc, orc_file, first, last)
+    table = orc.read(columns=(columns + ['id']) if 'id' in orc.schema.names else columns)
+    muts = np.array(table.select(columns), dtype=np.uint8).T
+    kept = np.count_nonzero(muts, axis=1) >= min_cov
+    return table.filter(kept), kept
+
+
+def _section_columns(orc, orc_file, first: int | None, last: int | None):
+    """ Return the indexes and the names of the columns of the positions of
+    a batch of vectors (an ORCFile) that lie within the section first-last.
+    """
+    names = [name for name in orc.schema.names if name != 'id']
+    positions = [int(name[1:]) for name in names]
+    first = positions[0] if first is None else first
+    last = positions[-1] if last is None else last
+    if not positions[0] <= first <= last <= positions[-1]:
+        raise ValueError('Section {}-{} is not within positions {}-{} of {}'.format(
+            first, last, positions[0], positions[-1], orc_file))
+    indexes = [i for i, pos in enumerate(positions) if first <= pos <= last]
+    return indexes, [names[i] for i in indexes]
+
+
+def read_section_counts(counts_file, orc_file, first: int | None = None, last: int | None = None):
+    """
+    Read the byte counts (see count_mut_bytes) of one section of a reference
+    from those of a batch of vectors of a longer region, without reading the
+    vectors. The reads that read_section drops from a section are blank at
+    every position of the section, and blanks match no query, so the counts
+    of the section are just the rows of its positions.
+
+    Arguments
+    counts_file: path of the byte counts of the batch (.counts.npz)
+    orc_file: path of the batch of mutation vectors (.orc), of which only the
+              names of the columns are read
+    first: 5'-most position of the section (1-indexed), or None for the
+           first position of the batch
+    last: 3'-most position of the section (1-indexed), or None for the last
+          position of the batch
+
+    Returns
+    counts: NDArray (int64) of the byte counts of the section (positions x
+            256)
+    columns: names of the columns of the positions of the section
+    """
+    orc = pyarrow.orc.ORCFile(orc_file)
+    indexes, columns = _section_columns(orc, orc_file, first, last)
+    with np.load(counts_file) as npz:
+        counts = npz['counts']
+    if counts.shape[0] != len(orc.schema.names) - ('id' in orc.schema.names):
+        raise ValueError('Counts in {} do not match the positions of {}'.format(counts_file, orc_file))
+    return counts[indexes], columns
+
+
+def hash_read_name(read_name: str) -> int:
+    """ Return a signed 64-bit hash of a read name. Unlike the built-in
+    hash, it is the same in every process and every run. """
+    digest = blake2b(read_name.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def save_read_names(names_file, names: Sequence[str], read_names: str,
+                    lookup_file=None):
+    """
+    Write the names of the reads of one batch of mutation vectors, in the
+    order of the vectors, to a compressed file next to the batch.
+
+    Arguments
+    names_file: path of the file (.names.npz)
+    names: name of every read in the batch
+    read_names: how to store the names: 'full' names, names minus the
+                prefix shared by the batch ('prefix'), 64-bit hashes of the
+                names ('hash'), or not at all ('none', in which case no file
+                is written)
+    lookup_file: in 'hash' mode, path of a file (.lookup.npz) to which to
+                 write the names by their hashes, to be merged into the
+                 lookup table of the profile (see merge_read_name_lookups)
+
+    Raises ValueError if two different names have the same hash.
+    """
+    if read_names == READ_NAMES_NONE:
+        return
+    if read_names == READ_NAMES_FULL:
+        np.savez_compressed(names_file, names=np.array(
+            [name.encode() for name in names], dtype=bytes))
+    elif read_names == READ_NAMES_PREFIX:
+        # Illumina read names share a long prefix (instrument, run, flow
+        # cell, lane); store it once rather than in every name.
+        prefix = os.path.commonprefix(names) if len(names) > 1 else ""
+        np.savez_compressed(names_file, prefix=np.array(prefix.encode()),
+                            names=np.array([name[len(prefix):].encode()
+                                            for name in names], dtype=bytes))
+    elif read_names == READ_NAMES_HASH:
+        hashes = np.fromiter(map(hash_read_name, names), dtype=np.int64,
+                             count=len(names))
+        if len(np.unique(hashes)) != len(set(names)):
+            raise ValueError(f"Different read names have the same hash in "
+                             f"{names_file}; store the names in full or "
+                             f"without their prefix instead")
+        np.savez_compressed(names_file, hashes=hashes)
+        if lookup_file is not None:
+            np.savez_compressed(lookup_file, hashes=hashes, names=np.array(
+                [name.encode() for name in names], dtype=bytes))
+    else:
+        raise ValueError(f"Invalid value for read_names: '{read_names}'")
+
+
+def merge_read_name_lookups(table_file, lookup_files: Sequence):
+    """
+    Merge the names that save_read_names wrote by their hashes for every
+    batch of a profile into one lookup table of the profile, sorted by hash,
+    and delete the files of the batches. Every name is stored once, however
+    many batches hold its read.
+
+    Arguments
+    table_file: path of the lookup table of the profile (.npz)
+    lookup_files: paths of the names of every batch (.lookup.npz)
+
+    Raises ValueError if two different names have the same hash.
+    """
+    hashes = list()
+    names = list()
+    for lookup_file in lookup_files:
+        with np.load(lookup_file) as lookup:
+            hashes.append(lookup["hashes"])
+            names.append(lookup["names"])
+    hashes = np.concatenate(hashes) if hashes else np.array([], dtype=np.int64)
+    names = np.concatenate(names) if names else np.array([], dtype=bytes)
+    # Keep one name for each hash, in order of the hashes.
+    unique, first = np.unique(hashes, return_index=True)
+    if len(np.unique(names)) != len(unique):
+        raise ValueError(f"Different read names have the same hash in "
+                         f"{table_file}; store the names in full or "
+                         f"without their prefix instead")
+    np.savez_compressed(table_file, hashes=unique, names=names[first])
+    for lookup_file in lookup_files:
+        os.remove(lookup_file)
+
+
+def load_read_names(names_file, table_file=None) -> List[str]:
+    """
+    Return the names of the reads of one batch of mutation vectors, in the
+    order of the vectors, from a file written by save_read_names. If only
+    their hashes were stored, look the names up in the table of the profile
+    (see merge_read_name_lookups), if given; otherwise, return the hashes
+    (as str) instead.
+    """
+    with np.load(names_file) as table:
+        if "hashes" in table:
+            hashes = table["hashes"]
+            if table_file is None:
+                return list(map(str, hashes.tolist()))
+            with np.load(table_file) as lookup:
+                table_hashes = lookup["hashes"]
+                indexes = np.searchsorted(table_hashes, hashes)
+                if not (np.all(indexes < len(table_hashes))
+                        and np.array_equal(table_hashes[indexes], hashes)):
+                    raise ValueError(f"Names of reads in {names_file} are "
+                                     f"missing from {table_file}")
+                return np.char.decode(lookup["names"][indexes]).tolist()
+        names = np.char.decode(table["names"]).tolist()
+        if "prefix" in table:
+            prefix = table["prefix"].item().decode()
+            return [f"{prefix}{name}" for name in names]
+        return names
+
+
+def query_counts(counts: np.ndarray, bits: int, set_type = 'superset'):
+    """
+    Equivalent of query_muts(muts, bits, set_type=set_type) computed from the
+    per-position byte counts of muts (see count_mut_bytes) instead of from
+    muts itself, in O(positions) rather than O(vectors x positions) time.
+
+    Arguments
+    counts: NDArray of per-position byte counts (positions x 256).
+    bits: One-byte int representing the mutation to be queried.
+
+    Returns
+    NDArray with the number of times the query mutation occurs at each
+    position.
+    """
+    # Determine which byte values match the query using query_muts itself,
+    # so that both functions always agree on the logic of the query.
+    matches = query_muts(np.arange(256, dtype=np.uint8), bits,
+                         sum_up=False, set_type=set_type)
+    return counts[:, matches].sum(axis=1)
+
+
+class MutsBitmap(object):
+    """
+    Bitmap index of a set of mutation vectors, built once so that any number
+    of queries can be answered without another pass over the whole array.
+    The index holds one bit-plane for each of the 8 bits of the mutation
+    byte: plane b has one bit per vector at each position, which is 1 if
+    bit b is set in the vector's byte at that position, packed 8 vectors per
+    byte. A query ORs the planes of its bits (and, for subsets, masks out
+    the planes of the other bits), then counts the 1s with a table lookup,
+    touching 1 bit instead of 1 byte per vector for each plane involved.
+
+    Arguments
+    muts: NDArray (uint8) of a set of mutation vectors (2-dimensional), with
+          one row per vector and one column per position.
+    """
+
+    # Number of 1 bits in each byte value
+    POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)],
+                        dtype=np.uint8)
+
+    def __init__(self, muts: np.ndarray):
+        if not muts.dtype == np.uint8:
+            raise TypeError('muts must be of type uint8 and not {}'.format(muts.dtype))
+        if muts.ndim != 2:
+            raise ValueError('muts must be 2-dimensional, but has {} dimensions'.format(muts.ndim))
+        self.num_vectors, self.num_positions = muts.shape
+        # Pack the vectors along the last axis, so that the packed bits of
+        # each position are contiguous: planes[b, j] holds bit b of every
+        # vector at position j.
+        cols = np.ascontiguousarray(muts.T)
+        self.planes = np.stack([np.packbits(cols & (1 << b), axis=1)
+                                for b in range(8)])
+
+    def _any(self, bits: int):
+        """ Packed bits that are 1 wherever a vector has any of the bits. """
+        mask = np.zeros(self.planes.shape[1:], dtype=np.uint8)
+        for b in range(8):
+            if bits & (1 << b):
+                mask |= self.planes[b]
+        return mask
+
+    def match(self, bits: int, set_type = 'superset'):
+        """
+        Return the packed bits (positions x vectors/8) that are 1 wherever a
+        vector matches the query, with the same logic as query_muts.
+        """
+        assert isinstance(bits, int) and 0 <= bits < 256
+        mask = self._any(bits)
+        if set_type == 'subset':
+            # No bit of the vector may lie outside of the query.
+            mask &= ~self._any(AMBIG_INT ^ bits)
+        elif set_type != 'superset':
+            raise ValueError('Invalid set_type: {}'.format(set_type))
+        return mask
+
+    def unpack(self, mask: np.ndarray):
+        """ Return a bool NDArray (vectors x positions) of packed bits. """
+        return np.unpackbits(mask, axis=1,
+                             count=self.num_vectors).T.astype(bool)
+
+    def query(self, bits: int, sum_up = True, axis=0, set_type = 'superset'):
+        """
+        Equivalent of query_muts(muts, bits, sum_up, axis, set_type) for the
+        vectors from which the index was built.
+        """
+        mask = self.match(bits, set_type)
+        if not sum_up:
+            return self.unpack(mask)
+        if axis == 0:
+            # Count the vectors matching the query at each position.
+            return self.POPCOUNT[mask].sum(axis=1, dtype=np.int64)
+        if axis == 1:
+            # Count the positions matching the query in each vector.
+            return np.unpackbits(mask, axis=1, count=self.num_vectors).sum(
+                axis=0, dtype=np.int64)
+        raise ValueError('Invalid axis: {}'.format(axis))
+
+    def coverage(self):
+        """ Count the vectors covering (i.e. not BLANK at) each position. """
+        return self.query(AMBIG_INT)
+
+
 def query_muts(muts: np.ndarray, bits: int, sum_up = True, axis=0, set_type = 'superset'):
     """
     Count the number of times a query mutation occurs in each column
@@ -296,6 +615,8 @@ def query_muts(muts: np.ndarray, bits: int, sum_up = True, axis=0, set_type = 's
        bits: 11110000, muts: 00100000 -> True  AND True  (True)
        bits: 11110000, muts: 00100010 -> True  AND False (False)
        bits: 11110000, muts: 00000000 -> False AND True  (False)
+    Each call scans all of muts; to run several queries on the same set
+    of vectors, build a MutsBitmap of them once and query it instead.
 
     Arguments
     muts: NDArray of a set of mutation vectors (2-dimensional)
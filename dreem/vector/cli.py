@@ -10,6 +10,23 @@ from dreem.util.cli import *
 @opti_primers
 @opti_fill
 @opti_parallel
+@opti_min_mapq
+@opti_flags_req
+@opti_flags_exc
+@opti_min_aln_len
+@opti_max_scl_frac
+@opti_max_mismatches
+@opti_max_indels
+@opti_read_names
+@opti_max_reads
+@opti_sample_seed
+@opti_compress_level
+@opti_samtools_threads
+@opti_whole_refs
+@opti_slow_reads
+@opti_max_read_secs
+@opti_max_cpus
+@opti_max_mem
 @opto_top_dir
 @argi_fasta
 @argi_bams
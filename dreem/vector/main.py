@@ -6,9 +6,15 @@ import subprocess
 import warnings
 
 from dreem.util.util import DNA, run_cmd
-from dreem.util.cli import TOP_DIR, LIBRARY, COORDS, PRIMERS, FILL, PARALLEL
-from dreem.util.path import BAM_EXT
+from dreem.util.cli import TOP_DIR, LIBRARY, COORDS, PRIMERS, FILL, PARALLEL, DEFAULT_MIN_MAPQ, DEFAULT_FLAGS_REQ, \
+    DEFAULT_FLAGS_EXC, DEFAULT_MIN_ALN_LEN, DEFAULT_MAX_SCL_FRAC, DEFAULT_MAX_MISMATCHES, DEFAULT_MAX_INDELS, \
+    DEFAULT_READ_NAMES, DEFAULT_MAX_READS, DEFAULT_SAMPLE_SEED, DEFAULT_COMPRESS_LEVEL, DEFAULT_SAMTOOLS_THREADS, \
+    WHOLE_REFS, DEFAULT_SLOW_READS, DEFAULT_MAX_READ_SECS, DEFAULT_MAX_CPUS, DEFAULT_MAX_MEM
+from dreem.util.governor import configure
+from dreem.util.path import BAM_EXT, CRAM_EXT
+from dreem.util.reads import XamCompression
 from dreem.vector.mprofile import VectorWriterSpawner
+from dreem.vector.samview import SamReadFilter, SlowReadTracker
 from dreem.util.files_sanity import check_library
 
 
@@ -33,7 +39,23 @@ def encode_primers(primers: List[Tuple[str, str, str]]):
 
 def run(fasta: str, bam_dirs: List[str], out_dir: str = TOP_DIR,
         library: str = LIBRARY, coords: list = COORDS, primers: list = PRIMERS,
-        fill: bool = FILL, parallel: str = PARALLEL):
+        fill: bool = FILL, parallel: str = PARALLEL,
+        min_mapq: int = DEFAULT_MIN_MAPQ, flags_req: int = DEFAULT_FLAGS_REQ,
+        flags_exc: int = DEFAULT_FLAGS_EXC,
+        min_aln_len: int = DEFAULT_MIN_ALN_LEN,
+        max_scl_frac: float = DEFAULT_MAX_SCL_FRAC,
+        max_mismatches: int = DEFAULT_MAX_MISMATCHES,
+        max_indels: int = DEFAULT_MAX_INDELS,
+        read_names: str = DEFAULT_READ_NAMES,
+        max_reads: int = DEFAULT_MAX_READS,
+        sample_seed: int = DEFAULT_SAMPLE_SEED,
+        compress_level: int = DEFAULT_COMPRESS_LEVEL,
+        samtools_threads: int = DEFAULT_SAMTOOLS_THREADS,
+        whole_refs: bool = WHOLE_REFS,
+        slow_reads: int = DEFAULT_SLOW_READS,
+        max_read_secs: float = DEFAULT_MAX_READ_SECS,
+        max_cpus: int = DEFAULT_MAX_CPUS,
+        max_mem: float = DEFAULT_MAX_MEM):
     """
     Run the vectoring step.
     Generate a vector encoding mutations for each read
@@ -42,8 +64,39 @@ def run(fasta: str, bam_dirs: List[str], out_dir: str = TOP_DIR,
     FASTA (path): reference sequence(s) in FASTA format
 
     BAM_FILES (paths): list of one or more alignment files (space separated)
-                       in BAM format
+                       in BAM or CRAM format (CRAM is decoded using FASTA)
+
+    Reads failing any of the read filters (min_mapq, flags_req, flags_exc,
+    min_aln_len, max_scl_frac, max_mismatches, max_indels) are skipped before they are
+    vectorized; the number rejected by each filter is written to the report.
+
+    read_names sets how the names of the reads are stored in a file next to
+    each batch, in the order of the vectors: 'full', 'prefix' (without the
+    prefix shared by all reads in the batch), 'hash' (64-bit hashes, plus
+    one table per profile that maps them back to the names), or 'none' (no
+    file). The batches themselves hold only the vectors.
+
+    If max_reads is positive, only a random sample of about max_reads reads
+    (or pairs) from each mutational profile is vectorized; the sample depends
+    only on the read names and sample_seed, and the fraction of reads sampled
+    is written to the report.
+
+    If whole_refs is True, each reference is vectorized end-to-end only once,
+    and no vectors are written for its sections: clustering and aggregation
+    slice the vectors of each section from those of the whole reference when
+    they read them, so a section added later needs no vectoring at all.
+
+    If slow_reads is positive, the time to vectorize each read is measured,
+    and the names and CIGAR strings of the slow_reads slowest reads of each
+    profile are written next to its report. If max_read_secs is positive,
+    any read that takes longer is abandoned and counted in the report as
+    rejected for time; unlike max_indels, this limit depends on the speed
+    of the machine, so the reads it rejects may differ between runs.
+
+    All worker processes share a budget of max_cpus cores and max_mem GiB
+    of memory (0 for no limit besides the available memory).
     """
+    configure(max_cpus, max_mem)
 
     # read library
     if library:
@@ -53,7 +106,20 @@ def run(fasta: str, bam_dirs: List[str], out_dir: str = TOP_DIR,
     bam_files = [os.path.join(bam_dir, bam_file)
                  for bam_dir in bam_dirs
                  for bam_file in os.listdir(bam_dir)
-                 if bam_file.endswith(BAM_EXT)]
+                 if bam_file.endswith((BAM_EXT, CRAM_EXT))]
+    read_filter = SamReadFilter(min_mapq=min_mapq,
+                                flags_req=flags_req,
+                                flags_exc=flags_exc,
+                                min_aln_len=min_aln_len,
+                                max_scl_frac=max_scl_frac,
+                                max_mismatches=max_mismatches,
+                                max_indels=max_indels)
     writers = VectorWriterSpawner(out_dir, fasta, bam_files, coords,
-                                  encode_primers(primers), fill, parallel)
+                                  encode_primers(primers), fill, parallel,
+                                  read_filter, read_names, max_reads,
+                                  sample_seed,
+                                  XamCompression(compress_level,
+                                                 samtools_threads),
+                                  whole_refs,
+                                  SlowReadTracker(slow_reads, max_read_secs))
     writers.profile()
@@ -5,6 +5,8 @@ import itertools
 import os
 import pathlib
 import re
+import sys
+import time
 from tqdm import tqdm
 from datetime import datetime
 from hashlib import file_digest
@@ -13,16 +15,28 @@ from typing import Any, List, Optional, Tuple, Dict
 
 import numpy as np
 import pandas as pd
-
-from dreem.util.dflt import NUM_PROCESSES
+import pyarrow.orc as po
+
+from dreem.util.cli import (READ_NAMES_FULL, READ_NAMES_HASH, READ_NAMES_MODES,
+                            DEFAULT_MAX_READS,
+                            DEFAULT_SAMPLE_SEED, WHOLE_REFS)
+from dreem.util.governor import get_governor, set_governor
+from dreem.util.util import (count_mut_bytes, load_read_names,
+                             merge_read_name_lookups, save_read_names)
 from dreem.util.seq import FastaParser
 from dreem.util import path
 from dreem.util.seq import DNA
-from dreem.vector.samview import SamViewer
+from dreem.util.reads import XamCompression, XamIndexer
+from dreem.vector.samview import (SamViewer, SamReadFilter, SamReadSampler,
+                                  SamWindowViewer, SlowReadTracker,
+                                  count_reads, get_windows, merge_mates)
 from dreem.vector.vector import SamRecord
 
 
 DEFAULT_BATCH_SIZE = 33_554_432  # 2^25 bytes ≈ 33.6 Mb
+BATCH_SAMPLE_READS = 1000  # reads vectorized to measure the cost per read
+MIN_BATCH_SECONDS = 1.0  # least work (s) worth the overhead of a batch file
+MAX_BATCH_MEM_FRAC = 0.5  # most of the available memory batches may use
 
 
 class Region(object):
@@ -92,7 +106,6 @@ class Region(object):
     def columns(self) -> List[str]:
         """ Return a list of the bases and positions in the region of interest,
         each of the form '{base}{position}' (e.g. ['G13', 'C14', 'A15']). """
-        # FIXME: add a column for the read names
         return [f"{chr(base)}{pos}" for base, pos
                 in zip(self.region_seq, self.positions)]
 
@@ -285,8 +298,59 @@ class VectorIO(MutationalProfile):
         return path.MutVectorBatchFilePath(**self.fields,
                                            partition=path.OUTPUT_DIR,
                                            batch=batch_num,
-                                           ext=".orc")
+                                           ext=path.ORC_EXT)
+
+    def get_mv_counts_path(self, batch_num: int):
+        return path.MutVectorBatchFilePath(**self.fields,
+                                           partition=path.OUTPUT_DIR,
+                                           batch=batch_num,
+                                           ext=path.MUT_COUNTS_EXT)
     
+    def get_read_names_path(self, batch_num: int):
+        return path.MutVectorBatchFilePath(**self.fields,
+                                           partition=path.OUTPUT_DIR,
+                                           batch=batch_num,
+                                           ext=path.READ_NAMES_EXT)
+
+    def get_read_names_lookup_path(self, batch_num: int):
+        return path.MutVectorBatchFilePath(**self.fields,
+                                           partition=path.OUTPUT_DIR,
+                                           batch=batch_num,
+                                           ext=path.READ_NAMES_LOOKUP_EXT)
+
+    @property
+    def read_names_table_path(self):
+        return path.MutVectorReadNamesFilePath(**self.fields,
+                                               partition=path.OUTPUT_DIR,
+                                               ext=".npz")
+
+    @property
+    def slow_reads_path(self):
+        return path.MutVectorSlowReadsFilePath(**self.fields,
+                                               partition=path.OUTPUT_DIR,
+                                               ext=".txt")
+
+    def load_read_names(self, batch_num: int) -> List[str]:
+        """
+        Return the names of the reads in one batch, in the same order as
+        their mutation vectors. If only their hashes were stored, look the
+        names up in the table of the profile (or return the hashes, if the
+        profile has no table).
+
+        ** Arguments **
+        batch_num (int) -> number of the batch
+
+        ** Returns **
+        names (list) <---- name of every read in the batch
+        """
+        names_file = self.get_read_names_path(batch_num).path
+        if not names_file.is_file():
+            raise ValueError(f"Batch {batch_num} of {self} has no read names "
+                             f"(they were not stored during vectoring)")
+        table_file = self.read_names_table_path.path
+        return load_read_names(names_file, table_file if table_file.is_file()
+                               else None)
+
     @property
     def batch_nums(self):
         """ List all the batch numbers. """
@@ -296,6 +360,10 @@ class VectorIO(MutationalProfile):
     def mv_batch_paths(self):
         return list(map(self.get_mv_batch_path, self.batch_nums))
 
+    @property
+    def mv_counts_paths(self):
+        return list(map(self.get_mv_counts_path, self.batch_nums))
+
     @classmethod
     def digest_file(cls, path: str) -> str:
         """
@@ -316,9 +384,12 @@ class Report(VectorIO):
     # fields is a dict that maps the name of each field to its data type
     # and defines the order of the fields in the report file.
     fields = {"Sample Name": str, "Ref Name": str, "First": int, "Last": int,
-              "Ref Seq": DNA, "Num Batches": int, "Num Vectors": int,
-              "Checksums": list, "Began": datetime, "Ended": datetime,
-              "Duration": float, "Speed": float}
+              "Ref Seq": DNA, "Num Batches": int, "Batch Size": int,
+              "Num Vectors": int,
+              "Checksums": list, "Read Names": str, "Max Reads": int,
+              "Sample Fraction": float, "Reads Rejected": dict,
+              "Began": datetime,
+              "Ended": datetime, "Duration": float, "Speed": float}
     
     # units is a dict that defines the units of several fields that have them.
     units = {"Speed": "vec/s", "Duration": "s",
@@ -330,7 +401,12 @@ class Report(VectorIO):
     def __init__(self, top_dir: str, sample_name: str, ref_name: str,
                  first: int, last: int, ref_seq: DNA, num_batches: int,
                  num_vectors: int, checksums: List[str],
-                 began: datetime, ended: datetime):
+                 began: datetime, ended: datetime,
+                 reads_rejected: Optional[Dict[str, int]] = None,
+                 read_names: str = READ_NAMES_FULL,
+                 batch_size: int = 0,
+                 max_reads: int = DEFAULT_MAX_READS,
+                 sample_fraction: float = 1.0):
         """
         Initialize a Report object to
         - record information about a mutational profile and its mutation vectors
@@ -353,6 +429,18 @@ class Report(VectorIO):
         num_batches (int) -----> number of batches in the mutational profile
         num_vectors (int) -----> number of vectors in the mutational profile
         checksums (list[str]) -> list of checksums for mutation vector files
+        began (datetime) ------> date and time at which vectoring began
+        ended (datetime) ------> date and time at which vectoring ended
+        reads_rejected (dict) -> number of reads that each read filter
+                                 rejected before vectorization
+        read_names (str) ------> how read names were stored in the batches
+                                 ('full', 'prefix', 'hash', or 'none')
+        batch_size (int) ------> maximum number of reads in each batch
+                                 (0 if not recorded)
+        max_reads (int) -------> maximum number of reads to vectorize
+                                 (0 for no maximum)
+        sample_fraction (float) -> fraction of the reads that were sampled
+                                 for vectorization (1.0 if all of them)
 
         ** Returns **
         None
@@ -361,6 +449,12 @@ class Report(VectorIO):
         self.num_batches = num_batches
         self.num_vectors = num_vectors
         self.checksums = checksums
+        self.reads_rejected = (reads_rejected if reads_rejected is not None
+                               else dict())
+        self.read_names = read_names
+        self.batch_size = batch_size
+        self.max_reads = max_reads
+        self.sample_fraction = sample_fraction
         assert ended >= began
         self.began = began
         self.ended = ended
@@ -411,11 +505,16 @@ class Report(VectorIO):
         if dtype is str or dtype is int or dtype is DNA:
             return val
         if dtype is float:
-            return round(val, 2)
+            # Keep significant digits of small fractions (e.g. of reads
+            # sampled), which two decimal places would round to zero.
+            return round(val, 2) if abs(val) >= 1.0 else float(f"{val:.4g}")
         if dtype is datetime:
             return val.strftime(cls.datetime_fmt)
         if dtype is list:
             return ", ".join(val)
+        if dtype is dict:
+            return ", ".join(f"{key}: {cls.format_val(item)}"
+                             for key, item in val.items())
         raise ValueError(dtype)
 
     @classmethod
@@ -430,6 +529,10 @@ class Report(VectorIO):
             return datetime.strptime(valstr, cls.datetime_fmt)
         if dtype is list:
             return valstr.split(", ")
+        if dtype is dict:
+            # Values of dict fields (e.g. counts of rejected reads) are ints.
+            return {key: int(item) for key, item in
+                    (pair.split(": ") for pair in valstr.split(", ") if pair)}
         raise ValueError(dtype)
 
     def save(self):
@@ -476,7 +579,10 @@ class Report(VectorIO):
 
 
 class VectorWriter(VectorIO):
-    __slots__ = ["bam_path", "parallel_reads", "region_seqb"]
+    __slots__ = ["bam_path", "parallel_reads", "region_seqb", "read_filter",
+                 "reads_rejected", "read_names", "batch_size",
+                 "parallel_coords", "max_reads", "sample_seed",
+                 "sample_fraction", "ref_fasta", "compression", "slow_reads"]
 
     """
     Computes mutation vectors for all reads from one sample mapping to one
@@ -485,22 +591,55 @@ class VectorWriter(VectorIO):
     def __init__(self,
                  top_dir: path.TopDirPath,
                  bam_path: path.RefsetAlignmentInFilePath,
+                 ref_name: str,
                  first: int,
                  last: int,
                  ref_seq: DNA,
-                 parallel_reads: bool):
+                 parallel_reads: bool,
+                 read_filter: SamReadFilter,
+                 read_names: str = READ_NAMES_FULL,
+                 parallel_coords: bool = False,
+                 max_reads: int = DEFAULT_MAX_READS,
+                 sample_seed: int = DEFAULT_SAMPLE_SEED,
+                 ref_fasta=None,
+                 compression: XamCompression | None = None,
+                 slow_reads: SlowReadTracker | None = None):
         sample = bam_path.sample.name
         super().__init__(top_dir, sample, ref_name, first, last, ref_seq)
         self.bam_path = bam_path
         self.parallel_reads = parallel_reads
+        self.parallel_coords = parallel_coords
         self.region_seqb = bytes(self.region_seq)
-
-    def _write_batch(self, read_names: Tuple[str], muts: Tuple[bytearray],
+        self.read_filter = read_filter
+        self.reads_rejected = {key: 0 for key in read_filter.rejected}
+        # Reads abandoned for taking longer than the time limit.
+        self.reads_rejected["time"] = 0
+        if read_names not in READ_NAMES_MODES:
+            raise ValueError(f"Invalid value for read_names: '{read_names}'")
+        self.read_names = read_names
+        self.batch_size = 0
+        self.max_reads = max_reads
+        self.sample_seed = sample_seed
+        self.sample_fraction = 1.0
+        # Reference FASTA and compression policy for samtools, which needs
+        # the reference to read CRAM files.
+        self.ref_fasta = ref_fasta
+        self.compression = compression
+        # Slowest reads of all batches, merged as the batches finish.
+        self.slow_reads = (slow_reads.spawn() if slow_reads is not None
+                           else SlowReadTracker())
+
+    def _write_batch(self, names: Tuple[str], muts: Tuple[bytearray],
                      batch_num: int) -> Tuple[pathlib.Path, int]:
         """
-        Write a batch of mutation vectors to an ORC file.
+        Write a batch of mutation vectors to an ORC file, along with a
+        sidecar file of the number of times each byte value occurs at each
+        position (positions x 256), from which per-position summaries can
+        be computed without reading the vectors again.
 
         ** Arguments **
+        names (tuple) ---> name of the read of each mutation vector, stored
+                           next to the batch according to self.read_names
         muts (NDArray) --> batch of mutation vectors in which each row is a
                            mutation vector and each column is a position in the
                            region of interest
@@ -518,16 +657,35 @@ class VectorWriter(VectorIO):
         muts_array.resize((n_records, self.length))
         # Data must be converted to pd.DataFrame for PyArrow to write.
         # Explicitly set copy=False to copying the mutation vectors.
-        df = pd.DataFrame(data=muts_array, index=read_names,
-                          columns=self.columns, copy=False)
+        df = pd.DataFrame(data=muts_array, columns=self.columns, copy=False)
         mv_file = self.get_mv_batch_path(batch_num).path
         df.to_orc(mv_file, engine="pyarrow")
+        save_read_names(self.get_read_names_path(batch_num).path, names,
+                        self.read_names,
+                        self.get_read_names_lookup_path(batch_num).path)
+        np.savez_compressed(self.get_mv_counts_path(batch_num).path,
+                            counts=count_mut_bytes(muts_array.view(np.uint8)))
         return mv_file, n_records
 
+    def _merge_read_names(self):
+        """ If only the hashes of the read names are stored in the batches,
+        merge the names of all batches into one table for the profile, so
+        that the names can be looked up from the hashes. """
+        if self.read_names == READ_NAMES_HASH:
+            merge_read_name_lookups(
+                self.read_names_table_path.path,
+                [self.get_read_names_lookup_path(batch_num).path
+                 for batch_num in self.batch_nums])
+
     def _write_report(self, t_start: datetime, t_end: datetime):
         Report(self.top_dir, self.sample_name, self.ref_name, self.first,
                self.last, self.ref_seq, self.num_batches, self.num_vectors,
-               self.checksums, t_start, t_end).save()
+               self.checksums, t_start, t_end,
+               reads_rejected=self.reads_rejected,
+               read_names=self.read_names,
+               batch_size=self.batch_size,
+               max_reads=self.max_reads,
+               sample_fraction=self.sample_fraction).save()
 
     def _vectorize_record(self, rec: SamRecord):
         """
@@ -564,60 +722,249 @@ class VectorWriter(VectorIO):
         
         ** Returns **
         n_records (int) <-------- number of records read from the SAM file
-                                  between positions start and stop
+                                  between positions start and stop that
+                                  passed the read filter
         checksum (str) <--------- MD5 checksum of the ORC file of vectors
+        rejected (dict) <-------- number of records that each read filter
+                                  rejected between positions start and stop
+        slow_reads (SlowReadTracker) <- slowest reads of the batch
         """
+        slow_reads = self.slow_reads.spawn()
         if stop > start:
             with sam_viewer as sv:
                 # Use the SAM viewer to generate the mutation vectors.
                 # Collect them as a single, 1-dimensional bytes object.
-                read_names, muts = zip(*map(self._vectorize_record,
-                                            sv.get_records(start, stop)))
+                vectors = list(slow_reads.track(self._vectorize_record,
+                                                sv.get_records(start, stop)))
         else:
-            read_names, muts = (), ()
+            vectors = list()
             raise Warning(f"{self} contained no reads.")
+        n_records, checksum = self._write_vectors(vectors, batch_num)
+        return n_records, checksum, sam_viewer.read_filter.rejected, slow_reads
+
+    def _write_vectors(self, vectors: List[Tuple[str, bytearray]],
+                       batch_num: int):
+        """ Write a batch of (read name, mutation vector) pairs to a file
+        and return the number of vectors and the checksum of the file. """
+        read_names, muts = zip(*vectors) if vectors else ((), ())
         # Write the mutation vectors to a file and compute its checksum.
         mv_file, n_records = self._write_batch(read_names, muts, batch_num)
         checksum = self.digest_file(mv_file)
         return n_records, checksum
 
-    def _vectorize_sam(self):
+    def _vectorize_window(self, sam_window: SamWindowViewer, batch_num: int):
+        """
+        Generate a batch of mutation vectors from the reads that start in one
+        window of the region and write them to an ORC file.
+
+        ** Arguments **
+        sam_window (SamWindowViewer) -> viewer to the window of the BAM file
+        batch_num (int) --------------> non-negative integer label for the batch
+
+        ** Returns **
+        n_records (int) <-------------- number of records vectorized
+        checksum (str) <--------------- MD5 checksum of the ORC file of vectors
+        rejected (dict) <-------------- number of records that each read filter
+                                        rejected in the window
+        slow_reads (SlowReadTracker) <- slowest reads of the window
+        leftovers (list) <------------- SAM lines of mates that start in this
+                                        window but whose partners start in
+                                        another window
+        """
+        slow_reads = self.slow_reads.spawn()
+        vectors = list(slow_reads.track(self._vectorize_record,
+                                        sam_window.get_records()))
+        n_records, checksum = self._write_vectors(vectors, batch_num)
+        return (n_records, checksum, sam_window.read_filter.rejected,
+                slow_reads, sam_window.leftovers)
+
+    def _measure_read_cost(self, sam_viewer: SamViewer):
+        """
+        Vectorize a sample of reads from the start of a SAM file and measure
+        how much time and memory each read costs.
+
+        ** Arguments **
+        sam_viewer (SamViewer) -> viewer to the SAM file (not opened)
+
+        ** Returns **
+        secs (float) <----------- seconds to vectorize one read
+        mem (float) <------------ bytes of memory that one read occupies
+                                  while its batch is held and written
+        (both 0.0 if the SAM file contains no reads)
+        """
+        with sam_viewer as sv:
+            indexes = list(itertools.islice(
+                sv.get_batch_indexes(BATCH_SAMPLE_READS), 2))
+            if len(indexes) < 2:
+                return 0.0, 0.0
+            t_start = time.perf_counter()
+            vectors = list(map(self._vectorize_record,
+                               sv.get_records(*indexes)))
+            t_end = time.perf_counter()
+        if not vectors:
+            return 0.0, 0.0
+        # Each read is held as a tuple of its name and mutation vector in a
+        # list, then copied twice while the batch is converted and written.
+        mem = (sum(sys.getsizeof(name) + sys.getsizeof(muts)
+                   for name, muts in vectors) / len(vectors)
+               + sys.getsizeof(vectors[0]) + 8 + 2 * self.length)
+        return (t_end - t_start) / len(vectors), mem
+
+    def _get_batch_size(self, sam_viewer: SamViewer):
+        """
+        Choose the number of reads per batch. Batches should hold about
+        DEFAULT_BATCH_SIZE bytes in memory, but at least MIN_BATCH_SECONDS
+        of work so that short reads of long regions do not produce many tiny
+        files; and the batches of all processes that may be in memory at
+        once must fit in MAX_BATCH_MEM_FRAC of the memory that the resource
+        governor makes available.
+
+        ** Arguments **
+        sam_viewer (SamViewer) -> viewer to the SAM file (not opened)
+
+        ** Returns **
+        batch_size (int) <------- number of reads per batch
+        """
+        secs, mem = self._measure_read_cost(sam_viewer)
+        if mem <= 0.0:
+            # No reads were sampled, so fall back to the size of the vectors.
+            return max(1, DEFAULT_BATCH_SIZE // self.length)
+        batch_size = int(DEFAULT_BATCH_SIZE / mem)
+        if secs > 0.0:
+            batch_size = max(batch_size, int(MIN_BATCH_SECONDS / secs))
+        governor = get_governor()
+        mem_avail = governor.mem_available() * MAX_BATCH_MEM_FRAC
+        batch_size = min(batch_size,
+                         int(mem_avail / (governor.max_cpus * mem)))
+        return max(1, batch_size)
+
+    def _index_bam(self):
+        """ Index the BAM file if it has no index yet. """
+        XamIndexer(self.top_dir, self.bam_path, ref_fasta=self.ref_fasta,
+                   compression=self.compression).run()
+
+    def _get_sampler(self):
+        """
+        Return a sampler that keeps about max_reads of the reads in the
+        region, or None if there is no maximum or the region has no more
+        reads than the maximum; set sample_fraction accordingly.
+        """
+        self.sample_fraction = 1.0
+        if self.max_reads <= 0:
+            return None
+        if self.spanning:
+            n_reads = count_reads(self.bam_path, ref_fasta=self.ref_fasta)
+        else:
+            self._index_bam()
+            n_reads = count_reads(self.bam_path, self.ref_name,
+                                  self.first, self.last, self.ref_fasta)
+        if n_reads <= self.max_reads:
+            return None
+        self.sample_fraction = self.max_reads / n_reads
+        return SamReadSampler(self.sample_fraction, self.sample_seed)
+
+    def _vectorize_sam(self, sampler: SamReadSampler | None = None):
         with SamViewer(self.top_dir, self.bam_path, self.ref_name,
-                       self.first, self.last, self.spanning) as sv:
-            batch_size = max(1, DEFAULT_BATCH_SIZE // self.length)
-            indexes = list(sv.get_batch_indexes(batch_size))
+                       self.first, self.last, self.spanning,
+                       ref_fasta=self.ref_fasta,
+                       compression=self.compression) as sv:
+            self.batch_size = self._get_batch_size(
+                SamViewer(self.top_dir, sv.sam_path, self.ref_name,
+                          self.first, self.last, self.spanning, owner=False,
+                          read_filter=self.read_filter.spawn()))
+            # Batches are delimited before sampling, so enlarge them to keep
+            # about batch_size reads each after sampling.
+            indexes = list(sv.get_batch_indexes(
+                max(1, round(self.batch_size / self.sample_fraction))))
             starts = indexes[:-1]
             stops = indexes[1:]
             self.num_batches = len(starts)
             assert self.num_batches == len(stops)
             svs = [SamViewer(self.top_dir, sv.sam_path, self.ref_name,
-                             self.first, self.last, self.spanning, owner=False)
+                             self.first, self.last, self.spanning, owner=False,
+                             read_filter=self.read_filter.spawn(),
+                             sampler=sampler)
                    for _ in self.batch_nums]
             args = list(zip(svs, self.batch_nums, starts, stops))
             if self.parallel_reads:
-                n_procs = max(1, min(NUM_PROCESSES, self.num_batches))
-                with Pool(n_procs, maxtasksperchild=1) as pool:
+                governor = get_governor()
+                n_procs = max(1, min(governor.max_cpus, self.num_batches))
+                with governor.reserve(n_procs), Pool(
+                        n_procs, set_governor, (governor.share(n_procs),),
+                        maxtasksperchild=1) as pool:
                     results = pool.starmap(self._vectorize_batch, args,
                                            chunksize=1)
             else:
                 results = list(itertools.starmap(self._vectorize_batch, args))
             assert len(results) == self.num_batches
-            assert self.num_vectors == 0
-            assert len(self.checksums) == 0
-            for num_vectors, checksum in results:
-                self.num_vectors += num_vectors
-                self.checksums.append(checksum)
+            self._add_results(results)
     
+    def _vectorize_sam_coords(self, sampler: SamReadSampler | None = None):
+        """
+        Vectorize the region in windows of coordinates, one batch per window,
+        fetching the reads of each window from the indexed BAM file in a
+        separate process, so that no SAM file sorted by name is needed. The
+        mates of pairs that start in different windows are vectorized in a
+        final batch once all windows have finished.
+        """
+        self._index_bam()
+        governor = get_governor()
+        windows = get_windows(self.first, self.last, governor.max_cpus)
+        n_windows = len(windows)
+        # One batch for each window, plus one batch for the merged mates.
+        self.num_batches = n_windows + 1
+        sam_windows = [SamWindowViewer(self.bam_path, self.ref_name, windows,
+                                       window_num, self.read_filter.spawn(),
+                                       sampler, self.ref_fasta)
+                       for window_num in range(n_windows)]
+        args = list(zip(sam_windows, range(n_windows)))
+        with governor.reserve(n_windows), Pool(
+                n_windows, set_governor, (governor.share(n_windows),),
+                maxtasksperchild=1) as pool:
+            results = pool.starmap(self._vectorize_window, args, chunksize=1)
+        merge_filter = self.read_filter.spawn()
+        merge_slow_reads = self.slow_reads.spawn()
+        leftovers = [line for *_, lines in results for line in lines]
+        vectors = list(merge_slow_reads.track(
+            self._vectorize_record,
+            filter(merge_filter, merge_mates(leftovers))))
+        results.append((*self._write_vectors(vectors, n_windows),
+                        merge_filter.rejected, merge_slow_reads, []))
+        assert len(results) == self.num_batches
+        self._add_results([result[:-1] for result in results])
+
+    def _add_results(self, results: List[Tuple[int, str, Dict[str, int],
+                                               SlowReadTracker]]):
+        """ Add the number of vectors, checksum, rejected reads, and
+        slowest reads of every batch (in order) to those of the profile. """
+        assert self.num_vectors == 0
+        assert len(self.checksums) == 0
+        for num_vectors, checksum, rejected, slow_reads in results:
+            self.num_vectors += num_vectors
+            self.checksums.append(checksum)
+            for key, count in rejected.items():
+                self.reads_rejected[key] += count
+            self.slow_reads.merge(slow_reads)
+        self.reads_rejected["time"] += self.slow_reads.timed_out
+
     def vectorize(self):
         if not (all(f.path.is_file() for f in self.mv_batch_paths)
+                and all(f.path.is_file() for f in self.mv_counts_paths)
                 and self.report_path.path.is_file()):
             self.batch_dir.path.mkdir(parents=True, exist_ok=True)
             print(f"{self}: computing vectors")
             t_start = datetime.now()
-            self._vectorize_sam()
+            sampler = self._get_sampler()
+            if self.parallel_coords:
+                self._vectorize_sam_coords(sampler)
+            else:
+                self._vectorize_sam(sampler)
+            self._merge_read_names()
             t_end = datetime.now()
             print(f"{self}: writing report")
             self._write_report(t_start, t_end)
+            if self.slow_reads.num_slow > 0:
+                self.slow_reads.save(self.slow_reads_path.path)
             print(f"{self}: finished")
 
 
@@ -629,22 +976,41 @@ class VectorWriterSpawner(object):
                  coords: List[Tuple[str, int, int]],
                  primers: List[Tuple[str, DNA, DNA]],
                  fill: bool,
-                 parallel: str):
+                 parallel: str,
+                 read_filter: SamReadFilter,
+                 read_names: str = READ_NAMES_FULL,
+                 max_reads: int = DEFAULT_MAX_READS,
+                 sample_seed: int = DEFAULT_SAMPLE_SEED,
+                 compression: XamCompression | None = None,
+                 whole_refs: bool = WHOLE_REFS,
+                 slow_reads: SlowReadTracker | None = None):
         self.top_dir = TopDirPath.parse_seg(base_dir)
         self.bam_paths = list(map(XamInPath.parse_seg, bam_files))
         self.ref_path = FastaInPath.parse_seg(fasta)
         self.coords = coords
         self.primers = primers
         self.fill = fill
+        self.read_filter = read_filter
+        self.read_names = read_names
+        self.max_reads = max_reads
+        self.sample_seed = sample_seed
+        self.compression = compression
+        self.whole_refs = whole_refs
+        self.slow_reads = slow_reads
         if parallel == "auto":
             parallel = ("reads" if self.num_samples == self.num_regions == 1
                         else "profiles")
+        self.parallel_coords = False
         if parallel == "profiles":
             self.parallel_profiles = True
             self.parallel_reads = False
         elif parallel == "reads":
             self.parallel_profiles = False
             self.parallel_reads = True
+        elif parallel == "coords":
+            self.parallel_profiles = False
+            self.parallel_reads = False
+            self.parallel_coords = True
         elif parallel == "off":
             self.parallel_profiles = False
             self.parallel_reads = False
@@ -704,25 +1070,47 @@ class VectorWriterSpawner(object):
                     add_region(RegionFinder(ref, seq))
         return regions
 
+    def _get_writer(self, bam, ref_name: str, first: int, last: int,
+                    ref_seq: DNA):
+        return VectorWriter(self.top_dir, bam, ref_name, first, last, ref_seq,
+                            self.parallel_reads, self.read_filter,
+                            self.read_names, self.parallel_coords,
+                            self.max_reads, self.sample_seed,
+                            self.ref_path, self.compression,
+                            self.slow_reads)
+
+    def _get_whole_ref_writer(self, bam, ref_name: str):
+        ref_seq = self.ref_seqs[ref_name]
+        return self._get_writer(bam, ref_name, 1, len(ref_seq), ref_seq)
+
     @property
     def writers(self):
         for bam in self.bam_paths:
             print(bam, bam.xam._segment)
             ref_name = bam.xam.name
+            if self.whole_refs:
+                # Vectorize the whole reference once; the vectors of each
+                # section are sliced from it when they are read (see
+                # read_section), so none are written for the sections.
+                if self.regions[ref_name]:
+                    yield self._get_whole_ref_writer(bam, ref_name)
+                continue
             for region in self.regions[ref_name]:
                 assert region.ref_name == ref_name
-                yield VectorWriter(self.top_dir, bam, ref_name,
-                                   region.first, region.last, region.ref_seq,
-                                   self.parallel_reads)
+                yield self._get_writer(bam, ref_name, region.first,
+                                       region.last, region.ref_seq)
 
     def profile(self, processes: int = 0):
         writers = list(self.writers)
         if not writers:
             raise ValueError("No samples and/or regions were given.")
         if self.parallel_profiles:
-            with Pool(processes if processes
-                      else min(NUM_PROCESSES, len(writers)),
-                      maxtasksperchild=1) as pool:
+            governor = get_governor()
+            n_procs = (processes if processes
+                       else min(governor.max_cpus, len(writers)))
+            with governor.reserve(n_procs), Pool(
+                    n_procs, set_governor, (governor.share(n_procs),),
+                    maxtasksperchild=1) as pool:
                 pool.map(VectorWriter.vectorize, writers,
                          chunksize=1)
         else:
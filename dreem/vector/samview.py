@@ -1,13 +1,313 @@
 from __future__ import annotations
+from bisect import bisect_right
 from functools import cached_property, wraps
+from hashlib import blake2b
+import heapq
+import signal
+from time import perf_counter
 from io import BufferedReader
-from typing import Callable, Optional
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
-from dreem.util.reads import XamBase, BamVectorSelector, SamVectorSorter
+from dreem.util.cli import DEFAULT_MIN_MAPQ, DEFAULT_FLAGS_REQ, DEFAULT_FLAGS_EXC, DEFAULT_MIN_ALN_LEN, \
+    DEFAULT_MAX_SCL_FRAC, DEFAULT_MAX_MISMATCHES, DEFAULT_MAX_INDELS, DEFAULT_SAMPLE_SEED, \
+    DEFAULT_SLOW_READS, DEFAULT_MAX_READ_SECS
+from dreem.util.excmd import SAMTOOLS_CMD, iter_cmd_stdout
+from dreem.util.reads import XamCompression, XamIndexer, BamVectorSelector, SamVectorSorter, get_cram_ref_args
 from dreem.util.path import TopDirPath, OneRefAlignmentInFilePath, OneRefAlignmentTempFilePath
 from dreem.vector.vector import *
 
 
+class SamReadFilter(object):
+    """
+    Reject SAM records before they are vectorized, so that no time is spent
+    computing mutation vectors of reads that would be discarded anyway, and
+    count how many records each criterion rejected. A paired-end record is
+    rejected if either mate fails a criterion.
+
+    Arguments
+    min_mapq (int):         minimum mapping quality of every read
+    flags_req (int):        bits that must all be set in every read's flag
+    flags_exc (int):        bits that must all be unset in every read's flag
+    min_aln_len (int):      minimum number of bases of each read that are
+                            aligned to the reference (CIGAR ops M, =, and X)
+    max_scl_frac (float):   maximum fraction of each read that is soft-clipped
+    max_mismatches (int):   maximum number of substitutions (CIGAR op X) in
+                            each read, or NOLIM for no maximum
+    max_indels (int):       maximum number of insertions and deletions (CIGAR
+                            ops I and D) in each read, or NOLIM for no maximum;
+                            reads with many indels are the slowest to vectorize
+    """
+
+    __slots__ = ["min_mapq", "flags_req", "flags_exc", "min_aln_len",
+                 "max_scl_frac", "max_mismatches", "max_indels", "rejected"]
+
+    def __init__(self,
+                 min_mapq: int = DEFAULT_MIN_MAPQ,
+                 flags_req: int = DEFAULT_FLAGS_REQ,
+                 flags_exc: int = DEFAULT_FLAGS_EXC,
+                 min_aln_len: int = DEFAULT_MIN_ALN_LEN,
+                 max_scl_frac: float = DEFAULT_MAX_SCL_FRAC,
+                 max_mismatches: int = DEFAULT_MAX_MISMATCHES,
+                 max_indels: int = DEFAULT_MAX_INDELS):
+        if flags_req & flags_exc:
+            raise ValueError(f"Flags {flags_req & flags_exc} are both "
+                             "required and excluded")
+        if not 0.0 <= max_scl_frac <= 1.0:
+            raise ValueError(f"max_scl_frac ({max_scl_frac}) must be in "
+                             "[0, 1]")
+        self.min_mapq = min_mapq
+        self.flags_req = flags_req
+        self.flags_exc = flags_exc
+        self.min_aln_len = min_aln_len
+        self.max_scl_frac = max_scl_frac
+        self.max_mismatches = max_mismatches
+        self.max_indels = max_indels
+        # Number of records that each criterion rejected, in the order in
+        # which the criteria are checked.
+        self.rejected = {"mapq": 0, "flags": 0, "aln_len": 0,
+                         "scl_frac": 0, "mismatches": 0, "indels": 0}
+
+    @property
+    def criteria(self):
+        return {"min_mapq": self.min_mapq,
+                "flags_req": self.flags_req,
+                "flags_exc": self.flags_exc,
+                "min_aln_len": self.min_aln_len,
+                "max_scl_frac": self.max_scl_frac,
+                "max_mismatches": self.max_mismatches,
+                "max_indels": self.max_indels}
+
+    def spawn(self):
+        """ Return a new filter with the same criteria and no rejections. """
+        return self.__class__(**self.criteria)
+
+    def _check_read(self, read: SamRead):
+        """ Return the name of the first criterion that the read fails, or
+        an empty string if the read passes every criterion. """
+        if read.mapq < self.min_mapq:
+            return "mapq"
+        if self.flags_req or self.flags_exc:
+            flag = read.flag.value
+            if flag & self.flags_req != self.flags_req or flag & self.flags_exc:
+                return "flags"
+        if (self.min_aln_len > 0 or self.max_scl_frac < 1.0
+                or self.max_mismatches != NOLIM or self.max_indels != NOLIM):
+            aln_len = 0
+            scl_len = 0
+            mismatches = 0
+            indels = 0
+            for op, length in parse_cigar(read.cigar):
+                if op == CIG_INS or op == CIG_DEL:
+                    indels += 1
+                elif op == CIG_SCL:
+                    scl_len += length
+                elif op_consumes_read(op) and op_consumes_ref(op):
+                    aln_len += length
+                    if op == CIG_SUB:
+                        mismatches += length
+            if aln_len < self.min_aln_len:
+                return "aln_len"
+            if scl_len > self.max_scl_frac * len(read):
+                return "scl_frac"
+            if self.max_mismatches != NOLIM and mismatches > self.max_mismatches:
+                return "mismatches"
+            if self.max_indels != NOLIM and indels > self.max_indels:
+                return "indels"
+        return ""
+
+    def __call__(self, rec: SamRecord):
+        """ Return whether the record passes the filter; if not, count
+        which criterion rejected it. """
+        for read in (rec.read1, rec.read2):
+            if read is not None and (failed := self._check_read(read)):
+                self.rejected[failed] += 1
+                return False
+        return True
+
+
+class SamReadSampler(object):
+    """
+    Keep a deterministic, seeded random fraction of the reads. Whether a
+    read is kept depends only on its name and the seed, so both mates of a
+    pair are kept or skipped together, every process (batch or window)
+    makes the same choices, and rerunning with the same seed selects the
+    same reads. keep_line chooses from the raw SAM line, so that skipped
+    reads need not be parsed.
+
+    Arguments
+    fraction (float):       fraction of reads to keep (0 < fraction <= 1)
+    seed (int):             seed for the hash of each read name
+    """
+
+    __slots__ = ["fraction", "seed", "_key", "_threshold"]
+
+    HASH_BYTES = 8
+
+    def __init__(self, fraction: float, seed: int = DEFAULT_SAMPLE_SEED):
+        if not 0.0 < fraction <= 1.0:
+            raise ValueError(f"fraction must be in (0, 1], but got {fraction}")
+        self.fraction = fraction
+        self.seed = seed
+        self._key = seed.to_bytes(self.HASH_BYTES, "little", signed=True)
+        self._threshold = int(fraction * 2 ** (8 * self.HASH_BYTES))
+
+    def keep_qname(self, qname: bytes):
+        """ Return whether the read with this name is in the sample. """
+        digest = blake2b(qname, digest_size=self.HASH_BYTES,
+                         key=self._key).digest()
+        return int.from_bytes(digest, "little") < self._threshold
+
+    def keep_line(self, line: bytes):
+        """ Return whether the read on this SAM line is in the sample. """
+        return self.keep_qname(line.split(b"\t", 1)[0])
+
+    def __call__(self, rec: SamRecord):
+        """ Return whether the record is in the sample. """
+        return self.keep_qname(rec.read1.qname)
+
+
+class ReadTimeoutError(Exception):
+    """ A read took longer than the time limit to vectorize. """
+
+
+class SlowReadTracker(object):
+    """
+    Time the vectorization of every read and keep the slowest reads along
+    with their CIGAR strings, which usually reveal why they were slow (e.g.
+    many indels in repetitive sequence), and optionally abandon every read
+    that takes longer than a time limit. The limit is enforced with a
+    real-time interval timer (SIGALRM), so it is available only on Unix and
+    in the main thread of a process, which is where batches are vectorized.
+
+    Arguments
+    num_slow (int):         number of slowest reads to keep (0 for none)
+    max_secs (float):       seconds after which to abandon a read (0 for no
+                            limit)
+    """
+
+    __slots__ = ["num_slow", "max_secs", "slowest", "timed_out", "_timing"]
+
+    def __init__(self, num_slow: int = DEFAULT_SLOW_READS,
+                 max_secs: float = DEFAULT_MAX_READ_SECS):
+        if num_slow < 0:
+            raise ValueError(f"num_slow must be >= 0, but got {num_slow}")
+        if max_secs < 0.0:
+            raise ValueError(f"max_secs must be >= 0, but got {max_secs}")
+        if max_secs > 0.0 and not hasattr(signal, "setitimer"):
+            raise ValueError("max_secs requires interval timers, which are "
+                             "not available on this platform")
+        self.num_slow = num_slow
+        self.max_secs = max_secs
+        # Min-heap of (seconds, read name, CIGAR strings) of the slowest
+        # reads, so that the fastest of them is the first to be replaced.
+        self.slowest: List[Tuple[float, str, str]] = list()
+        # Number of reads abandoned for exceeding max_secs.
+        self.timed_out = 0
+        # Whether a call is being timed (so that an alarm may interrupt it).
+        self._timing = False
+
+    @property
+    def active(self):
+        return self.num_slow > 0 or self.max_secs > 0.0
+
+    def spawn(self):
+        """ Return a new tracker with the same settings and no reads. """
+        return self.__class__(self.num_slow, self.max_secs)
+
+    @staticmethod
+    def get_cigars(rec: SamRecord):
+        return " ".join(read.cigar.decode() for read in (rec.read1, rec.read2)
+                        if read is not None)
+
+    def _push(self, entry: Tuple[float, str, str]):
+        if len(self.slowest) < self.num_slow:
+            heapq.heappush(self.slowest, entry)
+        elif self.slowest and entry[0] > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def _add(self, secs: float, rec: SamRecord):
+        if self.num_slow > 0 and (len(self.slowest) < self.num_slow
+                                  or secs > self.slowest[0][0]):
+            self._push((secs, rec.read_name, self.get_cigars(rec)))
+
+    def _on_alarm(self, signum, frame):
+        # An alarm that goes off after the call has returned (but before the
+        # timer was disarmed) must not interrupt whatever runs next.
+        if self._timing:
+            raise ReadTimeoutError()
+
+    def _call_timed(self, func: Callable, rec: SamRecord):
+        self._timing = True
+        signal.setitimer(signal.ITIMER_REAL, self.max_secs)
+        try:
+            result = func(rec)
+        finally:
+            self._timing = False
+            signal.setitimer(signal.ITIMER_REAL, 0.0)
+        return result
+
+    def track(self, func: Callable, records: Iterable[SamRecord]):
+        """ Yield func(rec) for every record, timing each call and skipping
+        every record for which the call exceeds max_secs. """
+        if not self.active:
+            # Time nothing, so that tracking costs nothing when disabled.
+            yield from map(func, records)
+            return
+        timed = self.max_secs > 0.0
+        if timed:
+            handler = signal.signal(signal.SIGALRM, self._on_alarm)
+        try:
+            for rec in records:
+                t_start = perf_counter()
+                try:
+                    result = (self._call_timed(func, rec) if timed
+                              else func(rec))
+                except ReadTimeoutError:
+                    self.timed_out += 1
+                    self._add(perf_counter() - t_start, rec)
+                    continue
+                self._add(perf_counter() - t_start, rec)
+                yield result
+        finally:
+            if timed:
+                signal.signal(signal.SIGALRM,
+                              signal.SIG_DFL if handler is None else handler)
+
+    def merge(self, other: SlowReadTracker):
+        """ Add the slowest reads and timeouts of another tracker. """
+        self.timed_out += other.timed_out
+        for entry in other.slowest:
+            self._push(entry)
+
+    def save(self, file):
+        """ Write the slowest reads, slowest first, as a table. """
+        with open(file, "w") as f:
+            f.write("Seconds\tRead Name\tCIGAR\n")
+            for secs, name, cigars in sorted(self.slowest, reverse=True):
+                f.write(f"{secs:.6f}\t{name}\t{cigars}\n")
+
+
+def count_reads(xam_path: OneRefAlignmentInFilePath, ref_name: str = "",
+                first: int = 0, last: int = 0, ref_fasta=None):
+    """ Estimate the number of fragments (unpaired reads and pairs of mates,
+    of which SamViewer and merge_mates make one record each) in a BAM or
+    CRAM file, or of those overlapping a region of one reference if given,
+    in which case the file must be indexed. samtools counts the unpaired
+    and the paired reads itself (view -c with flag filters), so no lines
+    reach Python; each paired read counts as half a fragment, so a pair of
+    which only one mate overlaps the region counts as half. """
+    cmd = [SAMTOOLS_CMD, "view", "-c",
+           *get_cram_ref_args((xam_path.ext,), ref_fasta), xam_path]
+    if ref_name:
+        cmd.append(f"{ref_name}:{first}-{last}")
+
+    def count(flag: str):
+        # Flag 1 marks reads that are paired.
+        return int(b"".join(iter_cmd_stdout([*cmd[:3], flag, "1", *cmd[3:]])))
+
+    return count("-F") + (count("-f") + 1) // 2
+
+
 def _requires_open(func: Callable):
     @wraps(func)
     def wrapper(self: SamViewer, *args, **kwargs):
@@ -34,16 +334,11 @@ def _range_of_records(func: Callable):
     @_reset_seek
     def wrapper(self: SamViewer, start: int, stop: int):
         self._sam_file.seek(start)
-        records = iter(func(self))
-        if stop is None:
-            return records
-        else:
-            while True:
-                if self._sam_file.tell() < stop:
-                    yield next(records)
-                else:
-                    assert self._sam_file.tell() == stop
-                    break
+        # The records end at stop, after any read still waiting for its
+        # mate has been yielded.
+        yield from func(self, stop)
+        if stop is not None:
+            assert self._sam_file.tell() == stop
     return wrapper
 
 
@@ -55,7 +350,11 @@ class SamViewer(object):
                  first: int,
                  last: int,
                  spanning: bool,
-                 owner: bool = True):
+                 owner: bool = True,
+                 read_filter: SamReadFilter | None = None,
+                 sampler: SamReadSampler | None = None,
+                 ref_fasta=None,
+                 compression: XamCompression | None = None):
         self.top_dir = top_dir
         self.xam_path = xam_path
         self.ref_name = ref_name
@@ -63,6 +362,10 @@ class SamViewer(object):
         self.last = last
         self.spanning = spanning
         self.owner = owner
+        self.read_filter = read_filter
+        self.sampler = sampler
+        self.ref_fasta = ref_fasta
+        self.compression = compression
         self._sam_path: (OneRefAlignmentInFilePath |
                          OneRefAlignmentTempFilePath |
                          None) = None
@@ -75,17 +378,20 @@ class SamViewer(object):
                 selector = None
                 xam_path = self.xam_path
             else:
-                xam_base = XamBase(self.top_dir, self.xam_path)
-                xam_index = xam_base.xam_index
-                if not xam_index.path.is_file():
-                    assert xam_base.create_index().path == xam_index.path
+                XamIndexer(self.top_dir, self.xam_path,
+                           ref_fasta=self.ref_fasta,
+                           compression=self.compression).run()
                 selector = BamVectorSelector(self.top_dir,
                                              self.xam_path,
                                              self.ref_name,
                                              self.first,
-                                             self.last)
+                                             self.last,
+                                             ref_fasta=self.ref_fasta,
+                                             compression=self.compression)
                 xam_path = selector.run()
-            sorter = SamVectorSorter(self.top_dir, xam_path)
+            sorter = SamVectorSorter(self.top_dir, xam_path,
+                                     ref_fasta=self.ref_fasta,
+                                     compression=self.compression)
             self._sam_path = sorter.run(name=True)
             if selector:
                 selector.clean()
@@ -130,16 +436,26 @@ class SamViewer(object):
         first_line = self._sam_file.readline()
         return SamRead(first_line).flag.paired if first_line else False
     
+    def _readline(self, stop: int | None):
+        """ Return the next line of a read in the sample, skipping the lines
+        of other reads without parsing them, or b"" upon reaching stop or
+        the end of the file. """
+        while stop is None or self._sam_file.tell() < stop:
+            line = self._sam_file.readline()
+            if not line or self.sampler is None or self.sampler.keep_line(line):
+                return line
+        return b""
+
     @_range_of_records
-    def _get_records_single(self):
-        while read := SamRead(self._sam_file.readline()):
+    def _get_records_single(self, stop: int | None):
+        while read := SamRead(self._readline(stop)):
             assert not read.flag.paired
             yield SamRecord(read)
 
     @_range_of_records
-    def _get_records_paired_flexible(self):
+    def _get_records_paired_flexible(self, stop: int | None):
         prev_read: Optional[SamRead] = None
-        while line := self._sam_file.readline():
+        while line := self._readline(stop):
             read = SamRead(line)
             assert read.flag.paired
             if prev_read:
@@ -169,9 +485,10 @@ class SamViewer(object):
             yield SamRecord(prev_read)
     
     @_range_of_records
-    def _get_records_paired_strict(self):
-        while line := self._sam_file.readline():
-            yield SamRecord(SamRead(line), SamRead(self._sam_file.readline()))
+    def _get_records_paired_strict(self, stop: int | None):
+        while line := self._readline(stop):
+            # Both mates have the same name, so both are in the sample.
+            yield SamRecord(SamRead(line), SamRead(self._readline(stop)))
     
     def get_records(self, start: int, stop: int):
         if self.paired:
@@ -181,7 +498,12 @@ class SamViewer(object):
                 records = self._get_records_paired_flexible
         else:
             records = self._get_records_single
-        return records(start, stop)
+        # Reads not in the sample are skipped before they are parsed, so
+        # no time is spent on them and only sampled reads can be rejected.
+        records = records(start, stop)
+        if self.read_filter is None:
+            return records
+        return filter(self.read_filter, records)
     
     @_reset_seek
     def get_batch_indexes(self, batch_size: int):
@@ -216,3 +538,158 @@ class SamViewer(object):
                                 # (the lines do not come from two paired mates),
                                 # then backtrack to the beginning of line_next.
                                 self._sam_file.seek(-len(line_next), 1)
+
+
+def get_windows(first: int, last: int, n_windows: int):
+    """ Split the positions from first to last (inclusive) into at most
+    n_windows contiguous windows of nearly equal length, as a list of the
+    (first, last) positions of each window. """
+    length = last - first + 1
+    n_windows = max(1, min(n_windows, length))
+    starts = [first + (length * i) // n_windows for i in range(n_windows)]
+    lasts = [start - 1 for start in starts[1:]] + [last]
+    return list(zip(starts, lasts))
+
+
+class SamWindowViewer(object):
+    """
+    View the reads in one window (shard) of a region directly from an
+    indexed BAM file, in coordinate order, without sorting by name. Every
+    read that overlaps the window is returned by samtools, so a read that
+    spans several windows is seen by several viewers; to vectorize each
+    read exactly once, the viewer of a window keeps only the reads that
+    start in it (reads that start before the region count as starting in
+    the first window).
+
+    The mates of a pair that start in the same window are vectorized
+    together by the viewer of that window. If the mates start in different
+    windows, the viewer of each mate's window sets it aside in leftovers,
+    and merge_mates pairs the leftovers from all windows afterwards.
+
+    Arguments
+    xam_path (path):        indexed BAM file
+    ref_name (str):         name of the reference
+    windows (list):         (first, last) positions of every window
+    window_num (int):       index of this viewer's window in windows
+    read_filter (SamReadFilter): filter for the records (optional)
+    sampler (SamReadSampler): sampler for the reads (optional)
+    ref_fasta (path):       reference FASTA, needed if xam_path is CRAM
+    """
+
+    def __init__(self,
+                 xam_path: OneRefAlignmentInFilePath,
+                 ref_name: str,
+                 windows: List[Tuple[int, int]],
+                 window_num: int,
+                 read_filter: SamReadFilter | None = None,
+                 sampler: SamReadSampler | None = None,
+                 ref_fasta=None):
+        self.xam_path = xam_path
+        self.ref_name = ref_name
+        self.windows = windows
+        self.window_num = window_num
+        self.read_filter = read_filter
+        self.sampler = sampler
+        self.ref_fasta = ref_fasta
+        self.leftovers: List[bytes] = list()
+
+    @cached_property
+    def _starts(self):
+        return [first for first, _ in self.windows]
+
+    def window_of(self, pos: int):
+        """ Return the index of the window containing a position; positions
+        before the region map to the first window, and positions after it to
+        len(windows). """
+        if pos > self.windows[-1][1]:
+            return len(self.windows)
+        return max(0, bisect_right(self._starts, pos) - 1)
+
+    def _mate_window(self, line: bytes, read: SamRead):
+        """ Return the window in which the mate of a read starts, or None if
+        the read has no mate on the same reference. """
+        if not read.flag.paired or read.flag.munmap:
+            return None
+        rnext, pnext = line.split(b"\t", 8)[6:8]
+        if rnext != b"=" and rnext != read.rname:
+            return None
+        return self.window_of(int(pnext))
+
+    def _iter_lines(self):
+        first, last = self.windows[self.window_num]
+        lines = iter_cmd_stdout([
+            SAMTOOLS_CMD, "view",
+            *get_cram_ref_args((self.xam_path.ext,), self.ref_fasta),
+            self.xam_path, f"{self.ref_name}:{first}-{last}"])
+        if self.sampler is None:
+            yield from lines
+        else:
+            yield from filter(self.sampler.keep_line, lines)
+
+    def _iter_records(self):
+        # Reads whose mates have not yet been seen, keyed by query name.
+        pending: Dict[bytes, Tuple[bytes, SamRead]] = dict()
+        for line in self._iter_lines():
+            read = SamRead(line)
+            if not read.flag.paired:
+                if self.window_of(read.pos) == self.window_num:
+                    yield SamRecord(read)
+                continue
+            if (mate := pending.pop(read.qname, None)) is None:
+                pending[read.qname] = line, read
+                continue
+            # Both mates overlap this window.
+            mate_line, mate_read = mate
+            win1 = self.window_of(mate_read.pos)
+            win2 = self.window_of(read.pos)
+            if win1 == win2:
+                if win1 == self.window_num:
+                    if mate_read.flag.first:
+                        yield SamRecord(mate_read, read)
+                    else:
+                        yield SamRecord(read, mate_read)
+            else:
+                # The mates start in different windows: each is set aside by
+                # the viewer of the window in which it starts.
+                if win1 == self.window_num:
+                    self.leftovers.append(mate_line)
+                if win2 == self.window_num:
+                    self.leftovers.append(line)
+        # Only one mate of each of these pairs overlaps this window.
+        for line, read in pending.values():
+            if self.window_of(read.pos) != self.window_num:
+                continue
+            mate_win = self._mate_window(line, read)
+            if mate_win is None or mate_win == self.window_num:
+                # The mate does not overlap the region: if it started in
+                # this window, it would overlap this window too.
+                yield SamRecord(read)
+            else:
+                self.leftovers.append(line)
+
+    def get_records(self):
+        """ Yield the records to vectorize in this window; once exhausted,
+        leftovers holds the lines of mates to be paired by merge_mates. """
+        self.leftovers.clear()
+        if self.read_filter is None:
+            return self._iter_records()
+        return filter(self.read_filter, self._iter_records())
+
+
+def merge_mates(lines: Iterable[bytes]):
+    """ Pair up the mates that SamWindowViewers set aside because they start
+    in different windows; a mate whose partner is absent (i.e. does not
+    overlap the region) becomes a record by itself. """
+    mates: Dict[bytes, List[SamRead]] = dict()
+    for line in lines:
+        read = SamRead(line)
+        mates.setdefault(read.qname, list()).append(read)
+    for reads in mates.values():
+        if len(reads) == 1:
+            yield SamRecord(reads[0])
+        else:
+            read1, read2 = reads
+            if read1.flag.first:
+                yield SamRecord(read1, read2)
+            else:
+                yield SamRecord(read2, read1)
@@ -1,15 +1,39 @@
 import os
 import itertools
+import random
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
 import unittest
-from unittest import TestCase
+from collections import Counter
+from types import SimpleNamespace
+from unittest import TestCase, mock
 
+import numpy as np
+import pyarrow.orc as po
+
+from dreem.util import path
+from dreem.util.governor import ResourceGovernor, get_governor, set_governor
+from dreem.util.seq import DNA
 from dreem.util.util import *
 from dreem.vector.vector import *
+from dreem.vector.samview import SamReadFilter, SamReadSampler, SamViewer, SamWindowViewer, SlowReadTracker, \
+    count_reads, get_windows, merge_mates
+from dreem.vector.mprofile import (BATCH_SAMPLE_READS, DEFAULT_BATCH_SIZE,
+                                   MAX_BATCH_MEM_FRAC, MIN_BATCH_SECONDS,
+                                   VectorWriter)
 
 
 
 class TestConsensusByte(TestCase):
-    pass
+    def test_consensus_muts_all_bytes(self):
+        bytes1, bytes2 = zip(*itertools.product(range(256), repeat=2))
+        expect = bytes(map(get_consensus_mut, bytes1, bytes2))
+        muts = get_consensus_muts(np.array(bytes1, dtype=np.uint8),
+                                  np.array(bytes2, dtype=np.uint8))
+        self.assertTrue(muts.tobytes() == expect)
 
 
 
@@ -50,6 +74,10 @@ class TestSamFlag(TestCase):
             real_flags = list(reversed(flags))
             self.assertListEqual(sf_flags, real_flags)
 
+    def test_flags_value(self):
+        for flag in range(SamFlag.MAX_FLAG + 1):
+            self.assertEqual(SamFlag(flag).value, flag)
+
     # invalid flags
 
     def test_flag_4096(self):
@@ -106,6 +134,162 @@ class TestSamRead(TestCase):
             SamRead(line)
 
 
+class TestSamReadFilter(TestCase):
+    line = b"Q	99	R	1	35	2S6=1X1=	=	1	10	ACGTACGTAC	IIIIIIIIII"
+
+    def test_pass_defaults(self):
+        rfilter = SamReadFilter()
+        self.assertTrue(rfilter(SamRecord(SamRead(self.line))))
+        self.assertEqual(sum(rfilter.rejected.values()), 0)
+
+    def test_reject_mapq(self):
+        rfilter = SamReadFilter(min_mapq=36)
+        self.assertFalse(rfilter(SamRecord(SamRead(self.line))))
+        self.assertEqual(rfilter.rejected["mapq"], 1)
+
+    def test_reject_flags(self):
+        rec = SamRecord(SamRead(self.line))
+        self.assertTrue(SamReadFilter(flags_req=3, flags_exc=16)(rec))
+        rfilter = SamReadFilter(flags_exc=32)
+        self.assertFalse(rfilter(rec))
+        self.assertEqual(rfilter.rejected["flags"], 1)
+
+    def test_reject_cigar(self):
+        rec = SamRecord(SamRead(self.line))
+        self.assertTrue(SamReadFilter(min_aln_len=8, max_scl_frac=0.2,
+                                      max_mismatches=1)(rec))
+        for criterion, kwargs in [("aln_len", {"min_aln_len": 9}),
+                                  ("scl_frac", {"max_scl_frac": 0.1}),
+                                  ("mismatches", {"max_mismatches": 0})]:
+            rfilter = SamReadFilter(**kwargs)
+            self.assertFalse(rfilter(rec))
+            self.assertEqual(rfilter.rejected[criterion], 1)
+
+    def test_reject_indels(self):
+        rec = SamRecord(SamRead(b"Q	0	R	1	35	3=1I2=1D4=	*	0	0	ACGTACGTAC	IIIIIIIIII"))
+        self.assertTrue(SamReadFilter(max_indels=2)(rec))
+        rfilter = SamReadFilter(max_indels=1)
+        self.assertFalse(rfilter(rec))
+        self.assertEqual(rfilter.rejected["indels"], 1)
+
+    def test_spawn(self):
+        rfilter = SamReadFilter(min_mapq=36)
+        rfilter(SamRecord(SamRead(self.line)))
+        spawn = rfilter.spawn()
+        self.assertEqual(spawn.criteria, rfilter.criteria)
+        self.assertEqual(sum(spawn.rejected.values()), 0)
+
+
+class TestSamReadSampler(TestCase):
+    qnames = [f"FS10000136:97:BPN80019-0831:1:1101:{i}:1040".encode()
+              for i in range(20000)]
+
+    def test_fraction(self):
+        for fraction in (0.01, 0.1, 0.5):
+            sampler = SamReadSampler(fraction, seed=3)
+            kept = sum(map(sampler.keep_qname, self.qnames))
+            self.assertAlmostEqual(kept / len(self.qnames), fraction,
+                                   delta=0.01)
+
+    def test_keep_all(self):
+        sampler = SamReadSampler(1.0)
+        self.assertTrue(all(map(sampler.keep_qname, self.qnames)))
+
+    def test_deterministic(self):
+        kept1 = list(map(SamReadSampler(0.2, seed=1).keep_qname, self.qnames))
+        kept2 = list(map(SamReadSampler(0.2, seed=1).keep_qname, self.qnames))
+        kept3 = list(map(SamReadSampler(0.2, seed=2).keep_qname, self.qnames))
+        self.assertEqual(kept1, kept2)
+        self.assertNotEqual(kept1, kept3)
+
+    def test_mates_together(self):
+        line1 = b"Q	99	R	1	40	4=	=	5	0	ACGT	IIII"
+        line2 = b"Q	147	R	5	40	4=	=	1	0	ACGT	IIII"
+        for seed in range(50):
+            sampler = SamReadSampler(0.5, seed=seed)
+            keep = sampler.keep_line(line1)
+            self.assertEqual(sampler.keep_line(line2), keep)
+            self.assertEqual(sampler(SamRecord(SamRead(line1),
+                                               SamRead(line2))), keep)
+
+    def test_invalid_fraction(self):
+        for fraction in (0.0, -0.5, 1.5):
+            with self.assertRaises(ValueError):
+                SamReadSampler(fraction)
+
+
+class TestSlowReadTracker(TestCase):
+    recs = [SamRecord(SamRead(f"Q{i}	0	R	1	35	{i}M	*	0	0	{'A' * i}	{'I' * i}".encode()))
+            for i in range(1, 11)]
+
+    @staticmethod
+    def cost(rec: SamRecord):
+        # Stand in for the time to vectorize a read with a known cost.
+        return len(rec.read1)
+
+    @classmethod
+    def slow(cls, rec: SamRecord):
+        # Take longer the higher the cost of the read.
+        time.sleep(0.01 * cls.cost(rec))
+        return cls.cost(rec)
+
+    def test_inactive(self):
+        tracker = SlowReadTracker()
+        self.assertEqual(list(tracker.track(self.cost, self.recs)),
+                         list(map(self.cost, self.recs)))
+        self.assertEqual(tracker.slowest, [])
+
+    def test_keep_slowest(self):
+        tracker = SlowReadTracker(num_slow=3)
+        self.assertEqual(list(tracker.track(self.cost, self.recs)),
+                         list(map(self.cost, self.recs)))
+        self.assertEqual(len(tracker.slowest), 3)
+        tracker = SlowReadTracker(num_slow=3)
+        self.assertEqual(list(tracker.track(self.slow, self.recs)),
+                         list(map(self.cost, self.recs)))
+        self.assertEqual([(name, cigars) for _, name, cigars
+                          in sorted(tracker.slowest, reverse=True)],
+                         [("Q10", "10M"), ("Q9", "9M"), ("Q8", "8M")])
+        self.assertGreaterEqual(min(secs for secs, _, _ in tracker.slowest), 0.08)
+
+    def test_merge(self):
+        tracker1 = SlowReadTracker(num_slow=2)
+        tracker2 = tracker1.spawn()
+        for tracker, recs in [(tracker1, self.recs[:5]),
+                              (tracker2, self.recs[5:])]:
+            list(tracker.track(self.slow, recs))
+        tracker2.timed_out = 1
+        tracker1.merge(tracker2)
+        self.assertEqual(sorted(name for _, name, _ in tracker1.slowest),
+                         ["Q10", "Q9"])
+        self.assertEqual(tracker1.timed_out, 1)
+
+    def test_time_limit(self):
+        def slow(rec: SamRecord):
+            if rec.read_name == "Q5":
+                while True:
+                    pass
+            return rec.read_name
+        tracker = SlowReadTracker(max_secs=0.01)
+        names = list(tracker.track(slow, self.recs))
+        self.assertEqual(len(names), 9)
+        self.assertNotIn("Q5", names)
+        self.assertEqual(tracker.timed_out, 1)
+        # The timer is disarmed after every call.
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL), (0.0, 0.0))
+
+    def test_late_alarm(self):
+        tracker = SlowReadTracker(max_secs=10.)
+        results = list()
+        for result in tracker.track(self.cost, self.recs):
+            results.append(result)
+            # An alarm between calls (e.g. one that went off just after a
+            # call returned) abandons no read and raises no error.
+            signal.raise_signal(signal.SIGALRM)
+        self.assertEqual(results, list(map(self.cost, self.recs)))
+        self.assertEqual(tracker.timed_out, 0)
+
+
 class TestParseCigar(TestCase):
     # valid CIGAR strings
 
@@ -713,6 +897,569 @@ class TestVectorizePair(TestCase):
         muts = vectorize_pair(ref, first, last, SamRead(line1), SamRead(line2))
         self.assertTrue(muts == expect)
 
+    def test_valid_partial_overlap(self):
+        ref = b"ACGTACGT"
+        first, last = 1, 8
+        line1 = b"Q	0	R	1	100	5=	*	*	4	ACGTA	IIIII"
+        line2 = b"Q	0	R	4	100	4=1X	*	*	4	TACGA	II!II"
+        SUB_C_N = (ANY_N[0] ^ SUB_C[0]).to_bytes()
+        expect = MATCH * 5 + SUB_C_N + MATCH + SUB_A
+        muts = vectorize_pair(ref, first, last, SamRead(line1), SamRead(line2))
+        self.assertTrue(muts == expect)
+
+
+class TestHashReadName(TestCase):
+    def test_hash_stable(self):
+        name = "FS10000136:97:BPN80019-0831:1:1101:1000:1090"
+        self.assertEqual(hash_read_name(name), hash_read_name(name))
+
+    def test_hash_int64(self):
+        for name in ("", "read", "FS10000136:97:BPN80019-0831:1:1101:1000:1090"):
+            self.assertTrue(-2**63 <= hash_read_name(name) < 2**63)
+
+    def test_hash_distinct(self):
+        names = [f"read_{i}" for i in range(10000)]
+        self.assertEqual(len(set(map(hash_read_name, names))), len(names))
+
+
+class TestSaveReadNames(TestCase):
+    names = [f"FS10000136:97:BPN80019-0831:1:1101:{i}:1090" for i in range(50)]
+
+    def setUp(self):
+        self.names_file = os.path.join(tempfile.mkdtemp(), "vectors_0.names.npz")
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.names_file))
+
+    def test_full_and_prefix(self):
+        for read_names in ("full", "prefix"):
+            for names in ([], self.names[:1], self.names, self.names + self.names[:3]):
+                with self.subTest(read_names=read_names, n=len(names)):
+                    save_read_names(self.names_file, names, read_names)
+                    self.assertEqual(load_read_names(self.names_file), names)
+
+    def test_hash(self):
+        save_read_names(self.names_file, self.names, "hash")
+        self.assertEqual(load_read_names(self.names_file),
+                         [str(hash_read_name(name)) for name in self.names])
+        with np.load(self.names_file) as table:
+            # The names themselves are not stored.
+            self.assertEqual(list(table), ["hashes"])
+
+    def test_hash_collision(self):
+        # The same name twice is not a collision, but two names with one hash are.
+        save_read_names(self.names_file, self.names[:2] * 2, "hash")
+        with mock.patch("dreem.util.util.hash_read_name", return_value=0):
+            with self.assertRaises(ValueError):
+                save_read_names(self.names_file, self.names[:2], "hash")
+
+    def test_none(self):
+        save_read_names(self.names_file, self.names, "none")
+        self.assertFalse(os.path.exists(self.names_file))
+
+    def save_batches(self, batches: list):
+        """ Save the names of every batch in 'hash' mode and merge them into
+        the lookup table of the profile. """
+        directory = os.path.dirname(self.names_file)
+        table_file = os.path.join(directory, "1-10_read_names.npz")
+        lookup_files = list()
+        for batch_num, names in enumerate(batches):
+            lookup_files.append(os.path.join(directory,
+                                             f"vectors_{batch_num}.lookup.npz"))
+            save_read_names(os.path.join(directory,
+                                         f"vectors_{batch_num}.names.npz"),
+                            names, "hash", lookup_files[-1])
+        merge_read_name_lookups(table_file, lookup_files)
+        return table_file
+
+    def test_hash_lookup(self):
+        # A name may occur in more than one batch (e.g. of two sections).
+        batches = [self.names[:20], [], self.names[10:]]
+        table_file = self.save_batches(batches)
+        directory = os.path.dirname(self.names_file)
+        for batch_num, names in enumerate(batches):
+            with self.subTest(batch_num=batch_num):
+                self.assertEqual(load_read_names(os.path.join(
+                    directory, f"vectors_{batch_num}.names.npz"), table_file),
+                    names)
+                self.assertFalse(os.path.exists(os.path.join(
+                    directory, f"vectors_{batch_num}.lookup.npz")))
+        with np.load(table_file) as table:
+            # Every name is stored once in the table.
+            self.assertEqual(len(table["names"]), len(self.names))
+
+    def test_hash_lookup_missing(self):
+        table_file = self.save_batches([self.names[:10]])
+        save_read_names(self.names_file, self.names[5:15], "hash")
+        with self.assertRaises(ValueError):
+            load_read_names(self.names_file, table_file)
+
+    def test_hash_lookup_collision(self):
+        # Names in different batches may collide only in the table.
+        with mock.patch("dreem.util.util.hash_read_name", return_value=0):
+            with self.assertRaises(ValueError):
+                self.save_batches([self.names[:1], self.names[1:2]])
+
+
+class TestVectorWriterReadNames(TestCase):
+    """ Test looking up the names of the reads of a profile vectorized with
+    only the hashes of the names in its batches. """
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def test_hash_lookup(self):
+        ref_seq = DNA(b"ACGTACGTAC")
+        writer = VectorWriter(self.top,
+                              SimpleNamespace(
+                                  sample=SimpleNamespace(name="sample")),
+                              "ref", 1, len(ref_seq), ref_seq, False,
+                              SamReadFilter(), "hash")
+        writer.get_mv_batch_path(0).path.parent.mkdir(parents=True)
+        batches = [[f"FS10000136:97:BPN80019-0831:1:1101:{i}:1090"
+                    for i in range(start, start + 30)] for start in (0, 30)]
+        for batch_num, names in enumerate(batches):
+            writer._write_batch(names, [bytes(len(ref_seq))] * len(names),
+                                batch_num)
+        writer.num_batches = len(batches)
+        writer._merge_read_names()
+        self.assertTrue(writer.read_names_table_path.path.is_file())
+        for batch_num, names in enumerate(batches):
+            self.assertEqual(writer.load_read_names(batch_num), names)
+            self.assertFalse(writer.get_read_names_lookup_path(
+                batch_num).path.exists())
+
+
+class TestBatchSize(TestCase):
+    """ Test choosing the number of reads per batch from the cost of
+    vectorizing a sample of reads. """
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.sam_file = os.path.join(self.top, "reads.sam")
+        rng = random.Random(0)
+        self.ref_seq = DNA("".join(rng.choice("ACGT")
+                                   for _ in range(60)).encode())
+        self.writer = VectorWriter(self.top,
+                                   SimpleNamespace(
+                                       sample=SimpleNamespace(name="sample")),
+                                   "ref", 1, len(self.ref_seq), self.ref_seq,
+                                   False, SamReadFilter())
+        self.governor = get_governor()
+
+    def tearDown(self):
+        set_governor(self.governor)
+        shutil.rmtree(self.top)
+
+    def viewer(self, n_reads: int):
+        """ Write n_reads pairs of reads to a SAM file sorted by name and
+        return a viewer (not opened) to the file. """
+        ref = str(self.ref_seq)
+        with open(self.sam_file, "w") as f:
+            f.write(f"@HD\tVN:1.6\tSO:queryname\n"
+                    f"@SQ\tSN:ref\tLN:{len(ref)}\n")
+            for i in range(n_reads):
+                pos1, pos2 = i % 11 + 1, i % 11 + 31
+                for flag, pos, pnext in [(99, pos1, pos2), (147, pos2, pos1)]:
+                    seq = ref[pos - 1: pos + 19]
+                    f.write(f"read{i}\t{flag}\tref\t{pos}\t40\t20M\t=\t"
+                            f"{pnext}\t0\t{seq}\t{'I' * len(seq)}\n")
+        return SamViewer(None, SimpleNamespace(path=self.sam_file), "ref", 1,
+                         len(self.ref_seq), True, owner=False,
+                         read_filter=SamReadFilter())
+
+    def measure(self, n_reads: int):
+        """ Measure the cost per read and return it with the number of reads
+        that were vectorized to measure it. """
+        with mock.patch.object(self.writer, "_vectorize_record",
+                               wraps=self.writer._vectorize_record) as vec:
+            secs, mem = self.writer._measure_read_cost(self.viewer(n_reads))
+        return secs, mem, vec.call_count
+
+    def test_measure_sample(self):
+        secs, mem, n_vectorized = self.measure(3 * BATCH_SAMPLE_READS)
+        self.assertEqual(n_vectorized, BATCH_SAMPLE_READS)
+        self.assertGreater(secs, 0.0)
+        # Each read costs at least its vector, twice (as it is written).
+        self.assertGreater(mem, 2 * len(self.ref_seq))
+
+    def test_measure_fewer_reads(self):
+        secs, mem, n_vectorized = self.measure(BATCH_SAMPLE_READS // 4)
+        self.assertEqual(n_vectorized, BATCH_SAMPLE_READS // 4)
+        self.assertGreater(secs, 0.0)
+        self.assertGreater(mem, 2 * len(self.ref_seq))
+
+    def test_measure_no_reads(self):
+        self.assertEqual(self.measure(0), (0.0, 0.0, 0))
+        # The size of the batches falls back to the size of the vectors.
+        self.assertEqual(self.writer._get_batch_size(self.viewer(0)),
+                         DEFAULT_BATCH_SIZE // len(self.ref_seq))
+
+    def batch_size(self, secs: float, mem: float):
+        with mock.patch.object(self.writer, "_measure_read_cost",
+                               return_value=(secs, mem)):
+            return self.writer._get_batch_size(None)
+
+    def test_size(self):
+        set_governor(ResourceGovernor(max_cpus=1, max_mem=1 << 40))
+        with mock.patch.object(ResourceGovernor, "mem_available",
+                               return_value=1 << 40):
+            # Batches hold about DEFAULT_BATCH_SIZE bytes.
+            self.assertEqual(self.batch_size(1e-2, 1000.),
+                             DEFAULT_BATCH_SIZE // 1000)
+            # Unless they would take less than MIN_BATCH_SECONDS.
+            self.assertEqual(self.batch_size(1e-6, 1000.),
+                             int(MIN_BATCH_SECONDS / 1e-6))
+
+    def test_memory_cap(self):
+        # The batches of all processes must fit in MAX_BATCH_MEM_FRAC of the
+        # memory of the budget, even if they would take too little time.
+        max_mem = 10_000_000
+        for max_cpus in (1, 4):
+            with self.subTest(max_cpus=max_cpus):
+                set_governor(ResourceGovernor(max_cpus=max_cpus,
+                                              max_mem=max_mem))
+                self.assertEqual(self.batch_size(1e-6, 1000.),
+                                 int(max_mem * MAX_BATCH_MEM_FRAC
+                                     / (max_cpus * 1000.)))
+        # At least one read goes in each batch.
+        set_governor(ResourceGovernor(max_cpus=1, max_mem=1))
+        self.assertEqual(self.batch_size(1e-6, 1000.), 1)
+
+
+class TestGetWindows(TestCase):
+    def test_windows_cover_region(self):
+        for n in range(1, 12):
+            windows = get_windows(5, 14, n)
+            self.assertEqual(len(windows), min(n, 10))
+            self.assertEqual(windows[0][0], 5)
+            self.assertEqual(windows[-1][1], 14)
+            for (_, last), (first, _) in zip(windows[:-1], windows[1:]):
+                self.assertEqual(first, last + 1)
+
+
+class TestSamWindowViewer(TestCase):
+    # Region 1-20 in windows 1-10 and 11-20
+    windows = [(1, 10), (11, 20)]
+    lines = [b"A	99	R	3	40	4=	=	5	0	ACGT	IIII",
+             b"B	99	R	4	40	4=	=	13	0	ACGT	IIII",
+             b"A	147	R	5	40	4=	=	3	0	ACGT	IIII",
+             b"C	0	R	8	40	5=	*	0	0	ACGTA	IIIII",
+             b"B	147	R	13	40	4=	=	4	0	ACGT	IIII"]
+
+    def view(self, window_num: int):
+        sv = SamWindowViewer(None, "R", self.windows, window_num)
+        first, last = self.windows[window_num]
+        sv._iter_lines = lambda: iter(
+            line for line in self.lines
+            if int(line.split()[3]) <= last
+            and int(line.split()[3]) + len(line.split()[9]) > first)
+        records = [(rec.read_name, rec.read2 is not None)
+                   for rec in sv.get_records()]
+        return records, sv.leftovers
+
+    def test_window_records(self):
+        records, leftovers = self.view(0)
+        self.assertEqual(sorted(records), [("A", True), ("C", False)])
+        self.assertEqual(leftovers, [self.lines[1]])
+        records, leftovers = self.view(1)
+        self.assertEqual(records, [])
+        self.assertEqual(leftovers, [self.lines[4]])
+
+    def test_merge_mates(self):
+        leftovers = self.view(0)[1] + self.view(1)[1]
+        records = list(merge_mates(leftovers))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].read_name, "B")
+        self.assertTrue(records[0].read1.flag.first)
+        self.assertTrue(records[0].read2.flag.second)
+
+
+def make_pair_lines(ref: str, n_pairs: int, seed: int = 0):
+    """ Return the SAM lines (sorted by coordinate) of pairs of 12-nt mates
+    with random substitutions, some with low mapping quality, whose mates
+    start anywhere from the same position to far apart. """
+    rng = random.Random(seed)
+
+    def line(qname: str, flag: int, pos: int, mapq: int, pnext: int):
+        seq = "".join(rng.choice("ACGT") if rng.random() < 0.1 else base
+                      for base in ref[pos - 1: pos + 11])
+        return (pos, f"{qname}\t{flag}\tref\t{pos}\t{mapq}\t{len(seq)}M\t"
+                     f"=\t{pnext}\t0\t{seq}\t{'I' * len(seq)}\n".encode())
+
+    lines = list()
+    for i in range(n_pairs):
+        qname = f"FS10000136:97:BPN80019-0831:1:1101:{i}:1040"
+        mapq = 0 if rng.random() < 0.1 else 40
+        pos1 = rng.randint(1, len(ref) - 11)
+        pos2 = rng.randint(pos1, len(ref) - 11)
+        lines.append(line(qname, 99, pos1, mapq, pos2))
+        lines.append(line(qname, 147, pos2, 40, pos1))
+    return [text for _, text in sorted(lines, key=lambda pair: pair[0])]
+
+
+def overlaps(line: bytes, first: int, last: int):
+    """ Return whether a SAM line of an ungapped read overlaps first-last,
+    as samtools view does for a region. """
+    fields = line.split(b"\t")
+    pos = int(fields[3])
+    return pos <= last and pos + len(fields[9]) > first
+
+
+class TestVectorizeWindows(TestCase):
+    """ Test that the reads of a region, vectorized in windows and with
+    the mates that start in different windows merged, are vectorized the
+    same as when sorted by name. """
+
+    def setUp(self):
+        rng = random.Random(1)
+        self.ref = "".join(rng.choice("ACGT") for _ in range(60))
+        self.lines = make_pair_lines(self.ref, 200)
+        self.sam_file = os.path.join(tempfile.mkdtemp(), "reads.sam")
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.sam_file))
+
+    def vectorize(self, records, first: int, last: int):
+        region_seqb = self.ref[first - 1: last].encode()
+        return sorted((rec.read_name, bytes(rec.vectorize(region_seqb,
+                                                          first, last)))
+                      for rec in records)
+
+    def sorted_by_name(self, first: int, last: int):
+        lines = [line for line in self.lines if overlaps(line, first, last)]
+        with open(self.sam_file, "wb") as f:
+            f.write(b"@HD\tVN:1.6\tSO:queryname\n"
+                    + f"@SQ\tSN:ref\tLN:{len(self.ref)}\n".encode())
+            f.writelines(sorted(lines, key=lambda line: line.split()[0]))
+        read_filter = SamReadFilter()
+        sv = SamViewer(None, SimpleNamespace(path=self.sam_file), "ref",
+                       first, last, (first, last) == (1, len(self.ref)),
+                       owner=False, read_filter=read_filter)
+        with sv:
+            vectors = self.vectorize(sv.get_records(
+                sv._rec1_pos, os.path.getsize(self.sam_file)), first, last)
+        return vectors, read_filter.rejected
+
+    def in_windows(self, first: int, last: int, n_windows: int):
+        windows = get_windows(first, last, n_windows)
+        records = list()
+        leftovers = list()
+        rejected = dict()
+        filters = list()
+        for window_num, (win_first, win_last) in enumerate(windows):
+            read_filter = SamReadFilter()
+            sw = SamWindowViewer(None, "ref", windows, window_num,
+                                 read_filter)
+            sw._iter_lines = lambda a=win_first, b=win_last: iter(
+                line for line in self.lines if overlaps(line, a, b))
+            records.extend(sw.get_records())
+            leftovers.extend(sw.leftovers)
+            filters.append(read_filter)
+        merge_filter = SamReadFilter()
+        records.extend(filter(merge_filter, merge_mates(leftovers)))
+        for read_filter in filters + [merge_filter]:
+            for key, count in read_filter.rejected.items():
+                rejected[key] = rejected.get(key, 0) + count
+        return self.vectorize(records, first, last), rejected, leftovers
+
+    def test_same_as_sorted(self):
+        for first, last in [(1, 60), (11, 50)]:
+            expect, expect_rejected = self.sorted_by_name(first, last)
+            self.assertGreater(expect_rejected["mapq"], 0)
+            for n_windows in range(1, 6):
+                with self.subTest(first=first, last=last,
+                                  n_windows=n_windows):
+                    vectors, rejected, leftovers = self.in_windows(
+                        first, last, n_windows)
+                    self.assertEqual(vectors, expect)
+                    self.assertEqual(rejected, expect_rejected)
+                    if n_windows > 1:
+                        self.assertGreater(len(leftovers), 0)
+
+
+class TopDir(str):
+    """ Top-level directory that is both the string that the paths of the
+    vectors take and the path that the samtools steps take. """
+
+    @property
+    def top(self):
+        return str(self)
+
+
+@unittest.skipUnless(shutil.which("samtools"), "samtools is not installed")
+class TestVectorizeCoords(TestCase):
+    """ Test that vectoring in windows of coordinates in parallel gives the
+    same vectors and counts as vectoring the reads sorted by name. """
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.governor = get_governor()
+        set_governor(ResourceGovernor(max_cpus=3))
+        rng = random.Random(0)
+        ref = "".join(rng.choice("ACGT") for _ in range(60))
+        self.ref_seq = DNA(ref.encode())
+        sample_dir = os.path.join(self.top, "sample")
+        os.makedirs(sample_dir)
+        sam_file = os.path.join(sample_dir, "ref.sam")
+        with open(sam_file, "wb") as f:
+            f.write(b"@HD\tVN:1.6\tSO:coordinate\n"
+                    + f"@SQ\tSN:ref\tLN:{len(ref)}\n".encode())
+            f.writelines(make_pair_lines(ref, 200))
+        self.bam_path = path.OneRefAlignmentInFilePath(top=self.top,
+                                                       sample="sample",
+                                                       ref="ref",
+                                                       ext=path.BAM_EXT)
+        subprocess.run(["samtools", "view", "-b", "-o", self.bam_path.path,
+                        sam_file], check=True)
+
+    def tearDown(self):
+        set_governor(self.governor)
+        shutil.rmtree(self.top)
+
+    def vectorize(self, first: int, last: int, parallel_coords: bool):
+        """ Vectorize the region and return the writer, the sorted rows of
+        all batches, and the summed counts. """
+        top = TopDir(os.path.join(self.top, f"coords-{parallel_coords}"))
+        os.makedirs(top, exist_ok=True)
+        writer = VectorWriter(top,
+                              SimpleNamespace(
+                                  sample=SimpleNamespace(name="sample")),
+                              "ref", first, last, self.ref_seq, False,
+                              SamReadFilter(),
+                              parallel_coords=parallel_coords)
+        # The writer takes the name of the sample from the path of the BAM
+        # file, and the viewers need a path that can be indexed.
+        writer.bam_path = self.bam_path
+        writer.get_mv_batch_path(0).path.parent.mkdir(parents=True)
+        if parallel_coords:
+            writer._vectorize_sam_coords()
+        else:
+            writer._vectorize_sam()
+        rows = list()
+        counts = 0
+        for batch_num in writer.batch_nums:
+            batch = po.ORCFile(writer.get_mv_batch_path(batch_num).path).read()
+            rows.extend(map(tuple, batch.to_pandas().values.tolist()))
+            with np.load(writer.get_mv_counts_path(batch_num).path) as npz:
+                counts = counts + npz["counts"]
+        return writer, sorted(rows), counts
+
+    def test_same_as_serial(self):
+        for first, last in [(1, 60), (11, 50)]:
+            with self.subTest(first=first, last=last):
+                serial, expect, expect_counts = self.vectorize(first, last,
+                                                               False)
+                coords, rows, counts = self.vectorize(first, last, True)
+                self.assertGreater(len(expect), 0)
+                self.assertEqual(rows, expect)
+                np.testing.assert_array_equal(counts, expect_counts)
+                self.assertEqual(coords.num_vectors, serial.num_vectors)
+                self.assertEqual(coords.num_vectors, len(rows))
+                self.assertEqual(coords.reads_rejected, serial.reads_rejected)
+                self.assertGreater(serial.reads_rejected["mapq"], 0)
+                # One batch for each of the 3 windows and one for the mates
+                # that start in different windows.
+                self.assertEqual(coords.num_batches, 4)
+                self.assertGreater(coords.num_vectors
+                                   - sum(len(po.ORCFile(
+                                       coords.get_mv_batch_path(i).path)
+                                       .read()) for i in range(3)), 0)
+                shutil.rmtree(os.path.join(self.top, "coords-False"))
+                shutil.rmtree(os.path.join(self.top, "coords-True"))
+
+
+class TestSamViewerSampling(TestCase):
+    """ Test sampling reads from a SAM file sorted by name. """
+
+    def setUp(self):
+        rng = random.Random(0)
+        lines = list()
+        for i in range(300):
+            qname = f"FS10000136:97:BPN80019-0831:1:1101:{i}:1040"
+            kind = rng.choice(["pair", "pair", "first", "second"])
+            if kind in ("pair", "first"):
+                lines.append(f"{qname}\t99\tR\t1\t40\t4=\t=\t5\t0\tACGT\tIIII\n")
+            if kind in ("pair", "second"):
+                lines.append(f"{qname}\t147\tR\t5\t40\t4=\t=\t1\t0\tACGT\tIIII\n")
+        self.lines = [line.encode() for line in lines]
+        self.sam_file = os.path.join(tempfile.mkdtemp(), "reads.sam")
+        self.write_sam(self.lines)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.sam_file))
+
+    def write_sam(self, lines: list[bytes]):
+        with open(self.sam_file, "wb") as f:
+            f.write(b"@HD\tVN:1.6\tSO:queryname\n@SQ\tSN:R\tLN:20\n")
+            f.writelines(lines)
+
+    def viewer(self, sampler: SamReadSampler | None = None):
+        return SamViewer(None, SimpleNamespace(path=self.sam_file), "R", 1, 20,
+                         False, owner=False, sampler=sampler)
+
+    def all_records(self, sv: SamViewer):
+        return sv.get_records(sv._rec1_pos, os.path.getsize(self.sam_file))
+
+    @staticmethod
+    def names(records):
+        return [(rec.read_name, rec.read2 is not None) for rec in records]
+
+    def test_sample_lines(self):
+        sampler = SamReadSampler(0.3, seed=5)
+        with self.viewer() as sv:
+            expect = self.names(filter(sampler, self.all_records(sv)))
+            indexes = list(sv.get_batch_indexes(7))
+        self.assertGreater(len(expect), 0)
+        with self.viewer(sampler) as sv:
+            self.assertEqual(self.names(self.all_records(sv)), expect)
+            # Batches of the sample together hold the whole sample.
+            self.assertEqual([name for start, stop in zip(indexes[:-1], indexes[1:])
+                              for name in self.names(sv.get_records(start, stop))],
+                             expect)
+
+    def test_skip_without_parsing(self):
+        sampler = SamReadSampler(0.5, seed=1)
+        # The first line tells whether the reads are paired.
+        skipped = [line for line in self.lines[1:] if not sampler.keep_line(line)]
+        # Lines of reads not in the sample are never parsed, so they may
+        # even be malformed.
+        self.write_sam([line.replace(b"\t147\t", b"\tX\t").replace(b"\t99\t", b"\tX\t")
+                        if line in skipped else line for line in self.lines])
+        with self.viewer(sampler) as sv:
+            # Every kept name makes one record, whether one or both of
+            # its mates are in the file.
+            self.assertEqual(len(list(self.all_records(sv))),
+                             len({line.split(b"\t", 1)[0] for line
+                                  in filter(sampler.keep_line, self.lines)}))
+
+    @unittest.skipUnless(shutil.which("samtools"), "samtools is not installed")
+    def test_count_reads(self):
+        bam_path = path.OneRefAlignmentInFilePath(
+            top=os.path.dirname(self.sam_file), sample="sample", ref="R",
+            ext=path.BAM_EXT)
+        os.makedirs(os.path.dirname(bam_path.path))
+
+        def count(lines: list[bytes]):
+            self.write_sam(lines)
+            subprocess.run(["samtools", "view", "-b", "-o", bam_path.path,
+                            self.sam_file], check=True)
+            return count_reads(bam_path)
+
+        # Every complete pair counts once.
+        names = Counter(line.split(b"\t", 1)[0] for line in self.lines)
+        pairs = [line for line in self.lines
+                 if names[line.split(b"\t", 1)[0]] == 2]
+        self.assertEqual(count(pairs), len(pairs) // 2)
+        # Every unpaired read counts once.
+        single = [line.replace(b"\t99\t", b"\t0\t").replace(b"\t147\t", b"\t16\t")
+                  for line in self.lines]
+        self.assertEqual(count(single), len(single))
+        # A pair with only one mate in the file counts as half.
+        self.assertEqual(count(single[:3] + pairs[:4] + [pairs[5]]), 6)
 
 if __name__ == "__main__":
     unittest.main()
@@ -2,6 +2,8 @@ from __future__ import annotations
 import re
 from typing import List, Optional
 
+import numpy as np
+
 from dreem.util.util import BASES, SUB_A, SUB_C, SUB_G, SUB_T, SUB_N, MATCH, DELET, ANY_N, INS_3, INS_5, BLANK, DNA, DEFAULT_PHRED_ENCODING
 
 
@@ -364,6 +366,12 @@ class SamFlag(object):
          self.dup, self.supp) = (x == "1" for x in
                                  self.PATTERN.format(bin(flag)[:1:-1]))
 
+    @property
+    def value(self):
+        """ Return the flag as an int (the inverse of parsing it). """
+        return sum(getattr(self, name) << bit
+                   for bit, name in enumerate(self.__slots__))
+
 
 class SamRead(object):
     __slots__ = ["qname", "flag", "rname", "pos", "mapq", "cigar",
@@ -509,11 +517,27 @@ def get_consensus_mut(byte1: int, byte2: int):
     return intersect if (intersect := byte1 & byte2) else byte1 | byte2
 
 
+def get_consensus_muts(muts1: np.ndarray, muts2: np.ndarray):
+    """
+    Vectorized version of get_consensus_mut: merge two mutation vectors
+    (uint8 arrays of equal length) in a single pass. Wherever one mate does
+    not cover a position (BLANK), the intersection is 0 and the consensus is
+    simply the byte of the other mate; only positions where the mates overlap
+    can have a non-zero intersection, which then becomes the consensus.
+    """
+    intersect = muts1 & muts2
+    return np.where(intersect, intersect, muts1 | muts2)
+
+
 def vectorize_pair(region_seq: bytes, region_first: int, region_last: int,
                    read1: SamRead, read2: SamRead):
+    # Each mate walks only the part of its CIGAR string that lies within the
+    # region; the positions it does not cover are BLANK padding.
     muts1 = vectorize_read(region_seq, region_first, region_last, read1)
     muts2 = vectorize_read(region_seq, region_first, region_last, read2)
-    return bytearray(map(get_consensus_mut, muts1, muts2))
+    # Merge the mates in one vectorized step instead of byte by byte.
+    return bytearray(get_consensus_muts(np.frombuffer(muts1, dtype=np.uint8),
+                                        np.frombuffer(muts2, dtype=np.uint8)))
 
 
 class SamRecord(object):